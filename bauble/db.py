@@ -27,6 +27,9 @@ from sqlalchemy.orm import class_mapper
 import datetime
 import os
 import re
+import threading
+import time
+from contextlib import contextmanager
 import bauble.error as error
 from bauble.i18n import _
 
@@ -94,25 +97,242 @@ def natsort(attr, obj):
     partial(natsort, 'accessions')(species)
     partial(natsort, 'species.accessions')(vern_name)
     """
-    from bauble import utils
     jumps = attr.split('.')
-    for attr in jumps:
+    for attr in jumps[:-1]:
         obj = getattr(obj, attr)
-    return sorted(obj, key=utils.natsort_key)
+    import bauble.sortkey as sortkey
+    result = sortkey.sorted_relation(obj, jumps[-1])
+    if result is None:
+        result = sorted(getattr(obj, jumps[-1]), key=natsort_key)
+    return result
 
 
-class HistoryExtension(orm.MapperExtension):
+## natural sort keys are cached on the instances, and dropped when the
+## instance, or an object its string depends on, is changed, expired or
+## refreshed.
+
+## class -> names of the relations from its objects to the objects
+## whose string depends on them; see set_natsort_dependents.
+_natsort_dependents = {}
+
+## session.info key of the classes whose cached keys may be stale: an
+## object their strings depend on was changed, and the relation to
+## them was not loaded.  they are dropped at the next natsort_key.
+NATSORT_STALE = 'natsort_stale'
+
+
+def natsort_key(obj):
+    """return the natural sort key of obj, see utils.natsort_text
+
+    the key of a mapped object is cached on the instance, until one of
+    its mapped attributes, or of the objects registered by
+    set_natsort_dependents, is changed, expired or refreshed.
     """
-    HistoryExtension is a
-    :class:`~sqlalchemy.orm.interfaces.MapperExtension` that is added
-    to all clases that inherit from bauble.db.Base so that all
-    inserts, updates, and deletes made to the mapped objects are
-    recorded in the `history` table.
+    state = sa.inspect(obj, raiseerr=False)
+    session = getattr(state, 'session', None)
+    if session is not None and session.info.get(NATSORT_STALE):
+        _forget_stale_natsort_keys(session)
+    cached = getattr(obj, '__dict__', {}).get('_natsort_key')
+    if cached is not None:
+        return cached
+    key = utils.natsort_text(obj)
+    set_natsort_key(obj, key)
+    return key
+
+
+def set_natsort_key(obj, key):
+    """cache key as the natural sort key of obj
     """
-    def _add(self, operation, mapper, instance):
-        """
-        Add a new entry to the history table.
-        """
+    if hasattr(obj, '__dict__'):
+        obj.__dict__['_natsort_key'] = key
+
+
+def set_natsort_dependents(cls, dependents):
+    """the strings of the objects in the dependents relations of a cls
+    object depend on it, and their cached keys go with its own.
+    """
+    _natsort_dependents[cls] = tuple(dependents)
+
+
+def _forget_natsort_key(target, loaded_only):
+    if target is None:
+        # expired after being garbage collected
+        return
+    target.__dict__.pop('_natsort_key', None)
+    for name in _natsort_dependents.get(type(target), ()):
+        if name in target.__dict__:
+            for obj in target.__dict__[name] or ():
+                obj.__dict__.pop('_natsort_key', None)
+            continue
+        session = orm.object_session(target)
+        if loaded_only or session is None:
+            continue
+        # the dependents in the session are not known without a query,
+        # they are looked for once, when a key is needed.
+        cls = sa.inspect(type(target)).relationships[name].mapper.class_
+        session.info.setdefault(NATSORT_STALE, set()).add(cls)
+
+
+def _forget_stale_natsort_keys(session):
+    classes = tuple(session.info.pop(NATSORT_STALE))
+    for obj in session.identity_map.values():
+        if isinstance(obj, classes):
+            obj.__dict__.pop('_natsort_key', None)
+
+
+def _natsort_changed(target, *args):
+    _forget_natsort_key(target, False)
+
+
+def _natsort_reloaded(target, *args):
+    _forget_natsort_key(target, True)
+
+
+def _watch_natsort_changes(mapper, cls):
+    if not issubclass(cls, Base):
+        return
+    for prop in mapper.column_attrs:
+        sa.event.listen(prop.class_attribute, 'set', _natsort_changed)
+    for prop in mapper.relationships:
+        if prop.uselist:
+            sa.event.listen(prop.class_attribute, 'append', _natsort_changed)
+            sa.event.listen(prop.class_attribute, 'remove', _natsort_changed)
+        else:
+            sa.event.listen(prop.class_attribute, 'set', _natsort_changed)
+    sa.event.listen(cls, 'expire', _natsort_reloaded)
+    sa.event.listen(cls, 'refresh', _natsort_reloaded)
+
+
+IN_CHUNK_SIZE = 500
+"""Maximum number of values bound in a single `IN (...)` clause.
+
+SQLite refuses statements with more than 999 bound parameters.
+"""
+
+
+def load_by_ids(session, cls, ids, options=(), populate_existing=False):
+    """return the list of `cls` objects whose id is in `ids`
+
+    objects are loaded with one `IN` query per IN_CHUNK_SIZE ids, and
+    `options` (like `orm.joinedload('species')`) are applied to each
+    query.  the order of the result is undefined.  objects already in
+    the session keep their state, unless `populate_existing` is set.
+    """
+    ids = list(ids)
+    result = []
+    for start in range(0, len(ids), IN_CHUNK_SIZE):
+        chunk = ids[start:start + IN_CHUNK_SIZE]
+        query = session.query(cls).options(*options)
+        if populate_existing:
+            query = query.populate_existing()
+        result.extend(query.filter(cls.id.in_(chunk)).all())
+    return result
+
+
+def in_ids(column, ids):
+    """return the `column IN (ids)` clause, for any number of integer ids
+
+    up to IN_CHUNK_SIZE ids are bound as parameters, more are rendered
+    literally in the statement, so that a single statement can still
+    aggregate over all of them.
+    """
+    ids = [int(i) for i in ids]
+    if len(ids) <= IN_CHUNK_SIZE:
+        return column.in_(ids)
+    return column.in_([sa.literal_column(str(i)) for i in ids])
+
+
+_change_listeners = {}
+
+
+def add_change_listener(callback, table_name=None):
+    """have callback(table_name, operation) invoked on changes
+
+    `HistoryExtension` notifies each insert, update and delete of a row
+    of `table_name`, or of any table if `table_name` is None, and the
+    commit or the rollback of the session having flushed them.  changes
+    made by other database clients are not notified.
+    """
+    _change_listeners.setdefault(table_name, []).append(callback)
+
+
+def remove_change_listener(callback, table_name=None):
+    """stop notifying changes to callback
+    """
+    try:
+        _change_listeners.get(table_name, []).remove(callback)
+    except ValueError:
+        pass
+
+
+def notify_change(table_name, operation):
+    """invoke the listeners of the changes to table_name
+    """
+    for table in (table_name, None):
+        for callback in list(_change_listeners.get(table, [])):
+            callback(table_name, operation)
+
+
+## session.info key of the names of the tables changed by the session
+## since its last commit.
+CHANGED_TABLES = 'changed_tables'
+
+
+def _notify_flushed(instance, table_name, operation):
+    session = orm.object_session(instance)
+    if session is not None:
+        session.info.setdefault(CHANGED_TABLES, set()).add(table_name)
+    notify_change(table_name, operation)
+
+
+def _notify_committed(session):
+    """the changes notified since the last commit are now seen by the
+    other sessions, which may have read the tables in the meanwhile
+    """
+    for table_name in session.info.pop(CHANGED_TABLES, ()):
+        notify_change(table_name, 'commit')
+
+
+def _notify_rolled_back(session):
+    """the changes notified since the last commit are undone
+    """
+    for table_name in session.info.pop(CHANGED_TABLES, ()):
+        notify_change(table_name, 'rollback')
+
+
+sa.event.listen(orm.Session, 'after_commit', _notify_committed)
+sa.event.listen(orm.Session, 'after_rollback', _notify_rolled_back)
+
+
+## session.info keys of the history entries of the running flush, of the
+## name of the user recording them, and of the history opt-out.
+HISTORY = 'history_entries'
+HISTORY_USER = 'history_user'
+NO_HISTORY = 'no_history'
+
+## columns set by the database at each insert and update, which would be
+## loaded again to be recorded: they are recorded as None unless loaded;
+## see HistoryExtension._add.
+_TIMESTAMPS = ('_created', '_last_updated')
+
+## mapper -> (column name, attribute key) pairs, to be recorded in history
+_history_columns = {}
+
+
+def record_history(session, record=True):
+    """set whether the changes flushed by session are recorded in history
+
+    bulk imports and restores may turn it off.
+    """
+    session.info[NO_HISTORY] = not record
+
+
+def _history_user(session):
+    """return the name of the user recording the history of session
+
+    the user is looked up at the first flush of the session.
+    """
+    if HISTORY_USER not in session.info:
         user = None
         try:
             if engine.name.startswith('sqlite'):
@@ -124,24 +344,95 @@ class HistoryExtension(orm.MapperExtension):
                 user = os.environ['USER']
             elif 'USERNAME' in os.environ and os.environ['USERNAME']:
                 user = os.environ['USERNAME']
+        session.info[HISTORY_USER] = user
+    return session.info[HISTORY_USER]
+
+
+def _start_history(session, flush_context, instances):
+    session.info.pop(HISTORY, None)  # left over by a failed flush
+
 
+def _write_history(session, flush_context):
+    entries = session.info.pop(HISTORY, None)
+    if not entries:
+        return
+    user = _history_user(session)
+    for entry in entries:
+        entry['user'] = user
+    session.connection().execute(History.__table__.insert(), entries)
+
+
+def add_history(session, table, rows, operation):
+    """record rows of table, changed bypassing the ORM, in the history
+
+    rows are the complete rows of table, as read from the database, and
+    are recorded like HistoryExtension does, with one statement on the
+    connection of session.
+    """
+    if session.info.get(NO_HISTORY) or not rows:
+        return
+    timestamp = datetime.datetime.today()
+    user = _history_user(session)
+    session.connection().execute(History.__table__.insert(), [
+        dict(table_name=table.name, table_id=row['id'],
+             values=str(dict((c.name, utils.utf8(row[c.name]))
+                             for c in table.c)),
+             operation=operation, user=user, timestamp=timestamp)
+        for row in rows])
+
+
+sa.event.listen(orm.Session, 'before_flush', _start_history)
+sa.event.listen(orm.Session, 'after_flush', _write_history)
+
+
+class HistoryExtension(orm.MapperExtension):
+    """
+    HistoryExtension is a
+    :class:`~sqlalchemy.orm.interfaces.MapperExtension` that is added
+    to all clases that inherit from bauble.db.Base so that all
+    inserts, updates, and deletes made to the mapped objects are
+    recorded in the `history` table.
+
+    the entries are collected during the flush, and inserted at its end
+    with one statement, in the same transaction.
+    """
+    def _add(self, operation, mapper, instance):
+        """
+        Add a new entry to the history of the flush of instance.
+        """
+        session = orm.object_session(instance)
+        if session.info.get(NO_HISTORY):
+            return
+        timestamp = datetime.datetime.today()
+        columns = _history_columns.get(mapper)
+        if columns is None:
+            columns = _history_columns[mapper] = [
+                (c.name, mapper.get_property_by_column(c).key)
+                for c in mapper.local_table.c]
+        loaded = sa.inspect(instance).dict
         row = {}
-        for c in mapper.local_table.c:
-            row[c.name] = utils.utf8(getattr(instance, c.name))
-        table = History.__table__
-        table.insert(dict(table_name=mapper.local_table.name,
-                          table_id=instance.id, values=str(row),
-                          operation=operation, user=user,
-                          timestamp=datetime.datetime.today())).execute()
+        for name, key in columns:
+            if key not in loaded and name in _TIMESTAMPS:
+                value = None
+            else:
+                value = getattr(instance, key)
+            row[name] = utils.utf8(value)
+        session.info.setdefault(HISTORY, []).append(
+            dict(table_name=mapper.local_table.name, table_id=instance.id,
+                 values=str(row), operation=operation,
+                 timestamp=timestamp))
 
     def after_update(self, mapper, connection, instance):
         self._add('update', mapper, instance)
+        _notify_flushed(instance, mapper.local_table.name, 'update')
 
     def after_insert(self, mapper, connection, instance):
         self._add('insert', mapper, instance)
+        _notify_flushed(instance, mapper.local_table.name, 'insert')
 
     def after_delete(self, mapper, connection, instance):
         self._add('delete', mapper, instance)
+        _notify_flushed(instance, mapper.local_table.name, 'delete')
 
 
 registered_tables = {}
@@ -170,6 +461,9 @@ class MapperBase(DeclarativeMeta):
             registered_tables[dict_['__tablename__']] = cls
         if 'top_level_count' not in dict_:
             cls.top_level_count = lambda x: {classname: 1}
+            if 'top_level_count_query' not in dict_:
+                cls.top_level_count_query = classmethod(
+                    lambda c, session, ids: {classname: len(ids)})
         if 'search_view_markup_pair' not in dict_:
             cls.search_view_markup_pair = lambda x: (
                 utils.xml_safe(str(x)),
@@ -199,6 +493,35 @@ database deadlocks, particularly when using PostgreSQL based
 databases.
 """
 
+WorkerSession = None
+"""
+bauble.db.WorkerSession is the :class:`sqlalchemy.orm.scoped_session`
+registry of the sessions of the background threads, created next to
+:data:`Session` by :func:`bauble.db.open()`.  Threads should use it
+through :func:`worker_session`.
+"""
+
+pool_metrics = None
+"""
+The :class:`PoolMetrics` of :data:`engine`.
+"""
+
+
+@contextmanager
+def worker_session():
+    """yield the session of the current thread, removed on exit
+
+    to be used by the background threads::
+
+        with db.worker_session() as session:
+            ...
+    """
+    session = WorkerSession()
+    try:
+        yield session
+    finally:
+        WorkerSession.remove()
+
 Base = declarative_base(metaclass=MapperBase)
 """
 All tables/mappers in Ghini which use the SQLAlchemy declarative
@@ -214,6 +537,8 @@ metadata = Base.metadata
 An instance of :class:`sqlalchemy.schema.Metadata`
 """
 
+sa.event.listen(orm.mapper, 'mapper_configured', _watch_natsort_changes)
+
 history_base = declarative_base(metadata=metadata)
 
 
@@ -239,8 +564,17 @@ class History(history_base):
         The name of the user who made the change.
       timestamp: :class:`sqlalchemy.types.DateTime`
         When the change was made.
+
+    the table is indexed on timestamp, on table_name and table_id, and
+    on user.  :mod:`bauble.history` maintains it.
     """
     __tablename__ = 'history'
+    __table_args__ = (
+        sa.Index('ix_history_timestamp', 'timestamp'),
+        sa.Index('ix_history_table', 'table_name', 'table_id',
+                 mysql_length={'table_name': 64}),
+        sa.Index('ix_history_user', 'user', mysql_length={'user': 64}),
+        {})
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
     table_name = sa.Column(sa.Text, nullable=False)
     table_id = sa.Column(sa.Integer, nullable=False, autoincrement=False)
@@ -250,6 +584,158 @@ class History(history_base):
     timestamp = sa.Column(types.DateTime, nullable=False)
 
 
+def pool_options(uri):
+    """return the keyword arguments of create_engine for the pool of uri
+
+    a database server, such as PostgreSQL, is reached through a
+    QueuePool, sized by the `bauble.db.pool_size` and
+    `bauble.db.max_overflow` preferences.  each thread keeps its own
+    connection to SQLite, shared by the nested checkouts of the thread:
+    it is not rolled back when they are checked in, which would discard
+    the work of the session owning its transaction.
+    """
+    from sqlalchemy.engine.url import make_url
+    from sqlalchemy.pool import QueuePool, SingletonThreadPool
+    if make_url(uri).get_backend_name() == 'sqlite':
+        return {'poolclass': SingletonThreadPool, 'pool_size': 20,
+                'pool_reset_on_return': None}
+    return {'poolclass': QueuePool,
+            'pool_size': _pref('pool_size_pref', 5),
+            'max_overflow': _pref('max_overflow_pref', 10),
+            'pool_recycle': 3600}
+
+
+def _pref(name, default):
+    """the value of the preference, default if not set or not yet loaded
+    """
+    import bauble.prefs as prefs
+    try:
+        return prefs.prefs.get(getattr(prefs, name), default)
+    except AttributeError:  # prefs.init() was not called
+        return default
+
+
+def _use_wal(engine):
+    return (engine.dialect.name == 'sqlite' and
+            engine.url.database not in (None, '', ':memory:') and
+            _pref('sqlite_wal_pref', True))
+
+
+def _sqlite_wal(dbapi_connection, connection_record):
+    """let the readers of a SQLite file go on while a writer commits
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
+
+
+class PoolMetrics(object):
+    """count the connections checked out from the pool of an engine
+
+    `connects` is the number of DBAPI connections opened, `checkouts`
+    the number of times a connection was handed out, `checked_out` the
+    number of connections in use now and `peak` its maximum, `held` the
+    seconds spent by the connections out of the pool.
+    """
+
+    def __init__(self, engine):
+        self.connects = self.checkouts = self.checked_out = self.peak = 0
+        self.held = 0.0
+        self._lock = threading.Lock()
+        sa.event.listen(engine, 'connect', self._connect)
+        sa.event.listen(engine, 'checkout', self._checkout)
+        sa.event.listen(engine, 'checkin', self._checkin)
+
+    def _connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _checkout(self, dbapi_connection, connection_record, proxy):
+        ## the SQLite connection of a thread is checked out again by its
+        ## nested connects, count it once, until its last checkin
+        info = connection_record.info
+        info['checkout_depth'] = info.get('checkout_depth', 0) + 1
+        with self._lock:
+            self.checkouts += 1
+            if info['checkout_depth'] > 1:
+                return
+            info['checkout_time'] = time.time()
+            self.checked_out += 1
+            self.peak = max(self.peak, self.checked_out)
+
+    def _checkin(self, dbapi_connection, connection_record):
+        info = connection_record.info
+        depth = info.pop('checkout_depth', 0) - 1
+        if depth > 0:
+            info['checkout_depth'] = depth
+            return
+        start = info.pop('checkout_time', None)
+        if start is None:
+            return
+        with self._lock:
+            self.checked_out -= 1
+            self.held += time.time() - start
+
+    def __str__(self):
+        return ('%(connects)d connects, %(checkouts)d checkouts, '
+                '%(checked_out)d checked out (peak %(peak)d), '
+                'held %(held).1f seconds' % self.__dict__)
+
+
+class StatementRecorder(object):
+    """record the SQL statements executed on an engine, db.engine by default
+
+    use it as a context manager.  `statements` holds the text of the
+    statements, in order of execution, `parameters` their parameters, a
+    list of them for an executemany, and `timings` their seconds, None
+    for the statements that failed.
+    """
+
+    def __init__(self, bind=None):
+        self.engine = bind or engine
+        self.statements = []
+        self.parameters = []
+        self.timings = []
+        self._lock = threading.Lock()
+
+    def _before(self, conn, cursor, statement, parameters, *args):
+        with self._lock:
+            self.statements.append(statement)
+            self.parameters.append(parameters)
+            self.timings.append(None)
+            index = len(self.timings) - 1
+        conn.info.setdefault(self, []).append((index, time.time()))
+
+    def _started(self, conn):
+        started = conn.info.get(self)
+        if not started:
+            return None, None
+        index, start = started.pop()
+        if not started:
+            del conn.info[self]
+        return index, start
+
+    def _after(self, conn, cursor, statement, parameters, *args):
+        index, start = self._started(conn)
+        if index is not None:
+            self.timings[index] = time.time() - start
+
+    def _failed(self, context):
+        if context.connection is not None:
+            self._started(context.connection)
+
+    def __enter__(self):
+        sa.event.listen(self.engine, 'before_cursor_execute', self._before)
+        sa.event.listen(self.engine, 'after_cursor_execute', self._after)
+        sa.event.listen(self.engine, 'handle_error', self._failed)
+        return self
+
+    def __exit__(self, *args):
+        sa.event.remove(self.engine, 'before_cursor_execute', self._before)
+        sa.event.remove(self.engine, 'after_cursor_execute', self._after)
+        sa.event.remove(self.engine, 'handle_error', self._failed)
+
+
 def open(uri, verify=True, show_error_dialogs=False):
     """
     Open a database connection.  This function sets bauble.db.engine to
@@ -277,13 +763,12 @@ def open(uri, verify=True, show_error_dialogs=False):
     global engine
     new_engine = None
 
-    from sqlalchemy.pool import NullPool, SingletonThreadPool
-    from bauble.prefs import testing
-    poolclass = testing and SingletonThreadPool or NullPool
-    poolclass = SingletonThreadPool
     new_engine = sa.create_engine(uri, echo=SQLALCHEMY_DEBUG,
                                   implicit_returning=False,
-                                  poolclass=poolclass, pool_size=20)
+                                  **pool_options(uri))
+    if _use_wal(new_engine):
+        sa.event.listen(new_engine, 'connect', _sqlite_wal)
+    metrics = PoolMetrics(new_engine)
     # TODO: there is a problem here: the code may cause an exception, but we
     # immediately loose the 'new_engine', which should know about the
     # encoding used in the exception string.
@@ -295,15 +780,12 @@ def open(uri, verify=True, show_error_dialogs=False):
 
     def _bind():
         """bind metadata to engine and create sessionmaker """
-        global Session, engine
+        global Session, WorkerSession, engine, pool_metrics
         engine = new_engine
+        pool_metrics = metrics
         metadata.bind = engine  # make engine implicit for metadata
-        def temp():
-            import inspect
-            logger.debug('creating session %s' % str(inspect.stack()[1]))
-            return sessionmaker(bind=engine, autoflush=False)()
         Session = sessionmaker(bind=engine, autoflush=False)
-        Session = temp
+        WorkerSession = orm.scoped_session(Session)
 
     if new_engine is not None and not verify:
         _bind()
@@ -313,6 +795,16 @@ def open(uri, verify=True, show_error_dialogs=False):
 
     verify_connection(new_engine, show_error_dialogs)
     _bind()
+    import bauble.history as history
+    try:
+        created = history.upgrade(engine)
+    except Exception, e:
+        # possibly the user may not create indexes
+        logger.warning('could not create the history indexes: %s'
+                       % utils.utf8(e))
+    else:
+        if created:
+            logger.info('created indexes %s' % ', '.join(created))
     return engine
 
 
@@ -395,6 +887,24 @@ def create(import_defaults=True):
         connection.close()
 
 
+def create_missing_indexes(table, engine=None):
+    """create the indexes of table missing in the database of engine, by
+    default the engine bound to the metadata of table
+
+    databases created before the indexes were part of the model don't
+    have them.  return the names of the created indexes.
+    """
+    engine = engine or table.bind
+    existing = set(i['name']
+                   for i in sa.inspect(engine).get_indexes(table.name))
+    created = []
+    for index in sorted(table.indexes, key=lambda i: i.name):
+        if index.name not in existing:
+            index.create(bind=engine)
+            created.append(index.name)
+    return created
+
+
 def verify_connection(engine, show_error_dialogs=False):
     """
     Test whether a connection to an engine is a valid Ghini database. This
@@ -537,6 +1047,7 @@ class Serializable:
     import re
     single_cap_re = re.compile('([A-Z])')
     link_keys = []
+    retrieve_keys = []
 
     def as_dict(self):
         result = dict((col, getattr(self, col))
@@ -567,11 +1078,29 @@ class Serializable:
     def retrieve_or_create(cls, session, keys,
                            create=True, update=True):
         """return database object corresponding to keys
+
+        if session memoises lookups (see memoise_lookups), the object
+        returned for keys is returned again for the same keys, without
+        querying nor updating it, and flushing is left to the caller.
         """
 
         logger.debug('initial value of keys: %s' % keys)
         ## first try retrieving
-        is_in_session = cls.retrieve(session, keys)
+        memo = session.info.get(MEMO)
+        if memo is None:
+            is_in_session = cls.retrieve(session, keys)
+        else:
+            natural_key = (cls, repr(sorted(keys.items())))
+            if natural_key in memo:
+                # these very keys were already applied
+                return memo[natural_key]
+            # what we look for may be still pending, flushing is only
+            # needed if a pending object could match.
+            with session.no_autoflush:
+                is_in_session = cls.retrieve(session, keys)
+            if not is_in_session and _may_be_pending(session, cls, keys):
+                session.flush()
+                is_in_session = cls.retrieve(session, keys)
         logger.debug('2 value of keys: %s' % keys)
 
         if not create and not is_in_session:
@@ -658,12 +1187,67 @@ class Serializable:
                 setattr(result, k, v)
         logger.debug('returning updated existing %s' % result)
 
-        session.flush()
+        if memo is None:
+            session.flush()
+        else:
+            memo[natural_key] = result
+            session.info.setdefault(MEMO_PENDING, []).append(natural_key)
 
         logger.debug('returning new %s' % result)
         return result
 
 
+## session.info keys of the lookup memo, and of the keys memoised since
+## the last commit.
+MEMO = 'serializable_memo'
+MEMO_PENDING = 'serializable_memo_pending'
+
+
+def memoise_lookups(session):
+    """have Serializable.retrieve_or_create memoise its lookups in session
+
+    meant for bulk imports: the memo lives as long as the session, the
+    lookups rolled back must be forgotten, see forget_rolled_back.
+    """
+    session.info[MEMO] = {}
+    session.info.pop(MEMO_PENDING, None)
+
+
+def _keep_memoised(session):
+    session.info.pop(MEMO_PENDING, None)
+
+
+sa.event.listen(orm.Session, 'after_commit', _keep_memoised)
+
+
+def _may_be_pending(session, cls, keys):
+    """whether a cls object added to session, and not yet flushed, could
+    be the one keys retrieve
+
+    only the cls.retrieve_keys columns are compared, the other keys being
+    values to update.  pending objects of a class without retrieve_keys
+    could always match.
+    """
+    names = [k for k in cls.retrieve_keys if k in keys]
+    for obj in session.new:
+        if isinstance(obj, cls) and \
+                all(getattr(obj, k) == keys[k] for k in names):
+            return True
+    return False
+
+
+def forget_rolled_back(session):
+    """drop from the lookup memo of session the lookups since the last commit
+
+    the objects created by them are gone, and the changes applied to
+    the others are undone, so that they must be looked up and applied
+    again.
+    """
+    memo = session.info.get(MEMO, {})
+    for natural_key in session.info.pop(MEMO_PENDING, ()):
+        memo.pop(natural_key, None)
+
+
 def construct_from_dict(session, obj, create=True, update=True):
     ## get class and remove reference
     logger.debug("construct_from_dict %s" % obj)
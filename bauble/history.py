@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+"""
+Maintenance of the history table.
+
+:class:`bauble.db.History` gets a row per change to a mapped object,
+and grows without bound.  This module:
+
+* adds to older databases the indexes of the table, by :func:`upgrade`,
+  run when the database is opened;
+* collapses the consecutive updates of an object by the same user into
+  the last of them, which holds all values of the object, by
+  :func:`compact`;
+* moves the rows older than a date into the `history_archive` table,
+  compressed in chunks, by :func:`archive`; :func:`archived` reads them
+  back.
+
+The archive table is optional, created by the first :func:`archive`.
+The `history-maintenance` command, and scripts/history_maintenance.py,
+run :func:`compact` and :func:`archive`.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import datetime
+import json
+import zlib
+from array import array
+
+import sqlalchemy as sa
+
+import bauble.db as db
+import bauble.pluginmgr as pluginmgr
+import bauble.utils as utils
+
+## history rows per archive row
+ARCHIVE_CHUNK_SIZE = 10000
+
+## the history columns, in the order they are archived
+COLUMNS = ('id', 'table_name', 'table_id', 'values', 'operation', 'user',
+           'timestamp')
+
+archive_table = sa.Table(
+    'history_archive', sa.MetaData(),
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('first_id', sa.Integer, nullable=False),
+    sa.Column('last_id', sa.Integer, nullable=False),
+    sa.Column('last_timestamp', sa.Text, nullable=False),
+    sa.Column('rows', sa.Integer, nullable=False),
+    sa.Column('data', sa.LargeBinary, nullable=False))
+
+
+def _forget(target, connection, **kwargs):
+    """the database was created again, its old history is gone
+    """
+    archive_table.drop(bind=connection, checkfirst=True)
+
+
+sa.event.listen(db.metadata, 'after_create', _forget)
+
+
+def upgrade(engine=None):
+    """create the history indexes missing in the database
+
+    return the names of the created indexes.
+    """
+    return db.create_missing_indexes(db.History.__table__, engine)
+
+
+def _in_transaction(connection, function, *args):
+    transaction = connection.begin()
+    try:
+        result = function(connection, *args)
+    except Exception, e:
+        logger.warning('history%s: %s' % (function.__name__,
+                                          utils.utf8(e)))
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    return result
+
+
+def _compact(connection, before):
+    table = db.History.__table__
+    query = sa.select([table.c.id, table.c.table_name, table.c.table_id,
+                       table.c.operation, table.c.user]).\
+        order_by(table.c.table_name, table.c.table_id, table.c.id)
+    if before is not None:
+        query = query.where(table.c.timestamp < before)
+    collapsed = array('l')
+    previous = None
+    result = connection.execute(query)
+    for row in result:
+        if (previous is not None and row.operation == 'update' and
+                previous.operation == 'update' and
+                (row.table_name, row.table_id, row.user) ==
+                (previous.table_name, previous.table_id, previous.user)):
+            collapsed.append(previous.id)
+        previous = row
+    result.close()
+    for start in range(0, len(collapsed), db.IN_CHUNK_SIZE):
+        connection.execute(table.delete().where(table.c.id.in_(
+            collapsed[start:start + db.IN_CHUNK_SIZE].tolist())))
+    return len(collapsed)
+
+
+def compact(connection, before=None):
+    """collapse the consecutive updates of each object by the same user
+
+    only the last update of each run is kept, and only the rows older
+    than before are considered, if given.  return the number of deleted
+    rows.
+    """
+    return _in_transaction(connection, _compact, before)
+
+
+def _archive(connection, before):
+    table = db.History.__table__
+    archive_table.create(bind=connection, checkfirst=True)
+    result = connection.execution_options(stream_results=True).execute(
+        sa.select([table.c[name] for name in COLUMNS]).
+        where(table.c.timestamp < before).order_by(table.c.id))
+    archived = 0
+    while True:
+        rows = result.fetchmany(ARCHIVE_CHUNK_SIZE)
+        if not rows:
+            break
+        data = [list(row)[:-1] + [str(row.timestamp)] for row in rows]
+        connection.execute(archive_table.insert().values(
+            first_id=data[0][0], last_id=data[-1][0],
+            last_timestamp=data[-1][-1], rows=len(data),
+            data=zlib.compress(json.dumps(data))))
+        archived += len(data)
+    result.close()
+    connection.execute(table.delete().where(table.c.timestamp < before))
+    return archived
+
+
+def archive(connection, before):
+    """move the history rows older than before into the archive table
+
+    return the number of archived rows.
+    """
+    return _in_transaction(connection, _archive, before)
+
+
+def archived(connection, first_id=None):
+    """yield the archived history rows as dictionaries, oldest first
+
+    timestamps are strings, as printed by the database.  only the rows
+    from the first_id on are read, if given.
+    """
+    if not connection.engine.has_table(archive_table.name):
+        return
+    query = sa.select([archive_table.c.data]).order_by(archive_table.c.id)
+    if first_id is not None:
+        query = query.where(archive_table.c.last_id >= first_id)
+    for (data, ) in connection.execute(query):
+        for values in json.loads(zlib.decompress(data)):
+            if first_id is None or values[0] >= first_id:
+                yield dict(zip(COLUMNS, values))
+
+
+class HistoryCommandHandler(pluginmgr.CommandHandler):
+    """compact the history, and archive the rows older than arg days
+
+    ``:history-maintenance`` compacts the whole history,
+    ``:history-maintenance=365`` also archives the rows older than a
+    year.  the `history` command is the one of the search view.
+    """
+
+    command = 'history-maintenance'
+
+    def __call__(self, cmd, arg):
+        connection = db.engine.connect()
+        try:
+            collapsed = compact(connection)
+            logger.info('collapsed %d history updates' % collapsed)
+            if arg:
+                before = datetime.datetime.today() - datetime.timedelta(
+                    days=int(arg))
+                logger.info('archived %d history rows'
+                            % archive(connection, before))
+        finally:
+            connection.close()
+
+
+pluginmgr.register_command(HistoryCommandHandler)
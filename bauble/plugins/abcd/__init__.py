@@ -55,6 +55,21 @@ from bauble import prefs
 #
 
 
+_abcd_schema = None
+
+
+def abcd_schema():
+    """
+    the ABCD 2.06 schema, parsed once
+    """
+    global _abcd_schema
+    if _abcd_schema is None:
+        schema_file = os.path.join(paths.lib_dir(), 'plugins',
+                                   'abcd', 'abcd_2.06.xsd')
+        _abcd_schema = etree.XMLSchema(etree.parse(schema_file))
+    return _abcd_schema
+
+
 def validate_xml(root):
     """
     Validate root against ABCD 2.06 schema
@@ -62,11 +77,30 @@ def validate_xml(root):
     :param root: root of an XML tree to validate against
     :returns: True or False depending if root validates correctly
     """
-    schema_file = os.path.join(paths.lib_dir(), 'plugins',
-                               'abcd', 'abcd_2.06.xsd')
-    xmlschema_doc = etree.parse(schema_file)
-    abcd_schema = etree.XMLSchema(xmlschema_doc)
-    return abcd_schema.validate(root)
+    return abcd_schema().validate(root)
+
+
+def validate_file(filename):
+    """
+    Validate the ABCD file filename against ABCD 2.06 schema
+
+    the file is validated while it is parsed, and each Unit is released
+    once parsed, so that memory use does not grow with the size of the
+    file.
+
+    :param filename: the name of the file to validate
+    :returns: True or False depending if the file validates correctly
+    """
+    unit = '{%s}Unit' % namespaces['abcd']
+    try:
+        for event, element in etree.iterparse(filename, tag=unit,
+                                              schema=abcd_schema()):
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    except etree.XMLSyntaxError:
+        return False
+    return True
 
 
 # TODO: this function needs to be renamed since we now check an object in
@@ -193,14 +227,11 @@ class ABCDAdapter(object):
         pass
 
 
-def create_abcd(decorated_objects, authors=True, validate=True):
+def get_institution():
     """
-    :param objects: a list/tuple of objects that implement the ABCDDecorator
-      interface
-    :param authors: flag to control whether to include the authors in the
-      species name
-    :param validate: whether we should validate the data before returning
-    :returns: a valid ABCD ElementTree
+    :returns: the Institution, once its required fields are filled in
+
+    if they are not, the user is asked to complete them.
     """
     import bauble.plugins.garden.institution as institution
     inst = institution.Institution()
@@ -211,10 +242,17 @@ def create_abcd(decorated_objects, authors=True, validate=True):
                 'Code fields are filled in.')
         utils.message_dialog(msg)
         institution.InstitutionEditor().start()
-        return create_abcd(decorated_objects, authors, validate)
+        return get_institution()
+    return inst
 
-    datasets = DataSets()
-    ds = ABCDElement(datasets, 'DataSet')
+
+def add_dataset_header(ds, inst):
+    """
+    append to the DataSet element ds the elements preceding its Units
+
+    :param ds: a DataSet element
+    :param inst: the Institution
+    """
     tech_contacts = ABCDElement(ds, 'TechnicalContacts')
     tech_contact = ABCDElement(tech_contacts, 'TechnicalContact')
 
@@ -235,88 +273,119 @@ def create_abcd(decorated_objects, authors=True, validate=True):
     revision = ABCDElement(metadata, 'RevisionData')
     ABCDElement(revision, 'DateModified', text='2001-03-01T00:00:00')
     ABCDElement(representation, 'Title', text='TheTitle')
-    units = ABCDElement(ds, 'Units')
-
-    # build the ABCD unit
-    for obj in decorated_objects:
-        unit = ABCDElement(units, 'Unit')
-        ABCDElement(unit, 'SourceInstitutionID', text=inst.code)
-
-        # TODO: don't really understand the SourceID element
-        ABCDElement(unit, 'SourceID', text='Ghini')
 
-        ABCDElement(unit, 'UnitID', text=obj.get_UnitID())
-        ABCDElement(unit, 'DateLastEdited', text=obj.get_DateLastEdited())
 
-        # TODO: add list of verifications to Identifications
-
-        # scientific name identification
-        identifications = ABCDElement(unit, 'Identifications')
+def create_unit(obj, inst, authors=True, units=None):
+    """
+    :param obj: an object implementing the ABCDAdapter interface
+    :param inst: the Institution
+    :param authors: flag to control whether to include the authors in the
+      species name
+    :param units: the Units element to append the new Unit to, if any
+    :returns: the ABCD Unit element for obj
+    """
+    if units is None:
+        unit = Element('{%s}Unit' % namespaces['abcd'], nsmap=namespaces)
+    else:
+        unit = ABCDElement(units, 'Unit')
+    ABCDElement(unit, 'SourceInstitutionID', text=inst.code)
+
+    # TODO: don't really understand the SourceID element
+    ABCDElement(unit, 'SourceID', text='Ghini')
+
+    ABCDElement(unit, 'UnitID', text=obj.get_UnitID())
+    ABCDElement(unit, 'DateLastEdited', text=obj.get_DateLastEdited())
+
+    # TODO: add list of verifications to Identifications
+
+    # scientific name identification
+    identifications = ABCDElement(unit, 'Identifications')
+    identification = ABCDElement(identifications, 'Identification')
+    result = ABCDElement(identification, 'Result')
+    taxon_identified = ABCDElement(result, 'TaxonIdentified')
+    higher_taxa = ABCDElement(taxon_identified, 'HigherTaxa')
+    higher_taxon = ABCDElement(higher_taxa, 'HigherTaxon')
+
+    # TODO: ABCDDecorator should provide an iterator so that we can
+    # have multiple HigherTaxonName's
+    ABCDElement(higher_taxon, 'HigherTaxonName', text=obj.get_family())
+    ABCDElement(higher_taxon, 'HigherTaxonRank', text='familia')
+
+    scientific_name = ABCDElement(taxon_identified, 'ScientificName')
+    ABCDElement(scientific_name, 'FullScientificNameString',
+                text=obj.get_FullScientificNameString(authors))
+
+    name_atomised = ABCDElement(scientific_name, 'NameAtomised')
+    botanical = ABCDElement(name_atomised, 'Botanical')
+    ABCDElement(botanical, 'GenusOrMonomial',
+                text=obj.get_GenusOrMonomial())
+    ABCDElement(botanical, 'FirstEpithet', text=obj.get_FirstEpithet())
+    if obj.get_InfraspecificEpithet():
+        ABCDElement(botanical, 'InfraspecificEpithet',
+                    text=obj.get_InfraspecificEpithet())
+        ABCDElement(botanical, 'Rank',
+                    text=obj.get_InfraspecificRank())
+    if obj.get_HybridFlag():
+        ABCDElement(botanical, 'HybridFlag', text=obj.get_HybridFlag())
+    if obj.get_CultivarName():
+        ABCDElement(botanical, 'CultivarName',
+                    text=obj.get_CultivarName())
+    author_team = obj.get_AuthorTeam()
+    if author_team is not None:
+        ABCDElement(botanical, 'AuthorTeam', text=author_team)
+    if obj.get_InfraspecificEpithet():
+        ABCDElement(botanical, 'InfraspecificEpithet',
+                    text=obj.get_InfraspecificEpithet())
+        ABCDElement(botanical, 'Rank',
+                    text=obj.get_InfraspecificRank())
+    ABCDElement(identification, 'PreferredFlag', text='true')
+
+    # vernacular name identification
+    # TODO: should we include all the vernacular names or only the default
+    # one
+    vernacular_name = obj.get_InformalNameString()
+    if vernacular_name is not None:
         identification = ABCDElement(identifications, 'Identification')
         result = ABCDElement(identification, 'Result')
         taxon_identified = ABCDElement(result, 'TaxonIdentified')
-        higher_taxa = ABCDElement(taxon_identified, 'HigherTaxa')
-        higher_taxon = ABCDElement(higher_taxa, 'HigherTaxon')
-
-        # TODO: ABCDDecorator should provide an iterator so that we can
-        # have multiple HigherTaxonName's
-        ABCDElement(higher_taxon, 'HigherTaxonName', text=obj.get_family())
-        ABCDElement(higher_taxon, 'HigherTaxonRank', text='familia')
-
-        scientific_name = ABCDElement(taxon_identified, 'ScientificName')
-        ABCDElement(scientific_name, 'FullScientificNameString',
-                    text=obj.get_FullScientificNameString(authors))
-
-        name_atomised = ABCDElement(scientific_name, 'NameAtomised')
-        botanical = ABCDElement(name_atomised, 'Botanical')
-        ABCDElement(botanical, 'GenusOrMonomial',
-                    text=obj.get_GenusOrMonomial())
-        ABCDElement(botanical, 'FirstEpithet', text=obj.get_FirstEpithet())
-        if obj.get_InfraspecificEpithet():
-            ABCDElement(botanical, 'InfraspecificEpithet',
-                        text=obj.get_InfraspecificEpithet())
-            ABCDElement(botanical, 'Rank',
-                        text=obj.get_InfraspecificRank())
-        if obj.get_HybridFlag():
-            ABCDElement(botanical, 'HybridFlag', text=obj.get_HybridFlag())
-        if obj.get_CultivarName():
-            ABCDElement(botanical, 'CultivarName',
-                        text=obj.get_CultivarName())
-        author_team = obj.get_AuthorTeam()
-        if author_team is not None:
-            ABCDElement(botanical, 'AuthorTeam', text=author_team)
-        if obj.get_InfraspecificEpithet():
-            ABCDElement(botanical, 'InfraspecificEpithet',
-                        text=obj.get_InfraspecificEpithet())
-            ABCDElement(botanical, 'Rank',
-                        text=obj.get_InfraspecificRank())
-        ABCDElement(identification, 'PreferredFlag', text='true')
-
-        # vernacular name identification
-        # TODO: should we include all the vernacular names or only the default
-        # one
-        vernacular_name = obj.get_InformalNameString()
-        if vernacular_name is not None:
-            identification = ABCDElement(identifications, 'Identification')
-            result = ABCDElement(identification, 'Result')
-            taxon_identified = ABCDElement(result, 'TaxonIdentified')
-            ABCDElement(taxon_identified, 'InformalNameString',
-                        text=vernacular_name)
-        if obj.get_IdentificationQualifier():
-            ABCDElement(scientific_name, 'IdentificationQualifier', 
-                        text=obj.get_IdentificationQualifier(), 
-                        attrib={'insertionpoint': obj.get_IdentificationQualifierRank()})
-        # add all the extra non standard elements
-        obj.extra_elements(unit)
-        # TODO: handle verifiers/identifiers
-        # TODO: RecordBasis
-
-        # notes are last in the schema and extra_elements() shouldn't
-        # add anything that comes past Notes, e.g. RecordURI,
-        # EAnnotations, UnitExtension
-        notes = obj.get_Notes()
-        if notes:
-            ABCDElement(unit, 'Notes', text=notes)
+        ABCDElement(taxon_identified, 'InformalNameString',
+                    text=vernacular_name)
+    if obj.get_IdentificationQualifier():
+        ABCDElement(scientific_name, 'IdentificationQualifier', 
+                    text=obj.get_IdentificationQualifier(), 
+                    attrib={'insertionpoint': obj.get_IdentificationQualifierRank()})
+    # add all the extra non standard elements
+    obj.extra_elements(unit)
+    # TODO: handle verifiers/identifiers
+    # TODO: RecordBasis
+
+    # notes are last in the schema and extra_elements() shouldn't
+    # add anything that comes past Notes, e.g. RecordURI,
+    # EAnnotations, UnitExtension
+    notes = obj.get_Notes()
+    if notes:
+        ABCDElement(unit, 'Notes', text=notes)
+    return unit
+
+
+def create_abcd(decorated_objects, authors=True, validate=True):
+    """
+    :param objects: a list/tuple of objects that implement the ABCDDecorator
+      interface
+    :param authors: flag to control whether to include the authors in the
+      species name
+    :param validate: whether we should validate the data before returning
+    :returns: a valid ABCD ElementTree
+    """
+    inst = get_institution()
+    datasets = DataSets()
+    ds = ABCDElement(datasets, 'DataSet')
+    add_dataset_header(ds, inst)
+    units = ABCDElement(ds, 'Units')
+
+    # build the ABCD unit
+    for obj in decorated_objects:
+        create_unit(obj, inst, authors, units)
 
     if validate:
         check(validate_xml(datasets), 'ABCD data not valid')
@@ -324,6 +393,40 @@ def create_abcd(decorated_objects, authors=True, validate=True):
     return ElementTree(datasets)
 
 
+def write_abcd(decorated_objects, output, authors=True, inst=None):
+    """
+    write the same ABCD data as create_abcd, one Unit at a time
+
+    each Unit element is serialised and released as soon as it is
+    created, so that memory use does not grow with the number of units.
+
+    :param decorated_objects: an iterable of objects that implement the
+      ABCDDecorator interface
+    :param output: a filename or a file object
+    :param authors: flag to control whether to include the authors in the
+      species name
+    :param inst: the Institution, looked up if None
+    :returns: the number of units written
+    """
+    if inst is None:
+        inst = get_institution()
+    abcd = namespaces['abcd']
+    header = Element('{%s}DataSet' % abcd, nsmap=namespaces)
+    add_dataset_header(header, inst)
+    count = 0
+    with etree.xmlfile(output, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element('{%s}DataSets' % abcd, nsmap=namespaces):
+            with xf.element('{%s}DataSet' % abcd):
+                for element in header:
+                    xf.write(element)
+                with xf.element('{%s}Units' % abcd):
+                    for obj in decorated_objects:
+                        xf.write(create_unit(obj, inst, authors))
+                        count += 1
+    return count
+
+
 class ABCDExporter(object):
     """
     Export Plants to an ABCD file.
@@ -363,23 +466,25 @@ class ABCDExporter(object):
             raise ValueError("%s exists and is not a a regular file"
                              % filename)
 
-        # if plants is None then export all plants, this could be huge
-        # TODO: do something about this, like list the number of plants
-        # to be returned and make sure this is what the user wants
+        # if plants is None then export all plants, this could be huge,
+        # so they are read a batch at a time
+        session = None
         if plants is None:
-            plants = db.Session().query(Plant).all()
+            session = db.Session()
+            plants = session.query(Plant).yield_per(500)
 
         # TODO: move PlantABCDAdapter, AccessionABCDAdapter and
         # PlantABCDAdapter into the ABCD plugin
         from bauble.plugins.report.xsl import PlantABCDAdapter
-        data = create_abcd([PlantABCDAdapter(p) for p in plants],
-                           validate=False)
-
-        data.write_c14n(filename)
+        try:
+            write_abcd((PlantABCDAdapter(p) for p in plants), filename)
+        finally:
+            if session is not None:
+                session.close()
 
         # validate after the file is written so we still have some
         # output but let the user know the file isn't valid ABCD
-        if not validate_xml(data):
+        if not validate_file(filename):
             msg = _("The ABCD file was created but failed to validate "
                     "correctly against the ABCD standard.")
             if prefs.testing:
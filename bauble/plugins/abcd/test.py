@@ -123,3 +123,64 @@ class ABCDTestCase(BaubleTestCase):
 
     def validate(self, xml):
         return self.abcd_schema.validate(xml)
+
+
+class UnitAdapter(abcd.ABCDAdapter):
+    """a minimal adapter, not needing the database"""
+
+    def get_UnitID(self):
+        return u'%s' % self._object
+
+    def get_DateLastEdited(self):
+        return u'2016-01-01T00:00:00'
+
+    def get_family(self):
+        return u'Orchidaceae'
+
+    def get_GenusOrMonomial(self):
+        return u'Maxillaria'
+
+    def get_FirstEpithet(self):
+        return u'variabilis'
+
+    def get_FullScientificNameString(self, authors=True):
+        return u'Maxillaria variabilis'
+
+    def get_Notes(self):
+        return None
+
+
+class StreamingABCDTests(BaubleTestCase):
+
+    def setUp(self):
+        super(StreamingABCDTests, self).setUp()
+        from bauble.plugins.garden import Institution
+        inst = Institution()
+        inst.name = inst.code = inst.contact = \
+            inst.technical_contact = inst.email = u'test'
+        inst.write()
+
+    def test_write_abcd_same_as_create_abcd(self):
+        adapters = [UnitAdapter(i) for i in range(5)]
+        tree = abcd.create_abcd(adapters, validate=False)
+        dummy, filename = tempfile.mkstemp()
+        count = abcd.write_abcd(iter(adapters), filename)
+        self.assertEquals(count, 5)
+        written = etree.parse(filename)
+        self.assertEquals(etree.tostring(written, method='c14n'),
+                          etree.tostring(tree, method='c14n'))
+        self.assertTrue(abcd.validate_xml(written))
+        self.assertTrue(abcd.validate_file(filename))
+        os.remove(filename)
+
+    def test_validate_file(self):
+        dummy, filename = tempfile.mkstemp()
+        abcd.write_abcd(iter([UnitAdapter(i) for i in range(3)]), filename)
+        self.assertTrue(abcd.validate_file(filename))
+        # a Unit without its UnitID
+        tree = etree.parse(filename)
+        unit_id = tree.find('.//{%s}UnitID' % abcd.namespaces['abcd'])
+        unit_id.getparent().remove(unit_id)
+        tree.write(filename)
+        self.assertFalse(abcd.validate_file(filename))
+        os.remove(filename)
@@ -47,6 +47,7 @@ from bauble.plugins.garden.institution import (
 
 #from bauble.plugins.garden.propagation import *
 import bauble.search as search
+import bauble.sortkey as sortkey
 import re
 
 # other ideas:
@@ -105,13 +106,16 @@ class GardenPlugin(pluginmgr.Plugin):
 
         mapper_search.add_meta(('collection', 'col', 'coll'),
                                Collection, ['locale'])
-        coll_kids = lambda coll: sorted(coll.source.accession.plants,
-                                        key=utils.natsort_key)
+        coll_kids = partial(db.natsort, 'source.accession.plants')
         SearchView.row_meta[Collection].set(
             children=coll_kids,
             infobox=AccessionInfoBox,
             context_menu=collection_context_menu)
 
+        sortkey.register(Accession, dependents=['plants'])
+        sortkey.register(Location)
+        sortkey.register(Plant)
+
         # done here b/c the Species table is not part of this plugin
         SearchView.row_meta[Species].child = "accessions"
 
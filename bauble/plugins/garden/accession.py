@@ -39,7 +39,7 @@ from functools import partial
 from bauble.i18n import _
 import lxml.etree as etree
 import pango
-from sqlalchemy import and_, or_, func
+from sqlalchemy import and_, or_, func, distinct
 from sqlalchemy import ForeignKey, Column, Unicode, Integer, Boolean, \
     UnicodeText, Table
 from sqlalchemy.orm import EXT_CONTINUE, MapperExtension, \
@@ -554,6 +554,7 @@ class Accession(db.Base, db.Serializable, db.WithNotes):
     __tablename__ = 'accession'
     __mapper_args__ = {'order_by': 'accession.code',
                        'extension': AccessionMapperExtension()}
+    retrieve_keys = ['code']
 
     # columns
     #: the accession code
@@ -814,6 +815,35 @@ class Accession(db.Base, db.Serializable, db.WithNotes):
                 (7, 'Locations'): set([p.location.id for p in self.plants]),
                 (8, 'Sources'): set(sd and [sd.id] or [])}
 
+    @classmethod
+    def top_level_count_query(cls, session, ids):
+        """top_level_count summed over the accessions with the given ids
+
+        the database computes all figures in one query.
+        """
+        row = session.query(
+            func.count(distinct(Accession.species_id)),
+            func.count(distinct(Species.genus_id)),
+            func.count(distinct(Genus.family_id)),
+            func.count(distinct(Plant.id)),
+            func.sum(Plant.quantity),
+            func.count(distinct(Plant.location_id)),
+            func.count(distinct(Source.source_detail_id))).\
+            select_from(Accession).\
+            join(Species, Species.id == Accession.species_id).\
+            join(Genus, Genus.id == Species.genus_id).\
+            outerjoin(Plant, Plant.accession_id == Accession.id).\
+            outerjoin(Source, Source.accession_id == Accession.id).\
+            filter(db.in_ids(Accession.id, ids)).one()
+        return {(1, 'Accessions'): len(ids),
+                (2, 'Species'): row[0],
+                (3, 'Genera'): row[1],
+                (4, 'Families'): row[2],
+                (5, 'Plantings'): row[3],
+                (6, 'Living plants'): row[4] or 0,
+                (7, 'Locations'): row[5],
+                (8, 'Sources'): row[6]}
+
 
 from bauble.plugins.garden.plant import Plant, PlantEditor
 
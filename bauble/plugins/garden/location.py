@@ -28,7 +28,7 @@ import logging
 logger = logging.getLogger(__name__)
 #logger.setLevel(logging.DEBUG)
 
-from sqlalchemy import Column, Unicode, UnicodeText
+from sqlalchemy import Column, Unicode, UnicodeText, func, distinct
 from sqlalchemy.orm import relation, backref, validates
 from sqlalchemy.orm.session import object_session
 from sqlalchemy.exc import DBAPIError
@@ -107,6 +107,7 @@ class Location(db.Base, db.Serializable):
     """
     __tablename__ = 'location'
     __mapper_args__ = {'order_by': 'name'}
+    retrieve_keys = ['code']
 
     # columns
     # refers to beds by unique codes
@@ -183,6 +184,37 @@ class Location(db.Base, db.Serializable):
                                      for a in accessions
                                      if a.source and a.source.source_detail])}
 
+    @classmethod
+    def top_level_count_query(cls, session, ids):
+        """top_level_count summed over the locations with the given ids
+
+        the database computes all figures in one query.
+        """
+        from bauble.plugins.garden import Accession, Plant, Source
+        from bauble.plugins.plants import Genus, Species
+        row = session.query(
+            func.count(distinct(Plant.id)),
+            func.sum(Plant.quantity),
+            func.count(distinct(Plant.accession_id)),
+            func.count(distinct(Accession.species_id)),
+            func.count(distinct(Species.genus_id)),
+            func.count(distinct(Genus.family_id)),
+            func.count(distinct(Source.source_detail_id))).\
+            select_from(Plant).\
+            join(Accession, Accession.id == Plant.accession_id).\
+            join(Species, Species.id == Accession.species_id).\
+            join(Genus, Genus.id == Species.genus_id).\
+            outerjoin(Source, Source.accession_id == Accession.id).\
+            filter(db.in_ids(Plant.location_id, ids)).one()
+        return {(1, 'Locations'): len(ids),
+                (2, 'Plantings'): row[0],
+                (3, 'Living plants'): row[1] or 0,
+                (4, 'Accessions'): row[2],
+                (5, 'Species'): row[3],
+                (6, 'Genera'): row[4],
+                (7, 'Families'): row[5],
+                (8, 'Sources'): row[6]}
+
 
 def mergevalues(value1, value2, formatter):
     """return the common value
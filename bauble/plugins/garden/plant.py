@@ -34,7 +34,7 @@ logger = logging.getLogger(__name__)
 import gtk
 
 from bauble.i18n import _
-from sqlalchemy import and_, func
+from sqlalchemy import and_, func, distinct
 from sqlalchemy import ForeignKey, Column, Unicode, Integer, Boolean, \
     UnicodeText, UniqueConstraint
 from sqlalchemy.orm import relation, backref, object_mapper, validates
@@ -446,6 +446,7 @@ class Plant(db.Base, db.Serializable, db.DefiningPictures, db.WithNotes):
     __tablename__ = 'plant'
     __table_args__ = (UniqueConstraint('code', 'accession_id'), {})
     __mapper_args__ = {'order_by': ['plant.accession_id', 'plant.code']}
+    retrieve_keys = ['code']
 
     # columns
     code = Column(Unicode(6), nullable=False)
@@ -613,6 +614,38 @@ class Plant(db.Base, db.Serializable, db.DefiningPictures, db.WithNotes):
                 (8, 'Sources'): set(sd and [sd.id] or []),
                 }
 
+    @classmethod
+    def top_level_count_query(cls, session, ids):
+        """top_level_count summed over the plants with the given ids
+
+        the database computes all figures in one query.
+        """
+        from bauble.plugins.garden.source import Source
+        from bauble.plugins.plants.genus import Genus
+        row = session.query(
+            func.count(distinct(Plant.accession_id)),
+            func.count(distinct(Accession.species_id)),
+            func.count(distinct(Species.genus_id)),
+            func.count(distinct(Genus.family_id)),
+            func.sum(Plant.quantity),
+            func.count(distinct(Plant.location_id)),
+            func.count(distinct(Source.source_detail_id))).\
+            select_from(Plant).\
+            join(Accession, Accession.id == Plant.accession_id).\
+            join(Species, Species.id == Accession.species_id).\
+            join(Genus, Genus.id == Species.genus_id).\
+            outerjoin(Source, Source.accession_id == Accession.id).\
+            filter(db.in_ids(Plant.id, ids)).one()
+        return {(1, 'Plantings'): len(ids),
+                (2, 'Accessions'): row[0],
+                (3, 'Species'): row[1],
+                (4, 'Genera'): row[2],
+                (5, 'Families'): row[3],
+                (6, 'Living plants'): row[4] or 0,
+                (7, 'Locations'): row[5],
+                (8, 'Sources'): row[6],
+                }
+
 
 from bauble.plugins.garden.accession import Accession
 
@@ -34,7 +34,8 @@ from sqlalchemy.orm import object_session
 
 #import bauble
 import bauble.db as db
-from bauble.test import BaubleTestCase, update_gui, check_dupids
+from bauble.test import (BaubleTestCase, StatementCounter, update_gui,
+                         check_dupids)
 import bauble.utils as utils
 from bauble.plugins.garden.accession import Accession, AccessionEditor, \
     AccessionNote, Voucher, SourcePresenter, Verification, dms_to_decimal, \
@@ -2060,3 +2061,54 @@ class GlobalFunctionsTests(GardenTestCase):
     def test_mergevalues_both_empty(self):
         'if both are empty, return the empty string'
         self.assertEquals(mergevalues(None, None, '%s|%s'), '')
+
+
+class TopLevelCountTests(GardenTestCase):
+
+    def setUp(self):
+        super(TopLevelCountTests, self).setUp()
+        setUp_data()
+        acc = self.session.query(Accession).get(2)
+        acc.source = Source(source_detail=SourceDetail(name=u'Kew'))
+        self.session.add(Plant(accession=acc, code=u'3', quantity=4,
+                               location=self.session.query(Location).get(2)))
+        self.session.commit()
+
+    def merged(self, klass, ids):
+        'the sum of the per-object top_level_count values'
+        d = {}
+        for item in self.session.query(klass).filter(klass.id.in_(ids)):
+            for k, v in item.top_level_count().items():
+                if isinstance(v, set):
+                    d[k] = v.union(d.get(k, set()))
+                else:
+                    d[k] = v + d.get(k, 0)
+        return dict((k, len(v) if isinstance(v, set) else v)
+                    for k, v in d.items())
+
+    def test_query_matches_top_level_count(self):
+        from bauble.view import top_level_count
+        for klass in (Family, Genus, Species, Accession, Plant, Location):
+            ids = [i for (i, ) in self.session.query(klass.id)]
+            self.assertEquals(top_level_count(self.session, klass, ids),
+                              self.merged(klass, ids), klass)
+            self.assertEquals(top_level_count(self.session, klass, ids[:1]),
+                              self.merged(klass, ids[:1]), klass)
+
+    def test_query_is_one_statement(self):
+        from bauble.view import top_level_count
+        for klass in (Family, Genus, Species, Accession, Plant, Location):
+            ids = [i for (i, ) in self.session.query(klass.id)]
+            with StatementCounter() as statements:
+                top_level_count(self.session, klass, ids)
+            self.assertEquals(len(statements), 1, klass)
+
+    def test_many_ids(self):
+        'more ids than a statement can bind still make one query'
+        from bauble.view import top_level_count
+        ids = [i for (i, ) in self.session.query(Plant.id)]
+        many = ids + range(1000, 1000 + db.IN_CHUNK_SIZE)
+        result = top_level_count(self.session, Plant, many)
+        expected = self.merged(Plant, ids)
+        expected[(1, 'Plantings')] = len(many)
+        self.assertEquals(result, expected)
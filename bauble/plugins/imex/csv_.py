@@ -26,7 +26,10 @@
 
 import os
 import csv
+import gzip
+import time
 import traceback
+from cStringIO import StringIO
 
 import logging
 logger = logging.getLogger(__name__)
@@ -124,6 +127,118 @@ class UnicodeWriter(object):
             self.writerow(row)
 
 
+def open_csv(filename, mode='rb'):
+    """open filename, compressing or decompressing if it ends in .gz
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def count_lines(filename, blocksize=1 << 16):
+    """the number of lines in filename, read one block at a time
+    """
+    lines = 0
+    last = '\n'
+    f = open_csv(filename)
+    try:
+        for block in iter(lambda: f.read(blocksize), ''):
+            lines += block.count('\n')
+            last = block[-1]
+    finally:
+        f.close()
+    if last != '\n':
+        # the last line has no line terminator
+        lines += 1
+    return lines
+
+
+def column_converter(column, default=None, processor=None):
+    """return a function turning a csv field into the value for column
+
+    an empty field becomes default, `True` and `False` are booleans in
+    a Boolean column, anything else is utf-8 text.  processor, if
+    given, is applied to the result.
+    """
+    booleans = {}
+    if isinstance(column.type, Boolean):
+        # need bool value, not 'True' or 'False' string
+        booleans = {'True': True, 'False': False}
+
+    def convert(text):
+        if text == '':
+            return default
+        if text in booleans:
+            return booleans[text]
+        return unicode(text, 'utf-8')
+
+    if processor is None:
+        return convert
+    return lambda text: processor(convert(text))
+
+
+def row_converter(table, fields, defaults, dialect=None):
+    """return the names of the columns to insert in table, and a
+    function making the list of their values out of a csv line
+
+    fields is the csv header, defaults maps column names to the values
+    of empty or missing fields.  the per column work is decided here,
+    once per table.  pass dialect to have the values processed by the
+    column types, as needed when bypassing them, like COPY does.
+    """
+    width = len(fields)
+    names = []
+    converters = []
+    for name in table.c.keys():
+        if name in fields:
+            index = fields.index(name)
+        elif name in defaults:
+            # the padding field, always empty
+            index = width
+        else:
+            continue
+        column = table.c[name]
+        processor = dialect and column.type.bind_processor(dialect)
+        names.append(name)
+        converters.append((index, column_converter(
+            column, defaults.get(name), processor)))
+
+    def convert(line):
+        line.extend([''] * (width + 1 - len(line)))
+        return [function(line[index]) for index, function in converters]
+
+    return names, convert
+
+
+def _copy_text(value):
+    if value is None:
+        return '\\N'
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def copy_rows(connection, table, names, rows):
+    """insert rows in table by the PostgreSQL `COPY` command
+
+    rows are lists of processed values, in the order of names.
+    """
+    data = StringIO()
+    writer = csv.writer(data, quotechar=QUOTE_CHAR, quoting=QUOTE_STYLE,
+                        lineterminator='\n')
+    for row in rows:
+        writer.writerow([_copy_text(v) for v in row])
+    data.seek(0)
+    quote = connection.dialect.identifier_preparer.quote
+    statement = "COPY %s (%s) FROM STDIN WITH CSV NULL '\\N'" % (
+        quote(table.name), ', '.join(quote(n) for n in names))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(statement, data)
+    finally:
+        cursor.close()
+
+
 class Importer(object):
 
     def start(self, **kwargs):
@@ -149,15 +264,21 @@ class CSVImporter(Importer):
     import order, each file being imported will completely replace any
     existing data in the corresponding table.
 
-    The CSVImporter imports the rows of the CSV file in chunks rather than
-    one row at a time.  The non-server side column defaults are determined
-    before the INSERT statement is generated instead of getting new defaults
-    for each row.  This shouldn't be a problem but it also means that your
-    column default should change depending on the value of previously
-    inserted rows.
+    The CSVImporter imports the rows of the CSV file in batches of
+    `batch_size` rows rather than one row at a time, by executemany, or
+    by COPY on PostgreSQL.  The tables are dropped, created and filled
+    in one transaction, a failed import leaves them as they were.  The
+    non-server side column defaults are determined before the INSERT
+    statement is generated instead of getting new defaults for each
+    row.  This shouldn't be a problem but it also means that your column
+    default should change depending on the value of previously inserted
+    rows.
 
     """
 
+    ## rows per executemany or COPY, also how often the GUI is updated
+    batch_size = 5000
+
     def __init__(self):
         super(CSVImporter, self).__init__()
         self.__error = False   # flag to indicate error on import
@@ -192,7 +313,7 @@ class CSVImporter(Importer):
         foreign_key column and child is usually the column that the
         foreign key points to, e.g ('parent_id', 'id')
         """
-        f = open(filename, 'rb')
+        f = open_csv(filename)
         reader = UnicodeReader(f, quotechar=QUOTE_CHAR,
                                quoting=QUOTE_STYLE)
 
@@ -223,6 +344,8 @@ class CSVImporter(Importer):
         import tempfile
         tmppath = tempfile.mkdtemp()
         head, tail = os.path.split(filename)
+        if tail.endswith('.gz'):
+            tail = tail[:-3]
         filename = os.path.join(tmppath, tail)
         tmpfile = open(filename, 'wb')
         tmpfile.write('%s\n' % ','.join(fields))
@@ -247,6 +370,8 @@ class CSVImporter(Importer):
         '''
         transaction = None
         connection = None
+        isolation_level = False  # not changed
+        synchronous = None
         self.__error_exc = BaubleError(_('Unknown Error.'))
 
         try:
@@ -254,7 +379,22 @@ class CSVImporter(Importer):
             # method called it inside a transaction then we can pick
             # up the parent connection and the transaction
             connection = metadata.bind.connect()
+            if connection.engine.name == 'sqlite':
+                # pysqlite commits before each DROP and CREATE: begin
+                # the transaction ourselves, so that the tables are
+                # dropped and created in the same transaction as their
+                # rows, and restored if the import fails.
+                dbapi_connection = connection.connection.connection
+                isolation_level = dbapi_connection.isolation_level
+                dbapi_connection.isolation_level = None
+                # the transaction is committed once, at the end; we can
+                # skip waiting for each write to reach the disk
+                synchronous = connection.execute(
+                    'PRAGMA synchronous').scalar()
+                connection.execute('PRAGMA synchronous=OFF')
             transaction = connection.begin()
+            if isolation_level is not False:
+                connection.execute('BEGIN')
         except Exception, e:
             msg = _('Error connecting to database.\n\n%s') % \
                 utils.xml_safe(e)
@@ -265,6 +405,8 @@ class CSVImporter(Importer):
         filename_dict = {}
         for f in filenames:
             path, base = os.path.split(f)
+            if base.endswith('.gz'):
+                base = base[:-3]
             table_name, ext = os.path.splitext(base)
             if table_name in filename_dict:
                 safe = utils.xml_safe
@@ -297,7 +439,7 @@ class CSVImporter(Importer):
         filesizes = {}
         for filename in filenames:
             #get the total number of lines for all the files
-            nlines = len(open(filename).readlines())
+            nlines = count_lines(filename)
             filesizes[filename] = nlines
             total_lines += nlines
 
@@ -309,8 +451,6 @@ class CSVImporter(Importer):
                 created_tables.append(table.name)
 
         steps_so_far = 0
-        cleaned = None
-        insert = None
         depends = set()  # the type will be changed to a [] later
         try:
             ## get all the dependencies
@@ -338,41 +478,25 @@ class CSVImporter(Importer):
                     metadata.drop_all(bind=connection, tables=depends)
                 else:
                     # user doesn't want to drop dependencies so we just quit
+                    transaction.rollback()
                     return
 
-            # commit the dependency drops
-            transaction.commit()
-            transaction = connection.begin()
-
-            # update_every determines how many rows we will insert at
-            # a time and consequently how often we update the gui
-            update_every = 127
-
-            # import the tables one at a time, breaking every so often
-            # so the GUI can update
-            from bauble.db import registered_tables
+            # prepare the tables one at a time, the data comes later;
+            # the drops, the creates and the data are all in the same
+            # transaction
+            to_import = []
             for table, filename in reversed(sorted_tables):
                 if self.__cancel or self.__error:
                     break
-                klass = registered_tables.get(table.name)
-                klassname = klass and klass.__name__ or table.name
-                msg = _('importing %(table)s table from %(filename)s') \
-                    % {'table': klassname,
-                       'filename': filename}
-                #log.info(msg)
-                bauble.task.set_message(msg)
-                yield  # allow progress bar update
 
                 # don't do anything if the file is empty:
                 if filesizes[filename] <= 1:
-                    if not table.exists():
+                    if not table.exists(bind=connection):
                         create_table(table)
                     continue
                 # check if the table was in the depends because they
-                # could have been dropped whereas table.exists() can
-                # return true for a dropped table if the transaction
-                # hasn't been committed
-                if table in depends or not table.exists():
+                # could have been dropped
+                if table in depends or not table.exists(bind=connection):
                     logger.info('%s does not exist. creating.' % table.name)
                     logger.debug('%s does not exist. creating.' % table.name)
                     create_table(table)
@@ -396,32 +520,39 @@ class CSVImporter(Importer):
                         table.drop(bind=connection)
                         create_table(table)
 
-                if self.__cancel or self.__error:
-                    break
+                to_import.append((table, filename))
 
-                # commit the drop of the table we're importing
-                transaction.commit()
-                transaction = connection.begin()
+            use_copy = connection.engine.name == 'postgresql'
+            started = time.time()
+            imported = 0
 
-                # open a temporary reader to get the column keys so we
-                # can later precompile our insert statement
-                f = open(filename, "rb")
-                tmp = UnicodeReader(f, quotechar=QUOTE_CHAR,
-                                    quoting=QUOTE_STYLE)
-                tmp.next()
-                csv_columns = set(tmp.reader.fieldnames)
-                del tmp
-                f.close()
+            # import the tables one at a time, breaking every so often
+            # so the GUI can update
+            from bauble.db import registered_tables
+            for table, filename in to_import:
+                if self.__cancel or self.__error:
+                    break
+                klass = registered_tables.get(table.name)
+                klassname = klass and klass.__name__ or table.name
+                msg = _('importing %(table)s table from %(filename)s') \
+                    % {'table': klassname,
+                       'filename': filename}
+                #log.info(msg)
+                bauble.task.set_message(msg)
+                yield  # allow progress bar update
 
                 # precompute the defaults...this assumes that the
                 # default function doesn't depend on state after each
                 # row...it shouldn't anyways since we do an insert
-                # many instead of each row at a time
+                # many instead of each row at a time.  the defaults are
+                # executed on our connection, since returning another
+                # one to the pool would roll back our transaction on
+                # SQLite, where they share the same DBAPI connection.
                 defaults = {}
                 for column in table.c:
                     if isinstance(column.default, ColumnDefault):
-                        defaults[column.name] = column.default.execute()
-                column_names = table.c.keys()
+                        defaults[column.name] = connection.execute(
+                            column.default)
 
                 # check if there are any foreign keys to on the table
                 # that refer to itself, if so create a new file with
@@ -435,28 +566,29 @@ class CSVImporter(Importer):
                                     self_keys)
                     filename = self._toposort_file(filename, key_pairs)
 
-                # the column keys for the insert are a union of the
-                # columns in the CSV file and the columns with
-                # defaults
-                column_keys = list(csv_columns.union(defaults.keys()))
+                f = open_csv(filename)
+                reader = csv.reader(f, quotechar=QUOTE_CHAR,
+                                    quoting=QUOTE_STYLE)
+                fields = reader.next()
+                names, convert = row_converter(
+                    table, fields, defaults,
+                    use_copy and connection.dialect or None)
                 insert = table.insert(bind=connection).\
-                    compile(column_keys=column_keys)
+                    compile(column_keys=names)
 
                 values = []
 
                 def do_insert():
-                    if values:
-                        connection.execute(insert, *values)
+                    if values and use_copy:
+                        copy_rows(connection, table, names, values)
+                    elif values:
+                        connection.execute(
+                            insert, [dict(zip(names, v)) for v in values])
                     del values[:]
                     percent = float(steps_so_far)/float(total_lines)
                     if 0 < percent < 1.0:
                         pb_set_fraction(percent)
 
-                isempty = lambda v: v in ('', None)
-
-                f = open(filename, "rb")
-                reader = UnicodeReader(f, quotechar=QUOTE_CHAR,
-                                       quoting=QUOTE_STYLE)
                 # NOTE: we shouldn't get this far if the file doesn't
                 # have any rows to import but if so there is a chance
                 # that this loop could cause problems
@@ -465,50 +597,21 @@ class CSVImporter(Importer):
                         yield
                     if self.__cancel or self.__error:
                         break
-
-                    # fill in default values and None for "empty"
-                    # columns in line
-                    for column in table.c.keys():
-                        if column in defaults \
-                                and (column not in line
-                                     or isempty(line[column])):
-                            line[column] = defaults[column]
-                        elif column in line and isempty(line[column]):
-                            line[column] = None
-                        elif column in line and line[column] == 'False' and \
-                                isinstance(table.c[column].type, Boolean):
-                            # need bool value, not 'False' string
-                            line[column] = False
-                        elif column in line and line[column] == 'True' and \
-                                isinstance(table.c[column].type, Boolean):
-                            # need bool value, not 'True' string
-                            line[column] = True
-                            # in SA 0.5.5 and only on an SQLite
-                            # database the 'False' will import as True
-                            # for some reason whereas True will import
-                            # as True automatically...probably because
-                            # bool('False') == True
-                    values.append(line)
+                    values.append(convert(line))
                     steps_so_far += 1
-                    if steps_so_far % update_every == 0:
+                    if len(values) == self.batch_size:
+                        imported += len(values)
                         do_insert()
                         yield
+                f.close()
 
                 if self.__error or self.__cancel:
                     break
 
-                # insert the remainder that were less than update every
+                # insert the remainder that were less than a batch
+                imported += len(values)
                 do_insert()
 
-                # we have commit after create after each table is imported
-                # or Postgres will complain if two tables that are
-                # being imported have a foreign key relationship
-                transaction.commit()
-                logger.debug('%s: %s' % (
-                    table.name,
-                    table.select().alias().count().execute().fetchone()[0]))
-                transaction = connection.begin()
-
             logger.debug('creating: %s' % ', '.join([d.name for d in depends]))
             # TODO: need to get those tables from depends that need to
             # be created but weren't created already
@@ -525,6 +628,20 @@ class CSVImporter(Importer):
             raise
         else:
             transaction.commit()
+            elapsed = max(time.time() - started, 0.001)
+            msg = _('imported %(rows)s rows in %(seconds).1f seconds, '
+                    '%(rate)d rows per second') % {
+                'rows': imported, 'seconds': elapsed,
+                'rate': imported / elapsed}
+            logger.info(msg)
+            bauble.task.set_message(msg)
+            for table, filename in to_import:
+                db.notify_change(table.name, 'insert')
+        finally:
+            if synchronous is not None:
+                connection.execute('PRAGMA synchronous=%d' % synchronous)
+            if isolation_level is not False:
+                dbapi_connection.isolation_level = isolation_level
 
         # unfortunately inserting an explicit value into a column that
         # has a sequence doesn't update the sequence, we shortcut this
@@ -577,6 +694,22 @@ class CSVImporter(Importer):
 
 
 class CSVExporter(object):
+    """exports the database tables to comma separated value files
+
+    rows are fetched from a streaming cursor, `batch_size` at a time,
+    and written as they come, so that memory use does not depend on the
+    size of the tables.  with compress, files are gzipped.  with
+    parallel larger than 1, that many tables are exported at the same
+    time, each on its own connection.
+    """
+
+    ## rows fetched from the cursor at a time
+    batch_size = 1000
+
+    def __init__(self, compress=False, parallel=1):
+        super(CSVExporter, self).__init__()
+        self.compress = compress
+        self.parallel = parallel
 
     def start(self, path=None):
         if path is None:
@@ -600,8 +733,40 @@ class CSVExporter(object):
         except Exception, e:
             logger.debug(e)
 
+    def export_table(self, table, filename, bind=None):
+        """write table to filename, one batch of rows at a time
+
+        a generator, yielding after each batch.
+        """
+        connection = (bind or db.engine).connect()
+        f = open_csv(filename, 'wb')
+        try:
+            writer = UnicodeWriter(f, quotechar=QUOTE_CHAR,
+                                   quoting=QUOTE_STYLE)
+            writer.writerow(table.c.keys())  # the column names
+            result = connection.execution_options(stream_results=True).\
+                execute(table.select())
+            while True:
+                rows = result.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                yield
+            result.close()
+        finally:
+            f.close()
+            connection.close()
+
+    def _export_whole_table(self, args):
+        table, filename = args
+        for step in self.export_table(table, filename):
+            pass
+        return table
+
     def __export_task(self, path):
         filename_template = os.path.join(path, "%s.txt")
+        if self.compress:
+            filename_template += '.gz'
         steps_so_far = 0
         ntables = 0
         for table in db.metadata.sorted_tables:
@@ -615,21 +780,26 @@ class CSVExporter(object):
                 if utils.yes_no_dialog(msg):
                     return
 
-        def replace(s):
-            if isinstance(s, (str, unicode)):
-                s.replace('\n', '\\n')
-            return s
-
-        def write_csv(filename, rows):
-            f = open(filename, 'wb')
-            writer = UnicodeWriter(f, quotechar=QUOTE_CHAR,
-                                   quoting=QUOTE_STYLE)
-            writer.writerows(rows)
-            f.close()
+        tables = [(table, filename_template % table.name)
+                  for table in db.metadata.sorted_tables]
+        if self.parallel > 1 and db.engine.name != 'sqlite':
+            # sqlite connections do not read concurrently, and an
+            # in-memory database is private to its connection
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(self.parallel)
+            try:
+                for table in pool.imap_unordered(self._export_whole_table,
+                                                 tables):
+                    steps_so_far += 1
+                    pb_set_fraction(float(steps_so_far)/float(ntables))
+                    bauble.task.set_message(
+                        _('exported %(table)s table') % {'table': table.name})
+                    yield
+            finally:
+                pool.terminate()
+            return
 
-        update_every = 30
-        for table in db.metadata.sorted_tables:
-            filename = filename_template % table.name
+        for table, filename in tables:
             steps_so_far += 1
             fraction = float(steps_so_far)/float(ntables)
             pb_set_fraction(fraction)
@@ -637,27 +807,8 @@ class CSVExporter(object):
                 % {'table': table.name, 'filename': filename}
             bauble.task.set_message(msg)
             logger.info("exporting %s" % table.name)
-
-            # get the data
-            results = table.select().execute().fetchall()
-
-            # create empty files with only the column names
-            if len(results) == 0:
-                write_csv(filename, [table.c.keys()])
+            for step in self.export_table(table, filename):
                 yield
-                continue
-
-            rows = []
-            rows.append(table.c.keys())  # append col names
-            ctr = 0
-            for row in results:
-                values = map(replace, row.values())
-                rows.append(values)
-                if ctr == update_every:
-                    yield
-                    ctr = 0
-                ctr += 1
-            write_csv(filename, rows)
 
 
 class CSVImportCommandHandler(pluginmgr.CommandHandler):
@@ -17,8 +17,13 @@
 # You should have received a copy of the GNU General Public License
 # along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
 
+import copy
 import os
+import time
+
 import gtk
+from sqlalchemy import select
+from sqlalchemy.orm import Query, joinedload
 
 import logging
 logger = logging.getLogger(__name__)
@@ -38,6 +43,29 @@ import bauble.pluginmgr as pluginmgr
 from bauble import pb_set_fraction
 
 
+## the relations as_dict reads, loaded with the objects; only many-to-one
+## relations, which can be eagerly loaded by yield_per queries.
+_as_dict_options = {
+    Genus: lambda: [joinedload('family')],
+    Species: lambda: [joinedload('genus')],
+    VernacularName: lambda: [joinedload('species').joinedload('genus')],
+    Accession: lambda: [joinedload('species').joinedload('genus')],
+    AccessionNote: lambda: [joinedload('accession')],
+    Plant: lambda: [joinedload('accession'), joinedload('location')],
+    PlantNote: lambda: [joinedload('plant').joinedload('accession')],
+    }
+
+
+def read_objects(filename):
+    """return the list of the objects in the JSON, or JSON Lines, file
+    """
+    with open(filename) as f:
+        if filename.endswith('.jsonl'):
+            return [json.loads(line) for line in f if line.strip()]
+        obj = json.load(f)
+    return isinstance(obj, list) and obj or [obj]
+
+
 def serializedatetime(obj):
     """Default JSON serializer."""
     import calendar
@@ -75,28 +103,40 @@ class JSONExporter(editor.GenericEditorPresenter):
 
     view_accept_buttons = ['sed-button-ok', 'sed-button-cancel', ]
 
+    # objects read per query round trip
+    batch_size = 1000
+
     def __init__(self, view):
         self.selection_based_on = 'sbo_selection'
         self.export_includes = 'ei_referred'
         self.include_private = True
         self.filename = ''
+        # one object per line, also implied by a .jsonl filename
+        self.json_lines = False
         super(JSONExporter, self).__init__(
             model=self, view=view, refresh_view=True)
 
     def get_objects(self):
-        '''return the list of objects to be exported
+        '''return the objects to be exported
 
-        if "based_on" is "selection", return the top level selection only.
+        if "based_on" is "selection", return the top level selection only,
+        or, if nothing is selected, all objects of the exported classes.
 
-        if "based_on" is something else, return all that is needed to create
-        a complete export.
+        if "based_on" is something else, return a list of queries, one per
+        class, yielding all that is needed to create a complete export.
         '''
         if self.selection_based_on == 'sbo_selection':
             if self.include_private:
                 logger.info('exporting selection overrides `include_private`')
-            return self.view.get_selection()
-
-        ## export disregarding selection
+            selection = self.view.get_selection()
+            if selection is not None:
+                return selection
+            return [self.session.query(cls) for cls in (
+                Familia, Genus, Species, VernacularName, Accession, Plant,
+                Location)]
+
+        ## export disregarding selection; related objects are selected
+        ## by subqueries, not by lists of ids
         result = []
         if self.selection_based_on == 'sbo_plants':
             plant_query = self.session.query(
@@ -105,61 +145,75 @@ class JSONExporter(editor.GenericEditorPresenter):
             if self.include_private is False:
                 plant_query = plant_query.filter(
                     Accession.private == False)  # `is` does not work
-            plants = plant_query.all()
+            plant_ids = plant_query.with_entities(Plant.id).subquery()
             plantnotes = self.session.query(PlantNote).filter(
-                PlantNote.plant_id.in_([j.id for j in plants])).all()
+                PlantNote.plant_id.in_(select([plant_ids.c.id])))
             ## only used locations and accessions
             locations = self.session.query(Location).filter(
-                Location.id.in_([j.location_id for j in plants])).all()
+                Location.id.in_(plant_query.with_entities(
+                    Plant.location_id).order_by(None).subquery()))
             accessions = self.session.query(Accession).filter(
-                Accession.id.in_([j.accession_id for j in plants])).order_by(
-                Accession.code).all()
-            ## notes are linked in opposite direction
-            accessionnotes = self.session.query(AccessionNote).filter(
-                AccessionNote.accession_id.in_(
-                    [j.id for j in accessions])).all()
+                Accession.id.in_(plant_query.with_entities(
+                    Plant.accession_id).order_by(None).subquery())).order_by(
+                Accession.code)
             # extend results with things not further used
-            result.extend(locations)
-            result.extend(plants)
-            result.extend(plantnotes)
+            result.extend([locations, plant_query, plantnotes])
         elif self.selection_based_on == 'sbo_accessions':
             accessions = self.session.query(Accession).order_by(
-                Accession.code).all()
+                Accession.code)
             if self.include_private is False:
-                accessions = [j for j in accessions if j.private is False]
-            accessionnotes = self.session.query(AccessionNote).filter(
-                AccessionNote.accession_id.in_(
-                    [j.id for j in accessions])).all()
+                accessions = accessions.filter(Accession.private == False)
 
         ## now the taxonomy, based either on all species or on the ones used
         if self.selection_based_on == 'sbo_taxa':
-            species = self.session.query(Species).order_by(
-                Species.epithet).all()
+            species = self.session.query(Species).order_by(Species.epithet)
         else:
+            ## notes are linked in opposite direction
+            accession_ids = accessions.with_entities(
+                Accession.id).order_by(None).subquery()
+            accessionnotes = self.session.query(AccessionNote).filter(
+                AccessionNote.accession_id.in_(
+                    select([accession_ids.c.id])))
             # prepend results with accession data
-            result = accessions + accessionnotes + result
+            result = [accessions, accessionnotes] + result
 
             species = self.session.query(Species).filter(
-                Species.id.in_([j.species_id for j in accessions])).order_by(
-                Species.epithet).all()
+                Species.id.in_(accessions.with_entities(
+                    Accession.species_id).order_by(None).subquery())).order_by(
+                Species.epithet)
 
+        species_ids = species.with_entities(
+            Species.id).order_by(None).subquery()
         vernacular = self.session.query(VernacularName).filter(
-            VernacularName.species_id.in_([j.id for j in species])).all()
+            VernacularName.species_id.in_(select([species_ids.c.id])))
 
         ## and all used genera and families
         genera = self.session.query(Genus).filter(
-            Genus.id.in_([j.genus_id for j in species])).order_by(
-            Genus.epithet).all()
+            Genus.id.in_(species.with_entities(
+                Species.genus_id).order_by(None).subquery())).order_by(
+            Genus.epithet)
         families = self.session.query(Familia).filter(
-            Familia.id.in_([j.family_id for j in genera])).order_by(
-            Familia.epithet).all()
+            Familia.id.in_(genera.with_entities(
+                Genus.family_id).order_by(None).subquery())).order_by(
+            Familia.epithet)
 
         ## prepend the result with the taxonomic information
-        result = families + genera + species + vernacular + result
+        result = [families, genera, species, vernacular] + result
 
         ## done, return the result
         return result
 
+    def iter_objects(self, queries):
+        """yield the objects of queries, batch_size at a time
+
+        the objects come with the related objects as_dict reads.
+        """
+        for query in queries:
+            cls = query.column_descriptions[0]['type']
+            options = _as_dict_options.get(cls, lambda: [])()
+            for obj in query.options(*options).yield_per(self.batch_size):
+                yield obj
+
     def on_btnbrowse_clicked(self, button):
         self.view.run_file_chooser_dialog(
             _("Choose a file..."), None,
@@ -185,19 +239,11 @@ class JSONExporter(editor.GenericEditorPresenter):
                              % filename)
 
         objects = self.get_objects()
-        # if objects is None then export all objects under classes Familia,
-        # Genus, Species, Accession, Plant, Location.
-        if objects is None:
-            s = db.Session()
-            objects = s.query(Familia).all()
-            objects.extend(s.query(Genus).all())
-            objects.extend(s.query(Species).all())
-            objects.extend(s.query(VernacularName).all())
-            objects.extend(s.query(Accession).all())
-            objects.extend(s.query(Plant).all())
-            objects.extend(s.query(Location).all())
-
-        count = len(objects)
+        if objects and isinstance(objects[0], Query):
+            count = sum(query.order_by(None).count() for query in objects)
+            objects = self.iter_objects(objects)
+        else:
+            count = len(objects)
         if count > 3000:
             msg = _('You are exporting %(nplants)s objects to JSON format.  '
                     'Exporting this many objects may take several minutes.  '
@@ -206,14 +252,30 @@ class JSONExporter(editor.GenericEditorPresenter):
             if not self.view.run_yes_no_dialog(msg):
                 return
 
+        json_lines = self.json_lines or filename.endswith('.jsonl')
+        if json_lines:
+            start, separator, end = '', '\n', '\n'
+        else:
+            start, separator, end = '[', ',\n ', ']'
+        started = time.time()
+        written = 0
         import codecs
         with codecs.open(filename, "wb", "utf-8") as output:
-            output.write('[')
-            output.write(',\n '.join(
-                [json.dumps(obj.as_dict(),
-                            default=serializedatetime, sort_keys=True)
-                 for obj in objects]))
-            output.write(']')
+            output.write(start)
+            for obj in objects:
+                if written:
+                    output.write(separator)
+                output.write(json.dumps(obj.as_dict(),
+                                        default=serializedatetime,
+                                        sort_keys=True))
+                written += 1
+            output.write(end)
+        elapsed = max(time.time() - started, 0.001)
+        logger.info('exported %(objects)s objects in %(seconds).1f seconds, '
+                    '%(rate)d objects per second' % {
+                        'objects': written, 'seconds': elapsed,
+                        'rate': written / elapsed})
+        return written
 
 
 class JSONImporter(editor.GenericEditorPresenter):
@@ -232,6 +294,11 @@ class JSONImporter(editor.GenericEditorPresenter):
 
     view_accept_buttons = ['sid-button-ok', 'sid-button-cancel', ]
 
+    # objects imported per commit
+    batch_size = 1000
+    # False for bulk restores, which need no history of their own
+    record_history = True
+
     def __init__(self, view):
         self.filename = ''
         self.update = True
@@ -254,28 +321,60 @@ class JSONImporter(editor.GenericEditorPresenter):
         JSONImporter.last_folder, bn = os.path.split(filename)
 
     def on_btnok_clicked(self, widget):
-        obj = json.load(open(self.filename))
-        a = isinstance(obj, list) and obj or [obj]
-        bauble.task.queue(self.run(a))
+        bauble.task.queue(self.run(read_objects(self.filename)))
 
     def on_btncancel_clicked(self, widget):
         pass
 
     def run(self, objects):
         ## generator function. will be run as a task.
+
+        ## objects are committed batch_size at a time, looking them up
+        ## in the database once per run.  if anything in a batch fails,
+        ## the batch is rolled back and its objects are imported again,
+        ## one per commit, so that only the bad ones are lost.  this is
+        ## safe, since objects are retrieved before being created.
         session = db.Session()
+        session.expire_on_commit = False
+        db.memoise_lookups(session)
+        db.record_history(session, self.record_history)
         n = len(objects)
-        for i, obj in enumerate(objects):
+        started = time.time()
+        for start in range(0, n, self.batch_size):
+            batch = objects[start:start + self.batch_size]
             try:
-                db.construct_from_dict(session, obj, self.create, self.update)
+                for i, obj in enumerate(batch, start):
+                    # construct_from_dict consumes its dictionary
+                    db.construct_from_dict(session, copy.deepcopy(obj),
+                                           self.create, self.update)
+                    pb_set_fraction(float(i) / n)
+                    yield
                 session.commit()
+                continue
             except Exception as e:
                 session.rollback()
-                logger.warning("could not import %s (%s: %s)" %
-                               (obj, type(e).__name__, e.args))
-            pb_set_fraction(float(i) / n)
-            yield
-        session.commit()
+                db.forget_rolled_back(session)
+                logger.info("importing objects %d to %d one by one (%s: %s)" %
+                            (start, start + len(batch) - 1,
+                             type(e).__name__, e.args))
+            for i, obj in enumerate(batch, start):
+                try:
+                    db.construct_from_dict(session, obj,
+                                           self.create, self.update)
+                    session.commit()
+                except Exception as e:
+                    session.rollback()
+                    db.forget_rolled_back(session)
+                    logger.warning("could not import %s (%s: %s)" %
+                                   (obj, type(e).__name__, e.args))
+                pb_set_fraction(float(i) / n)
+                yield
+        session.close()
+        elapsed = max(time.time() - started, 0.001)
+        logger.info('imported %(objects)s objects in %(seconds).1f seconds, '
+                    '%(rate)d objects per second' % {
+                        'objects': n, 'seconds': elapsed,
+                        'rate': n / elapsed})
 
 
 #
@@ -26,7 +26,7 @@ import os
 import shutil
 import tempfile
 
-from sqlalchemy import Column, Integer, Boolean
+from sqlalchemy import Column, Integer, Boolean, event, orm
 
 import bauble.db as db
 from bauble.plugins.plants import (
@@ -35,9 +35,9 @@ from bauble.plugins.garden import Accession, Location, Plant
 import bauble.plugins.garden.test as garden_test
 import bauble.plugins.plants.test as plants_test
 from bauble.plugins.imex.csv_ import CSVImporter, CSVExporter, QUOTE_CHAR, \
-    QUOTE_STYLE
+    QUOTE_STYLE, count_lines, row_converter
 from bauble.plugins.imex.iojson import JSONImporter, JSONExporter
-from bauble.test import BaubleTestCase
+from bauble.test import BaubleTestCase, StatementCounter
 import json
 from bauble.editor import MockView
 
@@ -310,6 +310,67 @@ class CSVTests(ImexTestCase):
         row = reader.next()
         self.assert_(row['cv_group'] == '')
 
+    def test_import_tables_together(self):
+        importer = TestImporter()
+        importer.start([os.path.join(self.path, '%s.txt' % name)
+                        for name in ('family', 'genus', 'species')],
+                       force=True)
+        self.assertEquals(self.session.query(Family).count(),
+                          len(family_data))
+        self.assertEquals(self.session.query(Genus).count(), len(genus_data))
+        self.assertEquals(self.session.query(Species).count(),
+                          len(species_data))
+
+    def test_count_lines(self):
+        filename = os.path.join(self.path, 'lines.txt')
+        for content, expect in (('', 0), ('a\nb\n', 2), ('a\nb', 2)):
+            f = open(filename, 'wb')
+            f.write(content)
+            f.close()
+            self.assertEquals(count_lines(filename, blocksize=3), expect)
+
+    def test_row_converter(self):
+        table = Family.__table__
+        names, convert = row_converter(
+            table, ['epithet', 'id', 'unknown'], {'aggregate': u''})
+        self.assertEquals(sorted(names), ['aggregate', 'epithet', 'id'])
+        values = dict(zip(names, convert(['Moraceae', '3', 'x'])))
+        self.assertEquals(values, {'id': u'3', 'epithet': u'Moraceae',
+                                   'aggregate': u''})
+        values = dict(zip(names, convert(['', '4'])))
+        self.assertEquals(values, {'id': u'4', 'epithet': None,
+                                   'aggregate': u''})
+
+    def test_import_in_batches(self):
+        filename = os.path.join(self.path, 'family.txt')
+        f = open(filename, 'wb')
+        f.write('id,epithet\n')
+        for i in range(12):
+            f.write('%d,Family%d\n' % (i + 1, i))
+        f.close()
+        importer = TestImporter()
+        importer.batch_size = 5
+        counter = StatementCounter()
+        with counter:
+            importer.start([filename], force=True)
+        inserts = [len(parameters) for statement, parameters
+                   in zip(counter.statements, counter.parameters)
+                   if statement.startswith('INSERT INTO family')]
+        self.assertEquals(inserts, [5, 5, 2])
+        self.assertEquals(self.session.query(Family).count(), 12)
+
+    def test_failed_import_keeps_tables(self):
+        filename = os.path.join(self.path, 'family.txt')
+        f = open(filename, 'wb')
+        f.write('id,epithet\n1,Family1\n1,Family2\n')
+        f.close()
+        importer = TestImporter()
+        self.assertRaises(Exception, importer.start, [filename], force=True)
+        self.session.close()
+        self.assertEquals(self.session.query(Family).count(),
+                          len(family_data))
+        self.assertEquals(self.session.query(Genus).count(), len(genus_data))
+
 
 class CSVTests2(ImexTestCase):
 
@@ -406,6 +467,34 @@ class CSVTests2(ImexTestCase):
         # the test export string
         pass
 
+    def test_export_table_in_batches(self):
+        tempdir = tempfile.mkdtemp()
+        filename = os.path.join(tempdir, 'genus.txt')
+        exporter = CSVExporter()
+        exporter.batch_size = 2
+        steps = list(exporter.export_table(Genus.__table__, filename))
+        genera = [g.epithet for g in self.session.query(Genus)]
+        self.assertEquals(len(steps), (len(genera) + 1) / 2)
+        rows = list(csv.DictReader(open(filename, 'rb')))
+        self.assertEquals([r['epithet'] for r in rows], genera)
+        shutil.rmtree(tempdir)
+
+    def test_export_gzip_import(self):
+        tempdir = tempfile.mkdtemp()
+        genera = sorted(g.epithet for g in self.session.query(Genus))
+        exporter = CSVExporter(compress=True)
+        exporter.start(tempdir)
+        filenames = os.listdir(tempdir)
+        self.assertTrue('family.txt.gz' in filenames)
+        self.assertFalse('family.txt' in filenames)
+        importer = CSVImporter()
+        importer.start([os.path.join(tempdir, name) for name in filenames],
+                       force=True)
+        self.session.expire_all()
+        self.assertEquals(sorted(g.epithet for g in
+                                 self.session.query(Genus)), genera)
+        shutil.rmtree(tempdir)
+
 
 class MockExportView:
     def widget_set_value(self, *args):
@@ -689,6 +778,31 @@ class JSONExportTests(BaubleTestCase):
         self.assertEquals(len(vern_from_json), 1)
         self.assertEquals(vern_from_json[0]['language'], 'es')
 
+    def test_export_json_lines(self):
+        from bauble.plugins.imex.iojson import read_objects
+        exporter = JSONExporter(MockView())
+        exporter.view.selection = None
+        exporter.include_private = True
+        exporter.filename = self.temp_path + '.jsonl'
+        self.assertEquals(exporter.run(), 11)
+        lines = open(exporter.filename).read().splitlines()
+        self.assertEquals(len(lines), 11)
+        self.assertEquals(read_objects(exporter.filename),
+                          [json.loads(line) for line in lines])
+        os.remove(exporter.filename)
+
+    def test_export_loads_related_objects_with_the_objects(self):
+        exporter = JSONExporter(MockView())
+        exporter.selection_based_on = 'sbo_plants'
+        queries = exporter.get_objects()
+        plants = queries[-2]
+        self.assertEquals(plants.column_descriptions[0]['type'], Plant)
+        exporter.session.expunge_all()
+        objects = self.assertMaxStatements(
+            1, list, exporter.iter_objects([plants]))
+        Plant.get_delimiter()  # a setting, read once
+        self.assertMaxStatements(0, lambda: [o.as_dict() for o in objects])
+
     def test_on_btnbrowse_clicked(self):
         view = MockView()
         exporter = JSONExporter(view)
@@ -1033,6 +1147,114 @@ class JSONImportTests(BaubleTestCase):
         self.assertEquals(anacampseros.__class__, Genus)
         self.assertEquals(anacampseros.author, u'')
 
+    def test_import_bad_object_does_not_abort_batch(self):
+        json_string = '[{"rank": "Genus", "epithet": "Neogyna", '\
+            '"ht-rank": "Familia", "ht-epithet": "Orchidaceae"}, '\
+            '{"rank": "Genus", "ht-epithet": "Orchidaceae"}, '\
+            '{"rank": "Genus", "epithet": "Sedum", '\
+            '"ht-rank": "Familia", "ht-epithet": "Crassulaceae"}]'
+        with open(self.temp_path, "w") as f:
+            f.write(json_string)
+        importer = JSONImporter(MockImportView())
+        importer.batch_size = 2
+        importer.filename = self.temp_path
+        importer.on_btnok_clicked(None)
+        self.assertEquals(sorted(g.epithet for g in self.session.query(
+            Genus).filter(Genus.epithet.in_([u'Neogyna', u'Sedum']))),
+            [u'Neogyna', u'Sedum'])
+
+    def test_import_update_kept_when_batch_fails(self):
+        ataceae = Family(epithet=u'Anacampserotaceae')
+        linnaeus = Genus(family=ataceae, epithet=u'Anacampseros')
+        self.session.add_all([ataceae, linnaeus])
+        self.session.commit()
+        json_string = '[{"author": "L.", "epithet": "Anacampseros", '\
+            '"ht-rank": "Familia", "ht-epithet": "Anacampserotaceae", '\
+            '"object": "taxon", "rank": "genus"}, '\
+            '{"rank": "Genus", "ht-epithet": "Orchidaceae"}]'
+        with open(self.temp_path, "w") as f:
+            f.write(json_string)
+        importer = JSONImporter(MockImportView())
+        importer.batch_size = 2
+        importer.filename = self.temp_path
+        importer.create = True
+        importer.update = True
+        importer.on_btnok_clicked(None)
+        self.session.expire_all()
+        self.assertEquals(linnaeus.author, u'L.')
+
+    def test_import_looks_up_genus_once(self):
+        json_string = '[%s]' % ', '.join(
+            '{"rank": "Species", "epithet": "%s", '
+            '"ht-rank": "Genus", "ht-epithet": "Aerides", '
+            '"familia": "Orchidaceae"}' % epithet
+            for epithet in ('lawrenceae', 'odorata', 'rosea'))
+        with open(self.temp_path, "w") as f:
+            f.write(json_string)
+        importer = JSONImporter(MockImportView())
+        importer.filename = self.temp_path
+        with StatementCounter() as statements:
+            importer.on_btnok_clicked(None)
+        self.assertEquals(len(self.session.query(Species).join(Genus).filter(
+            Genus.epithet == u'Aerides').all()), 3)
+        genus_lookups = [s for s in statements
+                         if 'FROM genus \nWHERE genus.epithet' in s]
+        self.assertEquals(len(genus_lookups), 1)
+
+    def test_import_flushes_once_per_batch(self):
+        epithets = ('lawrenceae', 'odorata', 'rosea', 'falcata', 'crassifolia',
+                    'multiflora')
+        json_string = '[%s]' % ', '.join(
+            '{"rank": "Species", "epithet": "%s", '
+            '"ht-rank": "Genus", "ht-epithet": "Aerides", '
+            '"familia": "Orchidaceae"}' % epithet for epithet in epithets)
+        with open(self.temp_path, "w") as f:
+            f.write(json_string)
+        importer = JSONImporter(MockImportView())
+        importer.filename = self.temp_path
+        flushes = []
+        listener = lambda session, context: flushes.append(session)
+        event.listen(orm.Session, 'after_flush', listener)
+        try:
+            with StatementCounter() as statements:
+                importer.on_btnok_clicked(None)
+        finally:
+            event.remove(orm.Session, 'after_flush', listener)
+        self.assertEquals(len(flushes), 1)
+        self.assertEquals(len([s for s in statements
+                               if s.startswith('INSERT INTO species')]), 6)
+        self.assertEquals(sorted(e for (e, ) in self.session.query(
+            Species.epithet).join(Genus).filter(Genus.epithet == u'Aerides')),
+            sorted(epithets))
+
+    def test_import_pending_object_found(self):
+        json_string = '[{"rank": "Genus", "epithet": "Aerides", '\
+            '"ht-rank": "Familia", "ht-epithet": "Orchidaceae"}, '\
+            '{"rank": "Genus", "epithet": "Aerides", "author": "Lour.", '\
+            '"ht-rank": "Familia", "ht-epithet": "Orchidaceae"}]'
+        with open(self.temp_path, "w") as f:
+            f.write(json_string)
+        importer = JSONImporter(MockImportView())
+        importer.filename = self.temp_path
+        importer.on_btnok_clicked(None)
+        genera = self.session.query(Genus).filter(
+            Genus.epithet == u'Aerides').all()
+        self.assertEquals([g.author for g in genera], [u'Lour.'])
+
+    def test_import_without_history(self):
+        json_string = ('[{"rank": "Genus", "epithet": "Aerides", '
+                       '"ht-rank": "Familia", "ht-epithet": "Orchidaceae"}]')
+        with open(self.temp_path, "w") as f:
+            f.write(json_string)
+        base_count = self.session.query(db.History).count()
+        importer = JSONImporter(MockImportView())
+        importer.filename = self.temp_path
+        importer.record_history = False
+        importer.on_btnok_clicked(None)
+        self.assertEquals(self.session.query(Genus).filter(
+            Genus.epithet == u'Aerides').count(), 1)
+        self.assertEquals(self.session.query(db.History).count(), base_count)
+
     def test_on_btnbrowse_clicked(self):
         view = MockView()
         exporter = JSONImporter(view)
@@ -66,6 +66,8 @@ from taxonomy_check import (
 from stored_queries import (
     StoredQueryEditorTool)
 import bauble.search as search
+import bauble.sortkey as sortkey
+import statistics
 from bauble.view import SearchView
 from bauble.ui import DefaultView
 from bauble import utils
@@ -78,17 +80,18 @@ from threading import Thread
 from gobject import idle_add
 
 
-class LabelUpdater(Thread):
-    def __init__(self, widget, query, *args, **kwargs):
-        super(LabelUpdater, self).__init__(*args, **kwargs)
-        self.query = query
-        self.widget = widget
+class StatisticsUpdater(Thread):
+    def __init__(self, widgets, garden=True, *args, **kwargs):
+        super(StatisticsUpdater, self).__init__(*args, **kwargs)
+        self.widgets = widgets
+        self.garden = garden
+
+    def set_labels(self, numbers):
+        for name, value in numbers.items():
+            getattr(self.widgets, 'splash_' + name).set_text(str(value))
 
     def run(self):
-        ssn = db.Session()
-        value, = ssn.execute(self.query).first()
-        idle_add(lambda x: self.widget.set_text(str(x)), value)
-        ssn.close()
+        idle_add(self.set_labels, statistics.get(garden=self.garden))
 
 
 class SplashInfoBox(pluginmgr.View):
@@ -213,95 +216,10 @@ class SplashInfoBox(pluginmgr.View):
 
         self.name_tooltip_query = name_tooltip_query
 
-        # LabelUpdater objects **can** run in a thread.
-        if 'GardenPlugin' in pluginmgr.plugins:
-            self.start_thread(
-                LabelUpdater(self.widgets.splash_nplttot,
-                             "select count(*) from plant"))
-            self.start_thread(
-                LabelUpdater(self.widgets.splash_npltuse,
-                             "select count(*) from plant where quantity>0"))
-            self.start_thread(
-                LabelUpdater(self.widgets.splash_npltnot,
-                             "select count(*) from plant where quantity=0"))
-            self.start_thread(
-                LabelUpdater(self.widgets.splash_nacctot,
-                             "select count(*) from accession"))
-            self.start_thread(
-                LabelUpdater(self.widgets.splash_naccuse,
-                             "select count(distinct accession.id) "
-                             "from accession "
-                             "join plant on plant.accession_id=accession.id "
-                             "where plant.quantity>0"))
-            self.start_thread(
-                LabelUpdater(self.widgets.splash_naccnot,
-                             "select count(id) "
-                             "from accession "
-                             "where id not in "
-                             "(select accession_id from plant "
-                             " where plant.quantity>0)"))
-            self.start_thread(
-                LabelUpdater(self.widgets.splash_nloctot,
-                             "select count(*) from location"))
-            self.start_thread(
-                LabelUpdater(self.widgets.splash_nlocuse,
-                             "select count(distinct location.id) "
-                             "from location "
-                             "join plant on plant.location_id=location.id "
-                             "where plant.quantity>0"))
-            self.start_thread(
-                LabelUpdater(self.widgets.splash_nlocnot,
-                             "select count(id) "
-                             "from location "
-                             "where id not in "
-                             "(select location_id from plant "
-                             " where plant.quantity>0)"))
-
-        self.start_thread(
-            LabelUpdater(self.widgets.splash_nspcuse,
-                         "select count(distinct species.id) "
-                         "from species join accession "
-                         "on accession.species_id=species.id"))
-        self.start_thread(
-            LabelUpdater(self.widgets.splash_ngenuse,
-                         "select count(distinct species.genus_id) "
-                         "from species join accession "
-                         "on accession.species_id=species.id"))
-        self.start_thread(
-            LabelUpdater(self.widgets.splash_nfamuse,
-                         "select count(distinct genus.family_id) from genus "
-                         "join species on species.genus_id=genus.id "
-                         "join accession on accession.species_id=species.id "))
-        self.start_thread(
-            LabelUpdater(self.widgets.splash_nspctot,
-                         "select count(*) from species"))
-        self.start_thread(
-            LabelUpdater(self.widgets.splash_ngentot,
-                         "select count(*) from genus"))
-        self.start_thread(
-            LabelUpdater(self.widgets.splash_nfamtot,
-                         "select count(*) from family"))
-        self.start_thread(
-            LabelUpdater(self.widgets.splash_nspcnot,
-                         "select count(id) from species "
-                         "where id not in "
-                         "(select distinct species.id "
-                         " from species join accession "
-                         " on accession.species_id=species.id)"))
-        self.start_thread(
-            LabelUpdater(self.widgets.splash_ngennot,
-                         "select count(id) from genus "
-                         "where id not in "
-                         "(select distinct species.genus_id "
-                         " from species join accession "
-                         " on accession.species_id=species.id)"))
-        self.start_thread(
-            LabelUpdater(self.widgets.splash_nfamnot,
-                         "select count(id) from family "
-                         "where id not in "
-                         "(select distinct genus.family_id from genus "
-                         "join species on species.genus_id=genus.id "
-                         "join accession on accession.species_id=species.id)"))
+        # the statistics are computed in a thread, the labels are set
+        # in the main loop.
+        self.start_thread(StatisticsUpdater(
+            self.widgets, garden='GardenPlugin' in pluginmgr.plugins))
 
     def on_sqb_clicked(self, btn_no, *args):
         try:
@@ -357,6 +275,10 @@ class PlantsPlugin(pluginmgr.Plugin):
         mapper_search.add_meta(('geography', 'geo'), Geography, ['name'])
         SearchView.row_meta[Geography].set(children=get_species_in_geography)
 
+        sortkey.register(Family)
+        sortkey.register(Genus, dependents=['species'])
+        sortkey.register(Species)
+
         ## now it's the turn of the DefaultView
         logger.debug('PlantsPlugin::init, registering splash info box')
         DefaultView.infoboxclass = SplashInfoBox
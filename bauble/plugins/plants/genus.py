@@ -33,7 +33,7 @@ logger = logging.getLogger(__name__)
 
 from sqlalchemy import (
     Column, Unicode, Integer, ForeignKey, UnicodeText, String,
-    UniqueConstraint, func, and_)
+    UniqueConstraint, func, and_, distinct)
 from sqlalchemy.orm import relation, backref, validates
 from sqlalchemy.orm.session import object_session
 from sqlalchemy.exc import DBAPIError
@@ -135,6 +135,7 @@ class Genus(db.Base, db.Serializable, db.WithNotes):
 
     rank = 'genus'
     link_keys = ['accepted']
+    retrieve_keys = ['epithet']
 
     # columns - common for all taxa
     epithet = Column(Unicode(64), nullable=False, index=True)
@@ -304,6 +305,36 @@ class Genus(db.Base, db.Serializable, db.WithNotes):
                                      for a in accessions
                                      if a.source and a.source.source_detail])}
 
+    @classmethod
+    def top_level_count_query(cls, session, ids):
+        """top_level_count summed over the genera with the given ids
+
+        the database computes all figures in one query.
+        """
+        from bauble.plugins.garden import Accession, Plant, Source
+        row = session.query(
+            func.count(distinct(Genus.family_id)),
+            func.count(distinct(Species.id)),
+            func.count(distinct(Accession.id)),
+            func.count(distinct(Plant.id)),
+            func.sum(Plant.quantity),
+            func.count(distinct(Plant.location_id)),
+            func.count(distinct(Source.source_detail_id))).\
+            select_from(Genus).\
+            outerjoin(Species, Species.genus_id == Genus.id).\
+            outerjoin(Accession, Accession.species_id == Species.id).\
+            outerjoin(Plant, Plant.accession_id == Accession.id).\
+            outerjoin(Source, Source.accession_id == Accession.id).\
+            filter(db.in_ids(Genus.id, ids)).one()
+        return {(1, 'Genera'): len(ids),
+                (2, 'Families'): row[0],
+                (3, 'Species'): row[1],
+                (4, 'Accessions'): row[2],
+                (5, 'Plantings'): row[3],
+                (6, 'Living plants'): row[4] or 0,
+                (7, 'Locations'): row[5],
+                (8, 'Sources'): row[6]}
+
 
 class GenusNote(db.Base):
     """
@@ -168,6 +168,28 @@ class SynonymSearch(search.SearchStrategy):
                 results.extend([syn.species for syn in q])
         return results
 
+    def search_pairs(self, text, session):
+        """like search, returning the (class, id) pairs of the accepted names
+
+        neither the matching objects nor the accepted ones are loaded.
+        """
+        from genus import Genus, GenusSynonym
+        if not prefs[self.return_synonyms_pref]:
+            return []
+        mapper_search = search.get_strategy('MapperSearch')
+        ids = {}
+        for cls, id in mapper_search.search_pairs(text, session):
+            ids.setdefault(cls, []).append(id)
+        results = []
+        for cls, synonym, accepted in (
+                (Species, SpeciesSynonym, SpeciesSynonym.species_id),
+                (Genus, GenusSynonym, GenusSynonym.genus_id)):
+            if cls in ids:
+                q = session.query(accepted).filter(
+                    db.in_ids(synonym.synonym_id, ids[cls]))
+                results.extend((cls, i) for (i, ) in q)
+        return results
+
 
 #
 # Species infobox for SearchView
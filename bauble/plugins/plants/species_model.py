@@ -29,7 +29,7 @@ from sqlalchemy.ext.associationproxy import association_proxy
 from functools import reduce
 from sqlalchemy import (
     Column, Unicode, Integer, ForeignKey, UnicodeText, func, UniqueConstraint,
-    Table)
+    Table, distinct)
 from sqlalchemy.orm import relation, backref
 import bauble.db as db
 import bauble.error as error
@@ -127,6 +127,7 @@ class Species(db.Base, db.Serializable, db.DefiningPictures, db.WithNotes):
 
     rank = 'species'
     link_keys = ['accepted']
+    retrieve_keys = ['epithet']
 
     # columns
     epithet = Column(Unicode(64), nullable=True, index=True)  # allows for `sp`
@@ -633,6 +634,37 @@ class Species(db.Base, db.Serializable, db.DefiningPictures, db.WithNotes):
                 (8, 'Sources'): set([a.source.source_detail.id
                                      for a in self.accessions
                                      if a.source and a.source.source_detail])}
+
+    @classmethod
+    def top_level_count_query(cls, session, ids):
+        """top_level_count summed over the species with the given ids
+
+        the database computes all figures in one query.
+        """
+        from bauble.plugins.plants.genus import Genus
+        from bauble.plugins.garden import Accession, Plant, Source
+        row = session.query(
+            func.count(distinct(Species.genus_id)),
+            func.count(distinct(Genus.family_id)),
+            func.count(distinct(Accession.id)),
+            func.count(distinct(Plant.id)),
+            func.sum(Plant.quantity),
+            func.count(distinct(Plant.location_id)),
+            func.count(distinct(Source.source_detail_id))).\
+            select_from(Species).\
+            join(Genus, Genus.id == Species.genus_id).\
+            outerjoin(Accession, Accession.species_id == Species.id).\
+            outerjoin(Plant, Plant.accession_id == Accession.id).\
+            outerjoin(Source, Source.accession_id == Accession.id).\
+            filter(db.in_ids(Species.id, ids)).one()
+        return {(1, 'Species'): len(ids),
+                (2, 'Genera'): row[0],
+                (3, 'Families'): row[1],
+                (4, 'Accessions'): row[2],
+                (5, 'Plantings'): row[3],
+                (6, 'Living plants'): row[4] or 0,
+                (7, 'Locations'): row[5],
+                (8, 'Sources'): row[6]}
 hybrid_parent_role = (
     ('?', 'not specified'),
     ('m', 'pollen donor'),
@@ -763,6 +795,9 @@ class VernacularName(db.Base, db.Serializable):
         else:
             return ''
 
+    ## loaded together with the names found by a value search
+    replacement_relation = 'species'
+
     def replacement(self):
         'user wants the species, not just the name'
         return self.species
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+"""
+Statistics of the collection, as shown in the splash screen.
+
+:func:`get` returns the numbers of families, genera, species,
+accessions, plants and locations: in total, in use and not in use.
+They are computed by two grouped queries, on one connection.
+
+The numbers can also be stored in the `splash_stats` table, which is
+optional, added and filled by the `splashstats` command.  As long as it
+exists, at each flush the totals follow the objects inserted and
+deleted, and the numbers of objects in use depending on the changed
+tables are cleared, to be computed again and stored by the next
+:func:`get`.  All the numbers of a table are cleared when it is created
+or dropped, as the CSV importer does.  Rows otherwise inserted bypassing
+the ORM are counted at the next `splashstats` command.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+import bauble.db as db
+import bauble.pluginmgr as pluginmgr
+import bauble.utils as utils
+
+## table name -> the name of the number of its rows
+TOTALS = {'family': 'nfamtot', 'genus': 'ngentot', 'species': 'nspctot',
+          'accession': 'nacctot', 'plant': 'nplttot', 'location': 'nloctot'}
+
+## number of objects in use -> names of the tables it depends on
+IN_USE = {'nfamuse': ('family', 'genus', 'species', 'accession'),
+          'ngenuse': ('genus', 'species', 'accession'),
+          'nspcuse': ('species', 'accession'),
+          'naccuse': ('accession', 'plant'),
+          'npltuse': ('plant', ),
+          'nlocuse': ('location', 'plant')}
+
+## number of objects not in use -> the total and the number in use
+NOT_IN_USE = {'nfamnot': ('nfamtot', 'nfamuse'),
+              'ngennot': ('ngentot', 'ngenuse'),
+              'nspcnot': ('nspctot', 'nspcuse'),
+              'naccnot': ('nacctot', 'naccuse'),
+              'npltnot': ('nplttot', 'npltuse'),
+              'nlocnot': ('nloctot', 'nlocuse')}
+
+TAXA = ('nfamtot', 'ngentot', 'nspctot', 'nfamuse', 'ngenuse', 'nspcuse')
+TAXA_QUERY = '''\
+SELECT (SELECT count(*) FROM family), (SELECT count(*) FROM genus),
+       (SELECT count(*) FROM species), count(DISTINCT genus.family_id),
+       count(DISTINCT species.genus_id), count(DISTINCT species.id)
+FROM accession
+JOIN species ON accession.species_id = species.id
+JOIN genus ON species.genus_id = genus.id'''
+
+GARDEN = ('nacctot', 'nloctot', 'nplttot', 'npltuse', 'naccuse', 'nlocuse')
+GARDEN_QUERY = '''\
+SELECT (SELECT count(*) FROM accession), (SELECT count(*) FROM location),
+       count(*), count(CASE WHEN quantity > 0 THEN 1 END),
+       count(DISTINCT CASE WHEN quantity > 0 THEN accession_id END),
+       count(DISTINCT CASE WHEN quantity > 0 THEN location_id END)
+FROM plant'''
+
+table = sa.Table('splash_stats', sa.MetaData(),
+                 sa.Column('name', sa.String(16), primary_key=True),
+                 sa.Column('value', sa.Integer))
+
+## whether the table exists, per engine; see persisted.
+_persisted = False
+_persisted_engine = None
+
+
+def _forget(target, connection, **kwargs):
+    """the database was created again, the stored numbers are wrong
+    """
+    global _persisted_engine
+    table.drop(bind=connection, checkfirst=True)
+    _persisted_engine = None
+
+
+sa.event.listen(db.metadata, 'after_create', _forget)
+
+
+def persisted(engine=None):
+    """return whether the statistics are stored in the database
+
+    the result is cached per engine, and refreshed by build() and drop().
+    """
+    global _persisted, _persisted_engine
+    engine = engine or db.engine
+    if engine is not _persisted_engine:
+        _persisted = engine.has_table(table.name)
+        _persisted_engine = engine
+    return _persisted
+
+
+def compute(connection, garden=True):
+    """return the dictionary of the numbers of objects, from the database
+
+    only the taxa are counted unless garden.
+    """
+    result = dict(zip(TAXA, connection.execute(TAXA_QUERY).first()))
+    if garden:
+        result.update(zip(GARDEN, connection.execute(GARDEN_QUERY).first()))
+    return result
+
+
+def _complete(numbers):
+    for name, (total, in_use) in NOT_IN_USE.items():
+        if total in numbers:
+            numbers[name] = numbers[total] - numbers[in_use]
+    return numbers
+
+
+def _store(connection, numbers):
+    connection.execute(table.delete().where(table.c.name.in_(numbers)))
+    connection.execute(table.insert(), [
+        {'name': name, 'value': value} for name, value in numbers.items()])
+
+
+def get(engine=None, garden=True):
+    """return the dictionary of the numbers shown in the splash screen
+
+    keys are the suffixes of the `splash_n...` labels; the numbers of
+    accessions, plants and locations are only there if garden.  stored
+    numbers are used when available, the others are computed, and
+    stored if the statistics are persisted.
+    """
+    engine = engine or db.engine
+    connection = engine.connect()
+    try:
+        if not persisted(engine):
+            return _complete(compute(connection, garden))
+        numbers = dict(connection.execute(
+            sa.select([table.c.name, table.c.value])).fetchall())
+        needed = TAXA + (garden and GARDEN or ())
+        if None in [numbers.get(name) for name in needed]:
+            computed = compute(connection, garden)
+            transaction = connection.begin()
+            try:
+                _store(connection, computed)
+            except Exception, e:
+                logger.warning('statistics.get(): %s' % utils.utf8(e))
+                transaction.rollback()
+            else:
+                transaction.commit()
+            numbers.update(computed)
+        return _complete(dict((name, numbers[name]) for name in needed))
+    finally:
+        connection.close()
+
+
+def _table_name(obj):
+    mapped = getattr(type(obj), '__table__', None)
+    return mapped is not None and mapped.name or None
+
+
+def _after_flush(session, flush_context):
+    connection = session.connection()
+    if not persisted(connection.engine):
+        return
+    deltas = {}
+    changed = set(_table_name(obj) for obj in session.dirty)
+    for delta, objects in ((1, session.new), (-1, session.deleted)):
+        for obj in objects:
+            name = _table_name(obj)
+            changed.add(name)
+            if name in TOTALS:
+                deltas[TOTALS[name]] = deltas.get(TOTALS[name], 0) + delta
+    if deltas:
+        connection.execute(
+            table.update().where(table.c.name == sa.bindparam('_name')).
+            values(value=table.c.value + sa.bindparam('_delta')),
+            [{'_name': k, '_delta': v} for k, v in deltas.items()])
+    _clear(connection, changed)
+
+
+def _clear(connection, changed, totals=False):
+    """clear the numbers depending on the changed tables
+
+    the numbers in use only, unless totals.
+    """
+    stale = [number for number, tables in IN_USE.items()
+             if changed.intersection(tables)]
+    if totals:
+        stale.extend(TOTALS[name] for name in changed if name in TOTALS)
+    if stale:
+        connection.execute(table.update().where(table.c.name.in_(stale)).
+                           values(value=None))
+
+
+def _replaced(target, connection, **kwargs):
+    """a counted table was created or dropped, by the CSV importer or a
+    restore, which bypass the ORM: none of its numbers is right.
+    """
+    if target.name in TOTALS and persisted(connection.engine):
+        _clear(connection, set([target.name]), totals=True)
+
+
+sa.event.listen(orm.Session, 'after_flush', _after_flush)
+sa.event.listen(sa.Table, 'after_create', _replaced)
+sa.event.listen(sa.Table, 'after_drop', _replaced)
+
+
+def drop(engine=None):
+    """remove the stored statistics from the database
+    """
+    global _persisted_engine
+    engine = engine or db.engine
+    try:
+        table.drop(bind=engine, checkfirst=True)
+    finally:
+        _persisted_engine = None
+
+
+def build(engine=None, garden=True):
+    """add the statistics table to the database, and fill it
+
+    return the dictionary of the stored numbers.
+    """
+    global _persisted_engine
+    engine = engine or db.engine
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        table.create(bind=connection, checkfirst=True)
+        numbers = compute(connection, garden)
+        _store(connection, numbers)
+    except Exception, e:
+        logger.warning('statistics.build(): %s' % utils.utf8(e))
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    finally:
+        connection.close()
+        _persisted_engine = None
+    return numbers
+
+
+class StatisticsCommandHandler(pluginmgr.CommandHandler):
+
+    command = 'splashstats'
+
+    def __call__(self, cmd, arg):
+        if arg == 'drop':
+            drop()
+        else:
+            build(garden='GardenPlugin' in pluginmgr.plugins)
+
+
+pluginmgr.register_command(StatisticsCommandHandler)
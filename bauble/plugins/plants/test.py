@@ -39,6 +39,7 @@ from bauble.plugins.plants.family import (
 from bauble.plugins.plants.genus import \
     Genus, GenusSynonym, GenusEditor, GenusNote
 from bauble.plugins.plants.geography import Geography, get_species_in_geography
+import bauble.plugins.plants.statistics as statistics
 from bauble.test import BaubleTestCase, check_dupids, mockfunc
 
 from functools import partial
@@ -1856,3 +1857,78 @@ class GlobalFunctionsTest(PlantTestCase):
     def test_vernname_get_kids(self):
         vName = self.session.query(VernacularName).filter_by(id=1).one()
         self.assertEquals(partial(db.natsort, 'species.accessions')(vName), [])
+
+
+class StatisticsTests(BaubleTestCase):
+
+    def setUp(self):
+        super(StatisticsTests, self).setUp()
+        from bauble.plugins.garden import Accession, Location, Plant
+        self.Plant = Plant
+        family = Family(epithet=u'Moraceae')
+        used = Genus(family=family, epithet=u'Ficus')
+        unused = Genus(family=family, epithet=u'Morus')
+        species = Species(genus=used, epithet=u'carica')
+        Species(genus=used, epithet=u'benjamina')
+        self.location = Location(code=u'GH')
+        self.accession = Accession(species=species, code=u'2016.0001')
+        self.plants = [Plant(accession=self.accession, code=unicode(i),
+                             quantity=i, location=self.location)
+                       for i in (0, 1, 2)]
+        self.session.add_all([family, unused])
+        self.session.commit()
+
+    def tearDown(self):
+        statistics.drop()
+        super(StatisticsTests, self).tearDown()
+
+    expected = {'nfamtot': 1, 'nfamuse': 1, 'nfamnot': 0,
+                'ngentot': 2, 'ngenuse': 1, 'ngennot': 1,
+                'nspctot': 2, 'nspcuse': 1, 'nspcnot': 1,
+                'nacctot': 1, 'naccuse': 1, 'naccnot': 0,
+                'nplttot': 3, 'npltuse': 2, 'npltnot': 1,
+                'nloctot': 1, 'nlocuse': 1, 'nlocnot': 0}
+
+    def test_get(self):
+        numbers = self.assertMaxStatements(2, statistics.get)
+        self.assertEquals(numbers, self.expected)
+
+    def test_get_taxa(self):
+        numbers = statistics.get(garden=False)
+        self.assertEquals(sorted(numbers),
+                          sorted(i for i in self.expected
+                                 if i[1:4] in ('fam', 'gen', 'spc')))
+
+    def test_build(self):
+        self.assertFalse(statistics.persisted())
+        statistics.build()
+        self.assertTrue(statistics.persisted())
+        numbers = self.assertMaxStatements(1, statistics.get)
+        self.assertEquals(numbers, self.expected)
+
+    def test_stored_numbers_follow_changes(self):
+        statistics.build()
+        self.session.add(self.Plant(accession=self.accession, code=u'3',
+                                    quantity=0, location=self.location))
+        self.session.delete(self.plants[1])
+        self.session.commit()
+        expected = dict(self.expected)
+        expected.update({'npltuse': 1, 'npltnot': 2})
+        self.assertEquals(statistics.get(), expected)
+        self.assertEquals(self.assertMaxStatements(1, statistics.get),
+                          expected)
+
+    def test_stored_numbers_cleared_on_replaced_table(self):
+        statistics.build()
+        # like the CSV importer does, bypassing the ORM
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        self.Plant.__table__.drop(bind=connection)
+        self.Plant.__table__.create(bind=connection)
+        transaction.commit()
+        connection.close()
+        expected = dict(self.expected)
+        expected.update({'nplttot': 0, 'npltuse': 0, 'npltnot': 0,
+                         'naccuse': 0, 'naccnot': 1,
+                         'nlocuse': 0, 'nlocnot': 1})
+        self.assertEquals(statistics.get(), expected)
@@ -32,9 +32,11 @@ logger = logging.getLogger(__name__)
 import gtk
 import gobject
 
-from sqlalchemy import union
+from sqlalchemy import and_
+from sqlalchemy.orm import Load, object_session
 
 import bauble
+import bauble.db as db
 from bauble.i18n import _
 from bauble.error import BaubleError
 import bauble.utils as utils
@@ -43,7 +45,7 @@ from bauble.prefs import prefs
 import bauble.pluginmgr as pluginmgr
 from bauble.plugins.plants import Family, Genus, Species, VernacularName
 from bauble.plugins.garden import Accession, Plant, Location
-from bauble.plugins.tag import Tag
+from bauble.plugins.tag import Tag, TaggedObj
 
 # TODO: this module should depend on PlantPlugin, GardenPlugin,
 # TagPlugin and should also allow other plugins to register between
@@ -75,150 +77,170 @@ formatter_settings_expanded_pref = 'report.settings.expanded'
 #         _paths[parent][descendent] = query
 
 
-def _get_pertinent_objects(cls, get_query_func, objs, session):
-    """
-    :param cls:
-    :param get_query_func:
-    :param objs:
-    :param session:
+## for each class we report on, the relations leading from it to each
+## class of objects that can be selected, and the message explaining
+## that objects of some other class can't be reported on.
+_pertinent_paths = {
+    Plant: ({Family: ('accession', 'species', 'genus', 'family'),
+             Genus: ('accession', 'species', 'genus'),
+             Species: ('accession', 'species'),
+             VernacularName: ('accession', 'species', 'vernacular_names'),
+             Accession: ('accession', ),
+             Plant: (),
+             Location: ('location', )},
+            _("Can't get plants from a %s")),
+    Accession: ({Family: ('species', 'genus', 'family'),
+                 Genus: ('species', 'genus'),
+                 Species: ('species', ),
+                 VernacularName: ('species', 'vernacular_names'),
+                 Accession: (),
+                 Plant: ('plants', ),
+                 Location: ('plants', 'location')},
+                _("Can't get accessions from a %s")),
+    Species: ({Family: ('genus', 'family'),
+               Genus: ('genus', ),
+               Species: (),
+               VernacularName: ('vernacular_names', ),
+               Accession: ('accessions', ),
+               Plant: ('accessions', 'plants'),
+               Location: ('accessions', 'plants', 'location')},
+              _("Can't get species from a %s")),
+    }
+
+
+def get_pertinent_ids(cls, objs, session):
+    """return the set of the ids of the cls objects pertinent to objs
+
+    :param cls: Plant, Accession or Species
+    :param objs: a mapped object, or a list of them
+    :param session: the session to use for the queries
+
+    objs are grouped by class, and each group is resolved with one
+    query, matching the ids of the group by `IN`.  the objects tagged by
+    the Tag objects in objs are found joining the `tagged_obj` table,
+    with one query per class of tagged objects.
     """
-    if session is None:
-        import bauble.db as db
-        session = db.Session()
     if not isinstance(objs, (tuple, list)):
         objs = [objs]
-    queries = map(lambda o: get_query_func(o, session), objs)
-    # TODO: what is the problem with the following form?
-    # results = session.query(cls).order_by(None).union(*queries)
-    unions = union(*[q.statement for q in queries])
-    results = session.query(cls).from_statement(unions)
-    return results
+    paths, message = _pertinent_paths[cls]
+    ids_by_class = {}
+    tag_ids = set()
+    for obj in objs:
+        if isinstance(obj, Tag):
+            tag_ids.add(obj.id)
+            continue
+        for source in paths:
+            if isinstance(obj, source):
+                ids_by_class.setdefault(source, set()).add(obj.id)
+                break
+        else:
+            raise BaubleError(message % type(obj).__name__)
+
+    result = set()
+    for source, path in paths.iteritems():
+        ids = ids_by_class.get(source)
+        if ids:
+            query = session.query(cls.id).join(*path).\
+                filter(db.in_ids(source.id, ids))
+            result.update(i for (i, ) in query)
+        if tag_ids:
+            classname = '%s.%s' % (source.__module__, source.__name__)
+            query = session.query(cls.id).join(*path).\
+                join(TaggedObj, and_(TaggedObj.obj_id == source.id,
+                                     TaggedObj.obj_class == classname)).\
+                filter(db.in_ids(TaggedObj.tag_id, tag_ids))
+            result.update(i for (i, ) in query)
+    return result
+
+
+def _get_pertinent_objects(cls, objs, session, hydrate=True):
+    """return the cls objects pertinent to objs
+
+    with hydrate, the list of objects, otherwise the set of their ids.
+    """
+    if session is None:
+        # the objects we return stay bound to the session of objs, which
+        # lives as long as the caller needs them
+        if not isinstance(objs, (tuple, list)):
+            objs = [objs]
+        session = objs and object_session(objs[0]) or db.Session()
+    ids = get_pertinent_ids(cls, objs, session)
+    if not hydrate:
+        return ids
+    return db.load_by_ids(session, cls, ids)
 
 
-def get_plant_query(obj, session):
-    """
+def _species_graph(load):
+    return [load.joinedload('genus').joinedload('family'),
+            load.joinedload('_default_vernacular_name').
+            joinedload('vernacular_name'),
+            load.subqueryload('notes'),
+            load.subqueryload('distribution').joinedload('geography')]
+
+
+def _accession_graph(load):
+    return [load.subqueryload('notes'),
+            load.joinedload('source').joinedload('collection')] + \
+        _species_graph(load.joinedload('species'))
+
+
+def _plant_graph(load):
+    return [load.joinedload('location'),
+            load.subqueryload('notes')] + \
+        _accession_graph(load.joinedload('accession'))
+
+
+## the loader options reaching, from the objects we report on, all that
+## the report adapters read
+_report_graphs = {Plant: _plant_graph,
+                  Accession: _accession_graph,
+                  Species: _species_graph}
+
+
+def load_report_objects(cls, ids, session):
+    """return the cls objects with the given ids, ready for a report
+
+    the objects are loaded with what the report adapters read of them,
+    in a fixed number of queries per db.IN_CHUNK_SIZE ids, independent
+    of the number of objects and of their notes and names.
     """
-    # as of sqlalchemy 0.5.0 we have to have the order_by(None) here
-    # so that if we want to union() the statements together later it
-    # will work properly
-    q = session.query(Plant).order_by(None)
-    if isinstance(obj, Family):
-        return q.join('accession', 'species', 'genus', 'family').\
-            filter_by(id=obj.id)
-    elif isinstance(obj, Genus):
-        return q.join('accession', 'species', 'genus').filter_by(id=obj.id)
-    elif isinstance(obj, Species):
-        return q.join('accession', 'species').filter_by(id=obj.id)
-    elif isinstance(obj, VernacularName):
-        return q.join('accession', 'species', 'vernacular_names').\
-            filter_by(id=obj.id)
-    elif isinstance(obj, Plant):
-        return q.filter_by(id=obj.id)
-    elif isinstance(obj, Accession):
-        return q.join('accession').filter_by(id=obj.id)
-    elif isinstance(obj, Location):
-        return q.filter_by(location_id=obj.id)
-    elif isinstance(obj, Tag):
-        plants = get_plants_pertinent_to(obj.objects, session)
-        return q.filter(Plant.id.in_([p.id for p in plants]))
-    else:
-        raise BaubleError(_("Can't get plants from a %s") % type(obj).__name__)
-
-
-def get_plants_pertinent_to(objs, session=None):
+    return db.load_by_ids(session, cls, ids, _report_graphs[cls](Load(cls)))
+
+
+def get_plants_pertinent_to(objs, session=None, hydrate=True):
     """
     :param objs: an instance of a mapped object
     :param session: the session to use for the queries
+    :param hydrate: if False, return the ids and not the objects
 
     Return all the plants found in objs.
     """
-    return _get_pertinent_objects(Plant, get_plant_query, objs, session)
+    return _get_pertinent_objects(Plant, objs, session, hydrate)
 
 
-def get_accession_query(obj, session):
-    """
-    """
-    # as of sqlalchemy 0.5.0 we have to have the order_by(None) here
-    # so that if we want to union() the statements together later it
-    # will work properly
-    q = session.query(Accession).order_by(None)
-    if isinstance(obj, Family):
-        return q.join('species', 'genus', 'family').\
-            filter_by(id=obj.id)
-    elif isinstance(obj, Genus):
-        return q.join('species', 'genus').filter_by(id=obj.id)
-    elif isinstance(obj, Species):
-        return q.join('species').filter_by(id=obj.id)
-    elif isinstance(obj, VernacularName):
-        return q.join('species', 'vernacular_names').\
-            filter_by(id=obj.id)
-    elif isinstance(obj, Plant):
-        return q.join('plants').filter_by(id=obj.id)
-    elif isinstance(obj, Accession):
-        return q.filter_by(id=obj.id)
-    elif isinstance(obj, Location):
-        return q.join('plants').filter_by(location_id=obj.id)
-    elif isinstance(obj, Tag):
-        acc = get_accessions_pertinent_to(obj.objects, session)
-        return q.filter(Accession.id.in_([a.id for a in acc]))
-    else:
-        raise BaubleError(_("Can't get accessions from a %s") %
-                          type(obj).__name__)
-
-
-def get_accessions_pertinent_to(objs, session=None):
+def get_accessions_pertinent_to(objs, session=None, hydrate=True):
     """
     :param objs: an instance of a mapped object
     :param session: the session to use for the queries
+    :param hydrate: if False, return the ids and not the objects
 
     Return all the accessions found in objs.
     """
-    return _get_pertinent_objects(
-        Accession, get_accession_query, objs, session)
+    return _get_pertinent_objects(Accession, objs, session, hydrate)
 
 
-def get_species_query(obj, session):
-    """
-    """
-    # as of sqlalchemy 0.5.0 we have to have the order_by(None) here
-    # so that if we want to union() the statements together later it
-    # will work properly
-    q = session.query(Species).order_by(None)
-    if isinstance(obj, Family):
-        return q.join('genus', 'family').\
-            filter_by(id=obj.id)
-    elif isinstance(obj, Genus):
-        return q.join('genus').filter_by(id=obj.id)
-    elif isinstance(obj, Species):
-        return q.filter_by(id=obj.id)
-    elif isinstance(obj, VernacularName):
-        return q.join('vernacular_names').\
-            filter_by(id=obj.id)
-    elif isinstance(obj, Plant):
-        return q.join('accessions', 'plants').filter_by(id=obj.id)
-    elif isinstance(obj, Accession):
-        return q.join('accessions').filter_by(id=obj.id)
-    elif isinstance(obj, Location):
-        return q.join('accessions', 'plants', 'location').\
-            filter_by(id=obj.id)
-    elif isinstance(obj, Tag):
-        acc = get_species_pertinent_to(obj.objects, session)
-        return q.filter(Species.id.in_([a.id for a in acc]))
-    else:
-        raise BaubleError(_("Can't get species from a %s") %
-                          type(obj).__name__)
-
-
-def get_species_pertinent_to(objs, session=None):
+def get_species_pertinent_to(objs, session=None, hydrate=True):
     """
     :param objs: an instance of a mapped object
     :param session: the session to use for the queries
+    :param hydrate: if False, return the ids and not the objects
 
     Return all the species found in objs.
     """
-    return sorted(
-        _get_pertinent_objects(Species, get_species_query, objs, session),
-        key=str)
+    result = _get_pertinent_objects(Species, objs, session, hydrate)
+    if not hydrate:
+        return result
+    return sorted(result, key=unicode)
 
 
 class SettingsBox(gtk.VBox):
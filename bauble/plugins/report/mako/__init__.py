@@ -24,13 +24,16 @@
 import logging
 logger = logging.getLogger(__name__)
 
+import codecs
 import os
 import shutil
 import tempfile
 
 import gtk
 
+from mako.runtime import Context
 from mako.template import Template
+from sqlalchemy.exc import InvalidRequestError
 
 from bauble.i18n import _
 import bauble.db as db
@@ -40,6 +43,55 @@ import bauble.utils as utils
 import bauble.utils.desktop as desktop
 
 
+## template filename -> (modification time, compiled Template)
+_templates = {}
+
+
+def get_template(filename):
+    """return the compiled Template in filename
+
+    the compiled templates are kept in memory and, as python modules, in
+    the templates cache directory.  both are compiled again when the
+    template file changes.
+    """
+    mtime = os.path.getmtime(filename)
+    cached = _templates.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    module_directory = os.path.join(
+        paths.appdata_dir(), 'templates', 'mako-cache')
+    if not os.path.exists(module_directory):
+        os.makedirs(module_directory)
+    template = Template(
+        filename=filename, input_encoding='utf-8', output_encoding='utf-8',
+        module_directory=module_directory)
+    _templates[filename] = (mtime, template)
+    return template
+
+
+def merge_all(session, objs):
+    """return the objs merged into session
+
+    the objects are merged without querying them one by one, then
+    refreshed from the database with one query per class and
+    db.IN_CHUNK_SIZE objects.  objects with changes not yet flushed are
+    merged with their changes, and not refreshed.
+    """
+    result = []
+    ids = {}
+    for obj in objs:
+        try:
+            result.append(session.merge(obj, load=False))
+        except InvalidRequestError:
+            # it has changes not yet flushed
+            result.append(session.merge(obj))
+        else:
+            ids.setdefault(type(obj), set()).add(obj.id)
+    for cls, cls_ids in ids.iteritems():
+        db.load_by_ids(session, cls, cls_ids, populate_existing=True)
+    return result
+
+
 class MakoFormatterSettingsBox(SettingsBox):
 
     def __init__(self, report_dialog=None, *args):
@@ -130,25 +182,25 @@ class MakoFormatterPlugin(FormatterPlugin):
             msg = _('Please select a template.')
             utils.message_dialog(msg, gtk.MESSAGE_WARNING)
             return False
-        template = Template(
-            filename=template_filename, input_encoding='utf-8',
-            output_encoding='utf-8')
+        template = get_template(template_filename)
         session = db.Session()
-        values = map(session.merge, objs)
-        report = template.render(values=values)
-        session.close()
+        values = merge_all(session, objs)
         # assume the template is the same file type as the output file
         head, ext = os.path.splitext(template_filename)
         fd, filename = tempfile.mkstemp(suffix=ext)
-        os.write(fd, report)
-        os.close(fd)
+        output = codecs.getwriter('utf-8')(os.fdopen(fd, 'w'))
+        try:
+            template.render_context(Context(output, values=values))
+        finally:
+            output.close()
+            session.close()
         try:
             desktop.open(filename)
         except OSError:
             utils.message_dialog(_('Could not open the report with the '
                                    'default program. You can open the '
                                    'file manually at %s') % filename)
-        return report
+        return filename
 
 
 formatter_plugin = MakoFormatterPlugin
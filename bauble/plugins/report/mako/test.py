@@ -88,6 +88,65 @@ class MakoFormatterTests(BaubleTestCase):
         plants = self.session.query(Plant).all()
         filename = os.path.join(os.path.dirname(__file__), 'example.csv')
         report = MakoFormatterPlugin.format(plants, template=filename)
-        assert(isinstance(report, basestring))
-        open('/tmp/testlabels.csv', 'w').write(report)
+        assert(os.path.exists(report))
+        os.remove(report)
         #print >>sys.stderr, report
+
+    def test_format_streams_utf8(self):
+        import tempfile
+        plants = self.session.query(Plant).all()
+        plants[0].accession.species.genus.epithet = u'Gen\xe8re'
+        self.session.commit()
+        fd, template = tempfile.mkstemp(suffix='.csv')
+        os.write(fd, '% for v in values:\n${v.accession.species.genus}\n'
+                 '% endfor\n')
+        os.close(fd)
+        report = MakoFormatterPlugin.format(plants, template=template)
+        lines = open(report).read().decode('utf-8').splitlines()
+        self.assertEquals(len(lines), len(plants))
+        self.assertEquals(lines[0], u'Gen\xe8re')
+        os.remove(report)
+        os.remove(template)
+
+    def test_template_cached(self):
+        import tempfile
+        from bauble.plugins.report.mako import get_template
+        fd, filename = tempfile.mkstemp(suffix='.txt')
+        os.write(fd, 'one')
+        os.close(fd)
+        template = get_template(filename)
+        self.assertTrue(get_template(filename) is template)
+        open(filename, 'w').write('two')
+        os.utime(filename, (0, os.path.getmtime(filename) + 10))
+        changed = get_template(filename)
+        self.assertFalse(changed is template)
+        self.assertEquals(changed.render(), 'two')
+        os.remove(filename)
+
+    def test_merge_all_batched(self):
+        import bauble.db as db
+        from bauble.plugins.report.mako import merge_all
+        plants = self.session.query(Plant).all()
+        accessions = self.session.query(Accession).all()
+        session = db.Session()
+        merged = self.assertMaxStatements(
+            2, merge_all, session, plants + accessions)
+        self.assertEquals([(type(o), o.id) for o in merged],
+                          [(type(o), o.id) for o in plants + accessions])
+        self.assertTrue(all(o in session for o in merged))
+        session.close()
+
+    def test_merge_all_refreshes(self):
+        import bauble.db as db
+        from bauble.plugins.report.mako import merge_all
+        plants = self.session.query(Plant).all()
+        session = db.Session()
+        plant = session.query(Plant).get(plants[0].id)
+        other = db.Session()
+        other.query(Plant).get(plant.id).quantity = 42
+        other.commit()
+        other.close()
+        merged = merge_all(session, plants)
+        self.assertTrue(plant in merged)
+        self.assertEquals(plant.quantity, 42)
+        session.close()
@@ -20,10 +20,11 @@
 
 import os
 
-from bauble.test import BaubleTestCase, check_dupids
+import bauble.db as db
+from bauble.test import BaubleTestCase, StatementCounter, check_dupids
 from bauble.plugins.report import (
     get_species_pertinent_to, get_accessions_pertinent_to,
-    get_plants_pertinent_to)
+    get_plants_pertinent_to, get_pertinent_ids, load_report_objects)
 from bauble.plugins.plants import Family, Genus, Species, VernacularName
 from bauble.plugins.garden import Accession, Plant, Location
 from bauble.plugins.tag import tag_objects, Tag
@@ -287,3 +288,57 @@ class ReportTests(ReportTestCase):
             [family, genus, species, accession, plant, location], self.session)
         ids = get_ids(plants)
         self.assert_(ids == range(1, 17), ids)
+
+    def test_pertinent_ids_one_query_per_class(self):
+        accessions = self.session.query(Accession).all()
+        locations = self.session.query(Location).all()[:3]
+        with StatementCounter() as statements:
+            ids = get_pertinent_ids(Plant, accessions + locations,
+                                    self.session)
+        self.assertEquals(sorted(ids), range(1, 33))
+        self.assertEquals(len(statements), 2)
+        self.assertFalse('UNION' in ' '.join(statements))
+
+    def test_load_report_objects(self):
+        from bauble.plugins.garden.plant import PlantNote
+        from bauble.plugins.plants.species_model import SpeciesNote
+        for plant in self.session.query(Plant):
+            self.session.add(PlantNote(plant=plant, note=u'n', user=u'u'))
+        for species in self.session.query(Species):
+            self.session.add(SpeciesNote(species=species, note=u'n',
+                                         user=u'u'))
+        self.session.commit()
+
+        def read(plant):
+            species = plant.accession.species
+            return (unicode(plant), unicode(plant.location),
+                    [n.note for n in plant.notes],
+                    [n.note for n in plant.accession.notes],
+                    plant.accession.source, species.str(authors=True),
+                    unicode(species.genus.family),
+                    species.default_vernacular_name,
+                    [n.note for n in species.notes],
+                    species.distribution_str())
+
+        session = db.Session()
+        ids = get_plants_pertinent_to(
+            session.query(Family).all(), session, hydrate=False)
+        # a fixed number of queries, and nothing left to load lazily
+        plants = self.assertMaxStatements(
+            5, load_report_objects, Plant, ids, session)
+        self.assertEquals(sorted(p.id for p in plants), range(1, 33))
+        Plant.get_delimiter()  # a setting, read once
+        self.assertMaxStatements(0, lambda: [read(p) for p in plants])
+        session.close()
+
+    def test_pertinent_ids_without_hydrating(self):
+        genus = self.session.query(Genus).get(1)
+        tag_objects('test', [self.session.query(Location).get(16)])
+        tag = self.session.query(Tag).filter_by(tag=u'test').one()
+        self.assertEquals(
+            get_plants_pertinent_to([genus, tag], self.session,
+                                    hydrate=False),
+            set([1, 2, 3, 4, 5, 6, 7, 8, 16]))
+        self.assertEquals(
+            get_species_pertinent_to(tag, self.session, hydrate=False),
+            set([4]))
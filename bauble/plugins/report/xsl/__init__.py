@@ -29,9 +29,12 @@ data to an XSL formatting stylesheet and uses a XSL-PDF renderer to
 convert the stylesheet to PDF.
 """
 import shutil
+import subprocess
 import sys
 import os
 import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 
 import gtk
 
@@ -43,18 +46,29 @@ from sqlalchemy.orm import object_session
 
 import bauble.db as db
 import bauble.paths as paths
+import bauble.sortkey as sortkey
 from bauble.plugins.plants.species import Species
+from bauble.plugins.garden import Accession, Plant
 #from bauble.plugins.garden.plant import Plant
 #from bauble.plugins.garden.accession import Accession
-from bauble.plugins.abcd import create_abcd, ABCDAdapter, ABCDElement
+from bauble.plugins.abcd import (
+    write_abcd, get_institution, ABCDAdapter, ABCDElement)
 from bauble.plugins.report import (
     get_plants_pertinent_to, get_species_pertinent_to,
-    get_accessions_pertinent_to, FormatterPlugin, SettingsBox)
+    get_accessions_pertinent_to, load_report_objects, FormatterPlugin,
+    SettingsBox)
 import bauble.prefs as prefs
 import bauble.utils as utils
 import bauble.utils.desktop as desktop
 from bauble.i18n import _
 
+try:
+    from PyPDF2 import PdfFileMerger
+except ImportError:
+    # without it, we can't join the PDF files of the chunks, and we
+    # render the whole report at once
+    PdfFileMerger = None
+
 if sys.platform == "win32":
     fop_cmd = 'fop.bat'
 else:
@@ -104,6 +118,39 @@ def on_path(exe):
     return False
 
 
+def render_chunk(abcd_filename, stylesheet, fo_cmd, pdf_filename):
+    """transform an ABCD file to XSL-FO, and render that to PDF
+
+    :returns: the seconds spent transforming and rendering.
+    """
+    start = time.time()
+    transform = etree.XSLT(etree.parse(stylesheet))
+    result = transform(etree.parse(abcd_filename))
+    fo_filename = '%s.fo' % abcd_filename
+    fo_outfile = open(fo_filename, 'w')
+    fo_outfile.write(str(result))
+    fo_outfile.close()
+    transformed = time.time()
+
+    # run the report to produce the pdf file, the command has to be
+    # on the path for this to work
+    fo_cmd = fo_cmd % ({'fo_filename': fo_filename,
+                        'out_filename': pdf_filename})
+    logger.debug(fo_cmd)
+    subprocess.call(fo_cmd, shell=True)
+    return transformed - start, time.time() - transformed
+
+
+def concatenate_pdfs(filenames, out_filename):
+    """write the pages of the PDF files filenames, in order, to out_filename
+    """
+    merger = PdfFileMerger()
+    for filename in filenames:
+        merger.append(filename)
+    merger.write(out_filename)
+    merger.close()
+
+
 class SpeciesABCDAdapter(ABCDAdapter):
     """
     An adapter to convert a Species to an ABCD Unit, the SpeciesABCDAdapter
@@ -487,8 +534,15 @@ _settings_box = XSLFormatterSettingsBox()
 
 
 class XSLFormatterPlugin(FormatterPlugin):
+    """
+    the ABCD data is written one unit at a time, in files of chunk_size
+    units; the chunks are transformed and rendered concurrently, by
+    `processes` renderers, and the resulting PDF files are joined.
+    """
 
     title = _('XSL')
+    chunk_size = 500
+    processes = None  # as many as the CPUs
 
     @classmethod
     def install(cls, import_defaults=True):
@@ -551,80 +605,102 @@ class XSLFormatterPlugin(FormatterPlugin):
                                  gtk.MESSAGE_ERROR)
             return False
 
+        timings = {}
+        started = time.time()
         session = db.Session()
 
-        # convert objects to ABCDAdapters depending on source type for
-        # passing to create_abcd
-        adapted = []
+        # the objects to convert to ABCDAdapters, depending on source
+        # type, when their chunk is written
+        units = []
         if source_type == plant_source_type:
-            plants = sorted(get_plants_pertinent_to(objs, session=session),
-                            key=utils.natsort_key)
+            plants = sortkey.natsorted(load_report_objects(
+                Plant, get_plants_pertinent_to(objs, session, hydrate=False),
+                session))
             if len(plants) == 0:
                 utils.message_dialog(_('There are no plants in the search '
                                        'results.  Please try another search.'))
                 return False
-            for p in plants:
-                if use_private:
-                    adapted.append(PlantABCDAdapter(p, for_labels=True))
-                elif not p.accession.private:
-                    adapted.append(PlantABCDAdapter(p, for_labels=True))
+            adapter = PlantABCDAdapter
+            units = [p for p in plants
+                     if use_private or not p.accession.private]
         elif source_type == species_source_type:
-            species = sorted(get_species_pertinent_to(objs, session=session),
-                             key=utils.natsort_key)
+            species = sortkey.natsorted(load_report_objects(
+                Species,
+                get_species_pertinent_to(objs, session, hydrate=False),
+                session))
             if len(species) == 0:
                 utils.message_dialog(_('There are no species in the search '
                                        'results.  Please try another search.'))
                 return False
-            for s in species:
-                adapted.append(SpeciesABCDAdapter(s, for_labels=True))
+            adapter = SpeciesABCDAdapter
+            units = species
         elif source_type == accession_source_type:
-            accessions = sorted(get_accessions_pertinent_to(objs,
-                                                            session=session),
-                                key=utils.natsort_key)
+            accessions = sortkey.natsorted(load_report_objects(
+                Accession,
+                get_accessions_pertinent_to(objs, session, hydrate=False),
+                session))
             if len(accessions) == 0:
                 utils.message_dialog(_('There are no accessions in the search '
                                        'results.  Please try another search.'))
                 return False
-            for a in accessions:
-                if use_private:
-                    adapted.append(AccessionABCDAdapter(a, for_labels=True))
-                elif not a.private:
-                    adapted.append(AccessionABCDAdapter(a, for_labels=True))
+            adapter = AccessionABCDAdapter
+            units = [a for a in accessions if use_private or not a.private]
         else:
             raise NotImplementedError('unknown source type')
 
-        if len(adapted) == 0:
+        if len(units) == 0:
             # nothing adapted....possibly everything was private
             # TODO: if everything was private and that is really why we got
             # here then it is probably better to show a dialog with a message
             # and raise and exception which appears as an error
             raise Exception('No objects could be adapted to ABCD units.')
-        abcd_data = create_abcd(adapted, authors=authors, validate=False)
-
+        timings['query'] = time.time() - started
+
+        chunk_size = len(units)
+        if PdfFileMerger is not None:
+            chunk_size = XSLFormatterPlugin.chunk_size
+        workdir = tempfile.mkdtemp()
+        inst = get_institution()
+        pool = ThreadPool(XSLFormatterPlugin.processes)
+        jobs = []
+        timings['abcd'] = 0
+        for index, first in enumerate(range(0, len(units), chunk_size)):
+            started = time.time()
+            abcd_filename = os.path.join(workdir, 'abcd%05d.xml' % index)
+            write_abcd((adapter(i, for_labels=True)
+                        for i in units[first:first + chunk_size]),
+                       abcd_filename, authors=authors, inst=inst)
+            timings['abcd'] += time.time() - started
+            pdf_filename = os.path.join(workdir, 'report%05d.pdf' % index)
+            jobs.append((pdf_filename, pool.apply_async(
+                render_chunk,
+                (abcd_filename, stylesheet, fo_cmd, pdf_filename))))
+        pool.close()
         session.close()
 
-        logger.debug(etree.dump(abcd_data.getroot()))
+        started = time.time()
+        timings['xslt'] = timings['render'] = 0
+        for pdf_filename, job in jobs:
+            transforming, rendering = job.get()
+            timings['xslt'] += transforming
+            timings['render'] += rendering
+        pool.join()
+        timings['transform and render, elapsed'] = time.time() - started
 
-        # create xsl fo file
-        dummy, fo_filename = tempfile.mkstemp()
-        style_etree = etree.parse(stylesheet)
-        transform = etree.XSLT(style_etree)
-        result = transform(abcd_data)
-        fo_outfile = open(fo_filename, 'w')
-        fo_outfile.write(str(result))
-        fo_outfile.close()
+        pdf_filenames = [pdf_filename for pdf_filename, job in jobs]
         dummy, filename = tempfile.mkstemp()
         filename = '%s.pdf' % filename
-
-        # TODO: checkout pyexpect for spawning processes
-
-        # run the report to produce the pdf file, the command has to be
-        # on the path for this to work
-        fo_cmd = fo_cmd % ({'fo_filename': fo_filename,
-                            'out_filename': filename})
-        logger.debug(fo_cmd)
-        # TODO: use popen to get output
-        os.system(fo_cmd)
+        if all(os.path.exists(f) for f in pdf_filenames):
+            started = time.time()
+            if len(pdf_filenames) == 1:
+                shutil.move(pdf_filenames[0], filename)
+            else:
+                concatenate_pdfs(pdf_filenames, filename)
+            timings['concatenate'] = time.time() - started
+        shutil.rmtree(workdir, ignore_errors=True)
+        logger.info('xsl report of %s units in %s chunks: %s' % (
+            len(units), len(jobs), ', '.join(
+                '%s %.2fs' % (k, v) for k, v in sorted(timings.items()))))
 
         logger.debug(filename)
         if not os.path.exists(filename):
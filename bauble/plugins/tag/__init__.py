@@ -24,6 +24,7 @@
 #
 import os
 import traceback
+from collections import OrderedDict
 
 import gtk
 
@@ -32,11 +33,12 @@ logger = logging.getLogger(__name__)
 #logger.setLevel(logging.DEBUG)
 
 from sqlalchemy import (
-    Column, Unicode, UnicodeText, Integer, String, ForeignKey)
-from sqlalchemy.orm import relation
+    Column, Unicode, UnicodeText, Integer, String, ForeignKey, Index, cast,
+    distinct, event, inspect, literal, select)
+from sqlalchemy.orm import Session, relation
 from sqlalchemy.orm.exc import DetachedInstanceError
-from sqlalchemy import and_
-from sqlalchemy.exc import DBAPIError, InvalidRequestError
+from sqlalchemy import and_, or_, func
+from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm.session import object_session
 
 from bauble.i18n import _
@@ -250,6 +252,18 @@ class TagItemGUI(editor.GenericEditorView):
         session.close()
 
 
+## table name -> number of changes notified; see Tag.objects
+_generations = {}
+OBJECTS_MAX_AGE = 300
+
+
+def _count_change(table_name, operation):
+    _generations[table_name] = _generations.get(table_name, 0) + 1
+
+
+db.add_change_listener(_count_change)
+
+
 class Tag(db.Base):
     """
     :Table name: tag
@@ -279,30 +293,31 @@ class Tag(db.Base):
     def markup(self):
         return '%s Tag' % self.tag
 
-    __my_own_timestamp = None
     __last_objects = None
+    __last_read = None  # (time, generations of the tables)
+    __watched = ()  # tagged_obj, and the tables of the tagged objects
 
     @property
     def objects(self):
         """return all tagged objects
 
-        reuse last result if nothing was changed in the database since
-        list was retrieved.
+        reuse last result until db.HistoryExtension notifies a change to
+        the tagged_obj table or to the table of a tagged object.  changes
+        made by other clients of the database are not notified, so the
+        result is also read again after OBJECTS_MAX_AGE seconds.
         """
-        if self.__my_own_timestamp is not None:
-            # should I update my list?
-            session = object_session(self)
-            last_history = session.query(db.History)\
-                .order_by(db.History.timestamp.desc())\
-                .limit(1).one()
-            if last_history.timestamp > self.__my_own_timestamp:
+        import time
+        if self.__last_objects is not None:
+            read_at, generations = self.__last_read
+            if time.time() - read_at > OBJECTS_MAX_AGE or any(
+                    _generations.get(t, 0) != generations.get(t, 0)
+                    for t in self.__watched):
                 self.__last_objects = None
         if self.__last_objects is None:
-            # here I update my list
-            from datetime import datetime
-            self.__my_own_timestamp = datetime.now()
+            self.__last_read = (time.time(), dict(_generations))
             self.__last_objects = self.get_tagged_objects()
-        # here I return my list
+            self.__watched = set([TaggedObj.__tablename__] + [
+                type(o).__table__.name for o in self.__last_objects])
         return self.__last_objects
 
     def is_tagging(self, obj):
@@ -315,18 +330,40 @@ class Tag(db.Base):
         """
         Return all object tagged with tag.
 
+        the objects are loaded with one IN query per class and
+        db.IN_CHUNK_SIZE objects, and returned in tagging order.
         """
         session = object_session(self)
+        pairs = _get_tagged_object_pairs(self)
+        ids = {}
+        for cls, obj_id in pairs:
+            ids.setdefault(cls, set()).add(obj_id)
+        loaded = {}
+        for cls, cls_ids in ids.iteritems():
+            for obj in db.load_by_ids(session, cls, cls_ids):
+                loaded[(cls, obj.id)] = obj
+
+        # skip the objects which were tagged and then deleted from the
+        # database bypassing the ORM; `vacuum-tags` removes them
+        return [loaded[pair] for pair in pairs if pair in loaded]
+
+    def get_tagged_counts(self):
+        """
+        Return the dictionary of the number of tagged objects per class.
 
-        # filter out any None values from the query which can happen if
-        # you tag something and then delete it from the datebase
-
-        # TODO: the missing tagged objects should probably be removed from
-        # the database
-        r = [session.query(mapper).filter_by(id=obj_id).first()
-             for mapper, obj_id in _get_tagged_object_pairs(self)]
-        r = [i for i in r if i is not None]
-        return r
+        counts come from the tagged_obj table, without loading the
+        objects.
+        """
+        session = object_session(self)
+        query = session.query(TaggedObj.obj_class, func.count(TaggedObj.id)).\
+            filter(TaggedObj.tag_id == self.id).\
+            group_by(TaggedObj.obj_class)
+        result = {}
+        for obj_class, count in query:
+            cls = _resolve_class(obj_class)
+            if cls is not None:
+                result[cls] = result.get(cls, 0) + count
+        return result
 
     @classmethod
     def attached_to(cls, obj):
@@ -348,20 +385,17 @@ class Tag(db.Base):
     def search_view_markup_pair(self):
         '''provide the two lines describing object for SearchView row.
         '''
-        import inspect
-        logging.debug('entering search_view_markup_pair %s, %s' % (
-            self, str(inspect.stack()[1])))
-        objects = self.objects
-        classes = set(type(o) for o in objects)
+        counts = self.get_tagged_counts()
+        classes = set(counts)
         if len(classes) == 1:
             fine_prints = "tagging %(1)s objects of type %(2)s" % {
-                '1': len(objects),
+                '1': sum(counts.values()),
                 '2': classes.pop().__name__}
         elif len(classes) == 0:
             fine_prints = "tagging nothing"
         else:
             fine_prints = "tagging %(1)s objects of %(2)s different types" % {
-                '1': len(objects),
+                '1': sum(counts.values()),
                 '2': len(classes)}
             if len(classes) < 4:
                 fine_prints += ': ' + (', '.join(
@@ -387,17 +421,131 @@ class TaggedObj(db.Base):
 
     """
     __tablename__ = 'tagged_obj'
+    __table_args__ = (Index('ix_tagged_obj_obj', 'obj_class', 'obj_id'), {})
 
     # columns
     obj_id = Column(Integer, autoincrement=False)
     obj_class = Column(String(128))
     # # TODO: can class names be unicode, i.e. should obj_class be unicode
-    tag_id = Column(Integer, ForeignKey('tag.id'))
+    tag_id = Column(Integer, ForeignKey('tag.id'), index=True)
 
     def __str__(self):
         return '%s: %s' % (self.obj_class, self.obj_id)
 
 
+def upgrade(engine=None):
+    """create the tagged_obj indexes missing in the database
+
+    return the names of the created indexes.
+    """
+    return db.create_missing_indexes(TaggedObj.__table__, engine)
+
+
+## session.info key of the ids of the objects deleted by the running
+## flush, per class; see _purge_tags.
+DELETED = 'tag_deleted_objects'
+
+
+def _collect_deleted(mapper, connection, target):
+    if isinstance(target, (Tag, TaggedObj)):
+        return
+    session = object_session(target)
+    session.info.setdefault(DELETED, OrderedDict()).setdefault(
+        type(target), set()).add(target.id)
+
+
+def _purge_tags(session, flush_context):
+    """remove the tags of the objects deleted by the flush, in the same
+    transaction, with one statement, and record them in the history.
+    """
+    deleted = session.info.pop(DELETED, None)
+    if not deleted:
+        return
+    table = TaggedObj.__table__
+    clause = _tagged_clause(deleted)
+    connection = session.connection()
+    if not session.info.get(db.NO_HISTORY):
+        rows = connection.execute(table.select().where(clause)).fetchall()
+        if not rows:
+            return
+        db.add_history(session, table, rows, 'delete')
+    connection.execute(table.delete().where(clause))
+
+
+def _forget_deleted(session, *args):
+    session.info.pop(DELETED, None)  # left over by a failed flush
+
+
+## every class mapped through db.Base
+event.listen(db.Base, 'after_delete', _collect_deleted, propagate=True)
+event.listen(Session, 'before_flush', _forget_deleted)
+event.listen(Session, 'after_flush', _purge_tags)
+
+
+def _orphans_clause(connection):
+    """the clause matching the tagged_obj rows pointing to no tag, or to
+    objects that don't exist, of classes we can resolve.
+    """
+    table = TaggedObj.__table__
+    clauses = [~table.c.tag_id.in_(select([Tag.__table__.c.id]))]
+    for (obj_class, ) in connection.execute(
+            select([table.c.obj_class]).distinct()):
+        cls = _resolve_class(obj_class)
+        if cls is None:
+            # its plugin might just be disabled
+            continue
+        clauses.append(and_(table.c.obj_class == obj_class,
+                            ~table.c.obj_id.in_(select([cls.__table__.c.id]))))
+    return or_(*clauses)
+
+
+def vacuum(engine=None, remove=True):
+    """find, and unless remove is False delete, the orphan tagged_obj rows
+
+    return the dictionary of the number of orphans per obj_class.
+    """
+    engine = engine or db.engine
+    table = TaggedObj.__table__
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        orphans = _orphans_clause(connection)
+        result = dict(connection.execute(
+            select([table.c.obj_class, func.count(table.c.id)]).
+            where(orphans).group_by(table.c.obj_class)).fetchall())
+        if remove and result:
+            connection.execute(table.delete().where(orphans))
+    except Exception, e:
+        logger.warning('tag.vacuum(): %s' % utils.utf8(e))
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    finally:
+        connection.close()
+    if remove and result:
+        db.notify_change(table.name, 'delete')
+    return result
+
+
+class VacuumTagsCommandHandler(pluginmgr.CommandHandler):
+
+    command = 'vacuum-tags'
+
+    def __call__(self, cmd, arg):
+        remove = (arg != 'report')
+        orphans = vacuum(remove=remove)
+        if remove:
+            msg = _('Removed %(count)s tagged objects which do not exist.')
+        else:
+            msg = _('Found %(count)s tagged objects which do not exist.')
+        details = ', '.join('%s: %s' % i for i in sorted(orphans.items()))
+        logger.info('%s %s' % (msg % {'count': sum(orphans.values())},
+                               details))
+        utils.message_details_dialog(
+            msg % {'count': sum(orphans.values())}, details)
+
+
 # TODO: maybe we shouldn't remove the obj from the tag if we can't
 # find it, it doesn't really hurt to have it there and in case the
 # table isn't available at the moment doesn't mean it won't be there
@@ -405,37 +553,47 @@ class TaggedObj(db.Base):
 # disabled by a user then the tag could still exist for that object to
 # other users who have that plugin enabled.
 
-# TODO: provide another function that returns (table, id) pairs that
-# this function can use so that we can expose that functionality
+## obj_class value -> the class it names, or None if it can't be found
+_classes = {}
+
+
+def _resolve_class(obj_class):
+    """return the class named by obj_class, None if it can't be imported
+
+    each name is resolved once.
+    """
+    try:
+        return _classes[obj_class]
+    except KeyError:
+        pass
+    module_name, part, cls_name = str(obj_class).rpartition('.')
+    try:
+        # __import__ "from_list" parameters has to be a list of strings
+        module = __import__(module_name, globals(), locals(),
+                            module_name.split('.')[1:])
+        cls = getattr(module, cls_name)
+    except (ImportError, ValueError, AttributeError), e:
+        logger.warning('Could not get the class %s: %s' % (obj_class, e))
+        cls = None
+    _classes[obj_class] = cls
+    return cls
+
+
 def _get_tagged_object_pairs(tag):
     """
     :param tag: a Tag instance
-    """
 
+    Return the list of the (class, id) pairs of the objects tagged by
+    tag, in tagging order, read without loading TaggedObj instances.
+    """
+    session = object_session(tag)
+    query = session.query(TaggedObj.obj_class, TaggedObj.obj_id).\
+        filter(TaggedObj.tag_id == tag.id).order_by(TaggedObj.id)
     kids = []
-    for obj in tag._objects:
-        try:
-            # __import__ "from_list" parameters has to be a list of strings
-            module_name, part, cls_name = str(obj.obj_class).rpartition('.')
-            module = __import__(module_name, globals(), locals(),
-                                module_name.split('.')[1:])
-            cls = getattr(module, cls_name)
-            kids.append((cls, obj.obj_id))
-        except KeyError, e:
-            logger.warning('KeyError -- tag.get_tagged_objects(%s): %s'
-                           % (tag, e))
-            continue
-        except DBAPIError, e:
-            logger.warning('DBAPIError -- tag.get_tagged_objects(%s): %s'
-                           % (tag, e))
-            continue
-        except AttributeError, e:
-            logger.warning('AttributeError -- tag.get_tagged_objects(%s): %s'
-                           % (tag, e))
-            logger.warning('Could not get the object for %s.%s(%s)'
-                           % (module_name, cls_name, obj.obj_id))
-            continue
-
+    for obj_class, obj_id in query:
+        cls = _resolve_class(obj_class)
+        if cls is not None:
+            kids.append((cls, obj_id))
     return kids
 
 
@@ -454,18 +612,47 @@ def create_named_empty_tag(name):
     return
 
 
+def _classname_of(cls):
+    """the classname stored in the tagged_obj table, for cls objects
+    """
+    return unicode('%s.%s' % (cls.__module__, cls.__name__))
+
+
+def _ids_by_class(objs):
+    """return the dictionary of the set of the ids of objs per class
+
+    classes keep the order of objs.  the ids of persistent objects come
+    from their identity, so that expired objects are not loaded again.
+    """
+    result = OrderedDict()
+    for obj in objs:
+        identity = inspect(obj).identity
+        obj_id = identity[0] if identity else obj.id
+        result.setdefault(type(obj), set()).add(obj_id)
+    return result
+
+
+def _tagged_clause(ids_by_class):
+    """the clause matching the tagged_obj rows of the objects in ids_by_class
+    """
+    table = TaggedObj.__table__
+    return or_(*[and_(table.c.obj_class == _classname_of(cls),
+                      db.in_ids(table.c.obj_id, ids))
+                 for cls, ids in ids_by_class.iteritems()])
+
+
 def untag_objects(name, objs):
     """
     Remove the tag name from objs.
 
+    the tagged_obj rows are removed with one DELETE statement, and
+    recorded in the history with one more.
+
     :param name: The name of the tag
     :type name: str
     :param objs: The list of objects to untag.
     :type objs: list
     """
-    # TODO: should we loop through objects in a tag to delete
-    # the TaggedObject or should we delete tags is they match
-    # the tag in TaggedObj.selectBy(obj_class=classname, obj_id=obj.id)
     name = utils.utf8(name)
     if not objs:
         create_named_empty_tag(name)
@@ -477,24 +664,24 @@ def untag_objects(name, objs):
         logger.info("%s - %s" % (type(e), e))
         logger.debug(traceback.format_exc())
         return
-    same = lambda x, y: x.obj_class == _classname(y) and x.obj_id == y.id
-    for obj in objs:
-        for kid in tag._objects:
-            if same(kid, obj):
-                o = session.query(type(kid)).filter_by(id=kid.id).one()
-                session.delete(o)
+    table = TaggedObj.__table__
+    clause = and_(table.c.tag_id == tag.id,
+                  _tagged_clause(_ids_by_class(objs)))
+    if not session.info.get(db.NO_HISTORY):
+        db.add_history(session, table, session.execute(
+            table.select().where(clause)).fetchall(), 'delete')
+    session.execute(table.delete().where(clause))
     session.commit()
-
-
-# create the classname stored in the tagged_obj table
-_classname = lambda x: unicode('%s.%s', 'utf-8') % (
-    type(x).__module__, type(x).__name__)
+    db.notify_change(table.name, 'delete')
 
 
 def tag_objects(name, objs):
     """
     Tag a list of objects.
 
+    the objects not yet tagged are tagged with one INSERT ... SELECT
+    statement per class, and the new rows are recorded in the history.
+
     :param name: The tag name, if it's a str object then it will be
       converted to unicode() using the default encoding. If a tag with
       this name doesn't exist it will be created
@@ -513,18 +700,37 @@ def tag_objects(name, objs):
         logger.debug("%s - %s" % (type(e), e))
         tag = Tag(tag=name)
         session.add(tag)
-    for obj in objs:
-        cls = and_(TaggedObj.obj_class == _classname(obj),
-                   TaggedObj.obj_id == obj.id,
-                   TaggedObj.tag_id == tag.id)
-        ntagged = session.query(TaggedObj).filter(cls).count()
-        if ntagged == 0:
-            tagged_obj = TaggedObj(obj_class=_classname(obj), obj_id=obj.id,
-                                   tag=tag)
-            session.add(tagged_obj)
+        session.flush()
+    table = TaggedObj.__table__
+    record = not session.info.get(db.NO_HISTORY)
+    inserted = []
+    for cls, ids in _ids_by_class(objs).iteritems():
+        source = cls.__table__
+        classname = _classname_of(cls)
+        # an anti-join, for the databases to use an index on tagged_obj
+        tagged = source.outerjoin(table, and_(
+            table.c.tag_id == tag.id, table.c.obj_class == classname,
+            table.c.obj_id == source.c.id))
+        missing = and_(db.in_ids(source.c.id, ids), table.c.id.is_(None))
+        if record:
+            # the ids of the rows to insert, to read them back afterwards
+            ids = [i for (i, ) in session.execute(
+                select([source.c.id], from_obj=tagged).where(missing))]
+            if not ids:
+                continue
+        untagged = select([source.c.id, literal(classname), literal(tag.id)],
+                          from_obj=tagged).where(missing)
+        session.execute(table.insert().from_select(
+            ['obj_id', 'obj_class', 'tag_id'], untagged))
+        if record:
+            inserted.extend(session.execute(table.select().where(and_(
+                table.c.tag_id == tag.id, table.c.obj_class == classname,
+                db.in_ids(table.c.obj_id, ids)))))
+    db.add_history(session, table, inserted, 'insert')
     # if a new tag is created with the name parameter it is always saved
     # regardless of whether the objects are tagged
     session.commit()
+    db.notify_change(table.name, 'insert')
 
 
 def get_tag_ids(objs):
@@ -533,26 +739,21 @@ def get_tag_ids(objs):
 
     Return a list of tag id's for tags associated with obj, only returns those
     tag ids that are common between all the objs
+
+    the intersection is computed in one grouped query.
     """
-    # TODO: this function does intersection in the most
-    # straightforward way and could probably do with some optimization
-    #clause = lambda x: and_(TaggedObj.obj_class==_classname(x),
-    #                        TaggedObj.obj_id==x.id)
-    #ors = or_(*map(clause, objs))
     if not objs:
         return []
     session = object_session(objs[0])
-    s = set()
-    tag_id_query = session.query(Tag.id).join('_objects')
-    for obj in objs:
-        clause = and_(TaggedObj.obj_class == _classname(obj),
-                      TaggedObj.obj_id == obj.id)
-        tags = [r[0] for r in tag_id_query.filter(clause)]
-        if len(s) == 0:
-            s.update(tags)
-        else:
-            s.intersection_update(tags)
-    return list(s)
+    ids_by_class = _ids_by_class(objs)
+    table = TaggedObj.__table__
+    # tagged_obj may hold the same object more than once per tag
+    tagged = func.count(distinct(table.c.obj_class + u'.' +
+                                 cast(table.c.obj_id, String)))
+    query = select([table.c.tag_id]).where(_tagged_clause(ids_by_class)).\
+        group_by(table.c.tag_id).\
+        having(tagged == sum(len(ids) for ids in ids_by_class.values()))
+    return [tag_id for (tag_id, ) in session.execute(query)]
 
 
 def _on_add_tag_activated(*args):
@@ -630,9 +831,19 @@ def _reset_tags_menu():
 
 
 class TagPlugin(pluginmgr.Plugin):
+    commands = [VacuumTagsCommandHandler]
 
     @classmethod
     def init(cls):
+        try:
+            created = upgrade()
+        except Exception, e:
+            # possibly the user may not create indexes
+            logger.warning('could not create the tagged_obj indexes: %s'
+                           % utils.utf8(e))
+        else:
+            if created:
+                logger.info('created indexes %s' % ', '.join(created))
         from bauble.view import SearchView
         from functools import partial
         mapper_search = search.get_strategy('MapperSearch')
@@ -20,15 +20,15 @@
 
 import os
 
-from sqlalchemy import or_
+from sqlalchemy import and_, or_
 #from sqlalchemy.exc import *
 
 from nose import SkipTest
 
 import bauble.plugins.tag as tag_plugin
-from bauble.plugins.plants import Family
+from bauble.plugins.plants import Family, Genus
 from bauble.plugins.tag import Tag, TagEditorPresenter
-from bauble.test import BaubleTestCase, check_dupids
+from bauble.test import BaubleTestCase, StatementCounter, check_dupids
 from bauble.editor import GenericEditorView
 
 
@@ -100,6 +100,183 @@ class TagTests(BaubleTestCase):
         tagged_objs = tag.objects
         self.assertEquals(tagged_objs, [])
 
+    def test_get_tagged_objects_one_query_per_class(self):
+        families = [Family(epithet=u'family%s' % i) for i in range(5)]
+        genera = [Genus(family=self.family, epithet=u'genus%s' % i)
+                  for i in range(3)]
+        self.session.add_all(families + genera)
+        self.session.commit()
+        tag_plugin.tag_objects('test', families + genera)
+        tag = self.session.query(Tag).filter_by(tag=u'test').one()
+        # the pairs, then one query per class
+        objects = self.assertMaxStatements(3, tag.get_tagged_objects)
+        self.assertEquals(objects, families + genera)
+
+    def test_get_tagged_counts(self):
+        genus = Genus(family=self.family, epithet=u'genus')
+        self.session.add(genus)
+        self.session.commit()
+        tag_plugin.tag_objects('test', [self.family, genus])
+        tag = self.session.query(Tag).filter_by(tag=u'test').one()
+        counts = self.assertMaxStatements(1, tag.get_tagged_counts)
+        self.assertEquals(counts, {Family: 1, Genus: 1})
+        first, second = tag.search_view_markup_pair()
+        self.assertTrue('tagging 2 objects of 2 different types' in first)
+
+    def test_bulk_tagging(self):
+        families = [Family(epithet=u'family%s' % i) for i in range(600)]
+        self.session.add_all(families)
+        self.session.commit()
+        tag_plugin.tag_objects('test', families[:300])
+        # tag lookup, untagged ids, one insert, new rows, history
+        self.assertMaxStatements(
+            5, tag_plugin.tag_objects, 'test', families)
+        table = tag_plugin.TaggedObj.__table__
+        rows = db.engine.execute(table.select()).fetchall()
+        self.assertEquals(sorted(r.obj_id for r in rows),
+                          sorted(f.id for f in families))
+        self.assertFalse([r for r in rows if r._created is None])
+        tag = self.session.query(Tag).filter_by(tag=u'test').one()
+        self.assertEquals(len(tag.objects), 600)
+
+        # tag lookup, rows, one delete, history
+        self.assertMaxStatements(
+            4, tag_plugin.untag_objects, 'test', families[100:])
+        self.assertEquals(tag.objects, families[:100])
+
+    def test_bulk_tagging_history(self):
+        family2 = Family(epithet=u'family2')
+        self.session.add(family2)
+        self.session.commit()
+        tag_plugin.tag_objects('test', [self.family])
+        tag_plugin.tag_objects('test', [self.family, family2])
+        tag_plugin.untag_objects('test', [family2])
+        history = db.History.__table__
+        entries = db.engine.execute(history.select().where(
+            history.c.table_name == u'tagged_obj').order_by(
+                history.c.id)).fetchall()
+        self.assertEquals([e.operation for e in entries],
+                          ['insert', 'insert', 'delete'])
+        self.assertEquals(entries[1].table_id, entries[2].table_id)
+        self.assertTrue("'obj_id': u'%s'" % family2.id in entries[1]['values'])
+        self.assertTrue("'tag_id'" in entries[2]['values'])
+        self.assertTrue(entries[2].user)
+
+        db.record_history(self.session, False)
+        tag_plugin.tag_objects('test', [family2])
+        self.assertEquals(db.engine.execute(history.count().where(
+            history.c.table_name == u'tagged_obj')).scalar(), 3)
+
+    def test_get_tag_ids_one_query(self):
+        family2 = Family(epithet=u'family2')
+        genus = Genus(family=self.family, epithet=u'genus')
+        self.session.add_all([family2, genus])
+        self.session.commit()
+        tag_plugin.tag_objects('test', [self.family, family2, genus])
+        tag_plugin.tag_objects('test', [self.family])  # no duplicates
+        tag_plugin.tag_objects('test2', [self.family, genus])
+        test, test2 = [self.session.query(Tag).filter_by(tag=t).one().id
+                       for t in (u'test', u'test2')]
+        ids = self.assertMaxStatements(
+            1, tag_plugin.get_tag_ids, [self.family, genus])
+        self.assertEquals(sorted(ids), sorted([test, test2]))
+        self.assertEquals(
+            tag_plugin.get_tag_ids([self.family, family2, genus]), [test])
+
+    def test_upgrade_creates_indexes(self):
+        from sqlalchemy import inspect
+        indexes = lambda: sorted(
+            i['name'] for i in inspect(db.engine).get_indexes('tagged_obj'))
+        self.assertEquals(indexes(), ['ix_tagged_obj_obj',
+                                      'ix_tagged_obj_tag_id'])
+        for name in indexes():
+            db.engine.execute('DROP INDEX %s' % name)
+        self.assertEquals(tag_plugin.upgrade(), ['ix_tagged_obj_obj',
+                                                 'ix_tagged_obj_tag_id'])
+        self.assertEquals(tag_plugin.upgrade(), [])
+        self.assertEquals(len(indexes()), 2)
+
+    def test_deleting_object_removes_its_tags(self):
+        family2 = Family(epithet=u'family2')
+        self.session.add(family2)
+        self.session.commit()
+        tag_plugin.tag_objects('test', [self.family, family2])
+        self.session.delete(family2)
+        self.session.commit()
+        table = tag_plugin.TaggedObj.__table__
+        self.assertEquals(
+            [r.obj_id for r in db.engine.execute(table.select())],
+            [self.family.id])
+
+    def test_deleted_objects_tags_removed_together(self):
+        families = [Family(epithet=u'family%s' % i) for i in range(5)]
+        genus = Genus(family=families[0], epithet=u'genus')
+        self.session.add_all(families + [genus])
+        self.session.commit()
+        tag_plugin.tag_objects('test', families[1:] + [genus])
+        for obj in families[2:] + [genus]:
+            self.session.delete(obj)
+        with StatementCounter() as statements:
+            self.session.commit()
+        self.assertEquals(len([s for s in statements
+                               if s.startswith('DELETE FROM tagged_obj')]), 1)
+        table = tag_plugin.TaggedObj.__table__
+        self.assertEquals(
+            [r.obj_id for r in db.engine.execute(table.select())],
+            [families[1].id])
+        history = db.History.__table__
+        self.assertEquals(db.engine.execute(history.count().where(and_(
+            history.c.table_name == u'tagged_obj',
+            history.c.operation == u'delete'))).scalar(), 4)
+
+    def test_vacuum(self):
+        family2 = Family(epithet=u'family2')
+        self.session.add(family2)
+        self.session.commit()
+        tag_plugin.tag_objects('test', [self.family, family2])
+        db.engine.execute(Family.__table__.delete().where(
+            Family.__table__.c.id == family2.id))
+        table = tag_plugin.TaggedObj.__table__
+        db.engine.execute(table.insert().values(
+            obj_class='bauble.plugins.plants.family.Family',
+            obj_id=self.family.id, tag_id=99))
+        self.assertEquals(tag_plugin.vacuum(remove=False),
+                          {'bauble.plugins.plants.family.Family': 2})
+        self.assertEquals(len(db.engine.execute(table.select()).fetchall()),
+                          3)
+        tag_plugin.vacuum()
+        self.assertEquals(
+            [(r.obj_id, r.tag_id)
+             for r in db.engine.execute(table.select())],
+            [(self.family.id, 1)])
+        self.assertEquals(tag_plugin.vacuum(), {})
+
+    def test_objects_cached_until_notified(self):
+        from bauble.plugins.garden import Location
+        family2 = Family(epithet=u'family2')
+        self.session.add(family2)
+        self.session.commit()
+        tag_plugin.tag_objects('test', [self.family])
+        tag = self.session.query(Tag).filter_by(tag=u'test').one()
+        self.assertEquals(tag.objects, [self.family])
+        # no history polling
+        self.assertMaxStatements(0, lambda: tag.objects)
+        # a change to an untagged class leaves the cache valid
+        self.session.add(Location(code=u'1'))
+        self.session.commit()
+        self.assertMaxStatements(0, lambda: tag.objects)
+        tag_plugin.tag_objects('test', [family2])
+        self.assertEquals(tag.objects, [self.family, family2])
+        # a change to a tagged class invalidates it
+        family2.epithet = u'family3'
+        self.session.commit()
+        with StatementCounter() as statements:
+            tag.objects
+        self.assertTrue(statements)
+        self.session.delete(family2)
+        self.session.commit()
+        self.assertEquals(tag.objects, [self.family])
+
     def test_get_tag_ids(self):
         family2 = Family(epithet=u'family2')
         self.session.add(family2)
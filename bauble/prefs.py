@@ -119,6 +119,31 @@ complete content of your log file.
 Values: True, False (Default: False)
 """
 
+pool_size_pref = 'bauble.db.pool_size'
+"""
+The preferences key for the number of connections kept open to a
+database server, such as PostgreSQL.
+
+Values: a positive integer (Default: 5)
+"""
+
+max_overflow_pref = 'bauble.db.max_overflow'
+"""
+The preferences key for the number of connections to a database server
+which may be opened beyond the pool size, and are closed when given back.
+
+Values: a non negative integer (Default: 10)
+"""
+
+sqlite_wal_pref = 'bauble.db.sqlite_wal'
+"""
+The preferences key to determine whether SQLite database files are used
+in write-ahead-log mode, letting the background threads read while the
+interface writes.  Disable it for files on network shares.
+
+Values: True, False (Default: True)
+"""
+
 
 from ConfigParser import RawConfigParser
 
@@ -19,6 +19,7 @@
 # along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
 
 
+import time
 import weakref
 
 import gtk
@@ -27,16 +28,19 @@ import logging
 logger = logging.getLogger(__name__)
 #logger.setLevel(logging.DEBUG)
 
-from sqlalchemy import or_, and_
+from sqlalchemy import event, or_, and_, false, func, inspect
 from sqlalchemy import Unicode
 from sqlalchemy import UnicodeText
-from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm import aliased, class_mapper, joinedload
 from sqlalchemy.orm.properties import (
     ColumnProperty, RelationshipProperty)
 RelationProperty = RelationshipProperty
 
 import bauble
+import bauble.db as db
 from bauble.error import check
+import bauble.pluginmgr as pluginmgr
+import bauble.textindex as textindex
 import bauble.utils as utils
 from bauble.i18n import _
 
@@ -49,6 +53,22 @@ def search(text, session=None):
     return list(results)
 
 
+def search_pairs(text, session=None):
+    """like search, returning the (class, id) pairs of the results
+
+    the strategies implementing search_pairs do not load the objects.
+    """
+    results = set()
+    for strategy in _search_strategies.values():
+        logger.debug("applying search strategy %s" % strategy)
+        if hasattr(strategy, 'search_pairs'):
+            results.update(strategy.search_pairs(text, session))
+        else:
+            results.update((type(i), i.id)
+                           for i in strategy.search(text, session) or [])
+    return list(results)
+
+
 class NoneToken(object):
     def __init__(self, t):
         pass
@@ -123,15 +143,19 @@ class TypedValueToken(ValueABC):
     def __init__(self, t):
         logger.debug('constructing typedvaluetoken %s' % str(t))
         try:
-            constructor, converter = self.constructor[t[1]]
+            self.function, converter = self.constructor[t[1]]
         except KeyError:
             return
-        params = tuple(converter(i) for i in t[3].express())
-        self.value = constructor(*params)
+        self.params = tuple(converter(i) for i in t[3].express())
 
     def __repr__(self):
         return "%s" % (self.value)
 
+    @property
+    def value(self):
+        # computed at each invocation, parsed statements are cached
+        return self.function(*self.params)
+
 
 class IdentifierToken(object):
     def __init__(self, t):
@@ -141,29 +165,15 @@ class IdentifierToken(object):
     def __repr__(self):
         return '.'.join(self.value)
 
-    def evaluate(self, env):
-        """return pair (query, attribute)
+    def clause(self, planner):
+        """return pair (attribute, wrap)
 
-        the value associated to the identifier is an altered query where the
-        joinpoint is the one relative to the attribute, and the attribute
-        itself.
+        the attribute the identifier refers to, and the function putting
+        a clause on it in the EXISTS subqueries of its to-many relations,
+        see QueryPlanner.resolve.
         """
 
-        query = env.session.query(env.domain)
-        if len(self.value) == 1:
-            # identifier is an attribute of the table being queried
-            cls = env.domain
-        elif len(self.value) > 1:
-            # identifier is an attribute of a joined table
-            query = query.join(*self.value[:-1], aliased=True)
-            cls = query._joinpoint['_joinpoint_entity']
-        attr = getattr(cls, self.value[-1])
-        logger.debug('IdentifierToken for %s, %s evaluates to %s'
-                     % (cls, self.value[-1], attr))
-        return query, attr
-
-    def needs_join(self, env):
-        return self.value[:-1]
+        return planner.resolve(self.value)
 
 
 class IdentExpression(object):
@@ -200,28 +210,24 @@ class IdentExpression(object):
     def __repr__(self):
         return "(%s %s %s)" % (self.operands[0], self.op, self.operands[1])
 
-    def evaluate(self, env):
-        q, a = self.operands[0].evaluate(env)
+    def clause(self, planner):
+        a, wrap = self.operands[0].clause(planner)
         if self.operands[1].express() == set():
             # check against the empty set
             if self.op in ('is', '=', '=='):
-                return q.filter(~a.any())
+                return wrap(~a.any())
             elif self.op in ('not', '<>', '!='):
-                return q.filter(a.any())
-        clause = lambda x: self.operation(a, x)
+                return wrap(a.any())
         logger.debug('filtering on %s(%s)' % (type(a), a))
-        return q.filter(clause(self.operands[1].express()))
-
-    def needs_join(self, env):
-        return [self.operands[0].needs_join(env)]
+        return wrap(self.operation(a, self.operands[1].express()))
 
 
 class ElementSetExpression(IdentExpression):
     # currently only implements `in`
 
-    def evaluate(self, env):
-        q, a = self.operands[0].evaluate(env)
-        return q.filter(a.in_(self.operands[1].express()))
+    def clause(self, planner):
+        a, wrap = self.operands[0].clause(planner)
+        return wrap(a.in_(self.operands[1].express()))
 
 
 class AggregatedExpression(IdentExpression):
@@ -236,21 +242,13 @@ class AggregatedExpression(IdentExpression):
         super(AggregatedExpression, self).__init__(t)
         logger.debug('AggregatedExpression::__init__(%s)' % t)
 
-    def evaluate(self, env):
+    def clause(self, planner):
         # operands[0] is the function/identifier pair
         # operands[1] is the value against which to test
         # operation implements the clause
-        q, a = self.operands[0].identifier.evaluate(env)
-        from sqlalchemy.sql import func
         f = getattr(func, self.operands[0].function)
-        clause = lambda x: self.operation(f(a), x)
-        # group by main ID
-        # apply having
-        main_table = q.column_descriptions[0]['type']
-        mta = getattr(main_table, 'id')
-        logger.debug('filtering on %s(%s)' % (type(mta), mta))
-        result = q.group_by(mta).having(clause(self.operands[1].express()))
-        return result
+        aggregated = planner.aggregate(f, self.operands[0].identifier.value)
+        return self.operation(aggregated, self.operands[1].express())
 
 
 class BetweenExpressionAction(object):
@@ -260,15 +258,10 @@ class BetweenExpressionAction(object):
     def __repr__(self):
         return "(BETWEEN %s %s %s)" % tuple(self.operands)
 
-    def evaluate(self, env):
-        q, a = self.operands[0].evaluate(env)
-        clause_low = lambda low: low <= a
-        clause_high = lambda high: a <= high
-        return q.filter(and_(clause_low(self.operands[1].express()),
-                             clause_high(self.operands[2].express())))
-
-    def needs_join(self, env):
-        return [self.operands[0].needs_join(env)]
+    def clause(self, planner):
+        a, wrap = self.operands[0].clause(planner)
+        return wrap(and_(self.operands[1].express() <= a,
+                         a <= self.operands[2].express()))
 
 
 class UnaryLogical(object):
@@ -279,9 +272,6 @@ class UnaryLogical(object):
     def __repr__(self):
         return "%s %s" % (self.name, str(self.operand))
 
-    def needs_join(self, env):
-        return self.operand.needs_join(env)
-
 
 class BinaryLogical(object):
     ## abstract base class. `name` is defined in derived classes
@@ -292,39 +282,27 @@ class BinaryLogical(object):
     def __repr__(self):
         return "(%s %s %s)" % (self.operands[0], self.name, self.operands[1])
 
-    def needs_join(self, env):
-        return self.operands[0].needs_join(env) + \
-            self.operands[1].needs_join(env)
-
 
 class SearchAndAction(BinaryLogical):
     name = 'AND'
 
-    def evaluate(self, env):
-        result = self.operands[0].evaluate(env)
-        for i in self.operands[1:]:
-            result = result.intersect(i.evaluate(env))
-        return result
+    def clause(self, planner):
+        return and_(*[i.clause(planner) for i in self.operands])
 
 
 class SearchOrAction(BinaryLogical):
     name = 'OR'
 
-    def evaluate(self, env):
-        result = self.operands[0].evaluate(env)
-        for i in self.operands[1:]:
-            result = result.union(i.evaluate(env))
-        return result
+    def clause(self, planner):
+        return or_(*[i.clause(planner) for i in self.operands])
 
 
 class SearchNotAction(UnaryLogical):
     name = 'NOT'
 
-    def evaluate(self, env):
-        q = env.session.query(env.domain)
-        for i in env.domains:
-            q.join(*i)
-        return q.except_(self.operand.evaluate(env))
+    def clause(self, planner):
+        # an object not matching the operand, also when this is NULL
+        return ~func.coalesce(self.operand.clause(planner), false())
 
 
 class ParenthesisedQuery(object):
@@ -334,11 +312,110 @@ class ParenthesisedQuery(object):
     def __repr__(self):
         return "(%s)" % self.query.__repr__()
 
-    def evaluate(self, env):
-        return self.query.evaluate(env)
+    def clause(self, planner):
+        return self.query.clause(planner)
+
 
-    def needs_join(self, env):
-        return self.query.needs_join(env)
+class QueryEnvironment(object):
+    """the state of one QueryAction invocation
+
+    it is the `env` passed to the `evaluate` methods of the filter, so
+    that the parsed statement is left untouched and can be invoked
+    again.
+    """
+
+    def __init__(self, search_strategy, domain):
+        self.search_strategy = search_strategy
+        self.session = search_strategy._session
+        self.domain = domain
+
+
+class QueryPlanner(object):
+    """compile the filter of a query into one SELECT on its domain
+
+    predicates are combined by AND, OR and NOT in the WHERE clause.
+    identifiers share their joins: each path of to-one relations is
+    outer joined once, however many predicates use it.  to-many
+    relations become EXISTS subqueries, one per predicate, so that a
+    predicate holds for an object if it holds for any of its related
+    objects.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self.query = env.session.query(env.domain)
+        self.aliases = {}  # path of to-one relations -> joined alias
+
+    def resolve(self, path):
+        """return pair (attribute, wrap) for the identifier path
+
+        the leading to-one relations of path are joined to the query,
+        wrap(clause) puts clause in the EXISTS subqueries of the other
+        relations.
+        """
+
+        entity = self.env.domain
+        relations = list(path[:-1])
+        prefix = ()
+        while relations and not self._property(entity, relations[0]).uselist:
+            name = relations.pop(0)
+            prefix += (name, )
+            if prefix not in self.aliases:
+                alias = aliased(self._property(entity, name).mapper.class_)
+                self.query = self.query.outerjoin(alias,
+                                                  getattr(entity, name))
+                self.aliases[prefix] = alias
+            entity = self.aliases[prefix]
+        steps = []
+        for name in relations:
+            # aliased, not to be correlated to the enclosing tables
+            target = aliased(self._property(entity, name).mapper.class_)
+            steps.append(getattr(entity, name).of_type(target))
+            entity = target
+        attr = getattr(entity, path[-1])
+        logger.debug('identifier %s resolves to %s' % ('.'.join(path), attr))
+
+        def wrap(clause):
+            for step in reversed(steps):
+                if step.property.uselist:
+                    clause = step.any(clause)
+                else:
+                    clause = step.has(clause)
+            return clause
+        return attr, wrap
+
+    def aggregate(self, f, path):
+        """return f of the path attribute over the related objects
+
+        a scalar subquery, correlated to the domain.
+        """
+
+        domain = self.env.domain
+        outer = aliased(domain)
+        query = self.env.session.query(outer).join(*path[:-1], aliased=True)
+        attr = getattr(query._joinpoint['_joinpoint_entity'], path[-1])
+        return query.with_entities(f(attr)).filter(
+            outer.id == domain.id).correlate(domain).as_scalar()
+
+    @staticmethod
+    def _property(entity, name):
+        return inspect(entity).mapper.get_property(name)
+
+    def plan(self, filter):
+        """return the query selecting the domain objects matching filter
+        """
+
+        clause = filter.clause(self)  # joins as it goes
+        return self.query.filter(clause)
+
+
+def id_pairs(query):
+    """return the set of the (class, id) pairs of the objects of query
+
+    only the ids are selected, the objects are not loaded.
+    """
+    cls = query.column_descriptions[0]['entity']
+    return set((cls, id) for (id, ) in query.with_entities(cls.id))
 
 
 class QueryAction(object):
@@ -349,6 +426,23 @@ class QueryAction(object):
     def __repr__(self):
         return "SELECT * FROM %s WHERE %s" % (self.domain, self.filter)
 
+    def query(self, search_strategy):
+        """return the query of the statement, None without a session
+        """
+        logger.debug('QueryAction:query - %s(%s) %s(%s)' %
+                     (type(self.domain), self.domain,
+                      type(self.filter), self.filter))
+        domain = self.domain
+        check(domain in search_strategy._domains or
+              domain in search_strategy._shorthand,
+              'Unknown search domain: %s' % domain)
+        domain = search_strategy._shorthand.get(domain, domain)
+        env = QueryEnvironment(search_strategy,
+                               search_strategy._domains[domain][0])
+        if env.session is None:
+            return None
+        return QueryPlanner(env).plan(self.filter)
+
     def invoke(self, search_strategy):
         """
         update search_strategy object with statement results
@@ -359,34 +453,30 @@ class QueryAction(object):
         use ilike but this would raise an error on SQLite.
         """
 
-        logger.debug('QueryAction:invoke - %s(%s) %s(%s)' %
-                     (type(self.domain), self.domain,
-                      type(self.filter), self.filter))
-        domain = self.domain
-        check(domain in search_strategy._domains or
-              domain in search_strategy._shorthand,
-              'Unknown search domain: %s' % domain)
-        self.domain = search_strategy._shorthand.get(domain, domain)
-        self.domain = search_strategy._domains[domain][0]
-        self.search_strategy = search_strategy
-
         result = set()
-        if search_strategy._session is not None:
-            self.domains = self.filter.needs_join(self)
-            self.session = search_strategy._session
-            records = self.filter.evaluate(self).all()
-            result.update(records)
+        query = self.query(search_strategy)
+        if query is not None:
+            result.update(query.all())
 
         if None in result:
             logger.warn('removing None from result set')
             result = set(i for i in result if i is not None)
         return result
 
+    def pairs(self, search_strategy):
+        """the (class, id) pairs of the statement results
+        """
+        query = self.query(search_strategy)
+        if query is None:
+            return set()
+        return id_pairs(query)
+
 
 class StatementAction(object):
     def __init__(self, t):
         self.content = t[0]
         self.invoke = lambda x: self.content.invoke(x)
+        self.pairs = lambda x: self.content.pairs(x)
 
     def __repr__(self):
         return repr(self.content)
@@ -405,20 +495,52 @@ class BinomialNameAction(object):
     def __repr__(self):
         return "%s %s" % (self.genus_epithet, self.species_epithet)
 
-    def invoke(self, search_strategy):
-        logger.debug('BinomialNameAction:invoke')
+    def query(self, search_strategy):
         from bauble.plugins.plants.genus import Genus
         from bauble.plugins.plants.species import Species
-        result = search_strategy._session.query(Species).filter(
+        return search_strategy._session.query(Species).filter(
             Species.sp.startswith(self.species_epithet)).join(Genus).filter(
-            Genus.genus.startswith(self.genus_epithet)).all()
-        result = set(result)
+            Genus.genus.startswith(self.genus_epithet))
+
+    def pairs(self, search_strategy):
+        return id_pairs(self.query(search_strategy))
+
+    def invoke(self, search_strategy):
+        logger.debug('BinomialNameAction:invoke')
+        result = set(self.query(search_strategy).all())
         if None in result:
             logger.warn('removing None from result set')
             result = set(i for i in result if i is not None)
         return result
 
 
+def compile_domain_query(query, mapper, properties, condition, values,
+                         use_union=False):
+    """restrict query to objects matching any of the property/value pairs
+
+    `condition(col)(val)` is the clause testing column `col` against
+    `val`.  the returned query is a single statement, so that each
+    matching object is hydrated exactly once: either the disjunction
+    of all property/value clauses, or, if `use_union` is set, a test
+    of the primary key against the UNION of one id-only subselect per
+    property.
+    """
+    values = list(values)
+    if not use_union:
+        return query.filter(or_(*[condition(col)(val)
+                                  for col in properties
+                                  for val in values]))
+    from sqlalchemy import select, union
+    pk = mapper.primary_key[0]
+    subselects = [select([pk]).where(or_(*map(condition(col), values)))
+                  for col in properties]
+    if len(subselects) == 1:
+        ids = subselects[0]
+    else:
+        ids = union(*subselects)
+    return query.filter(pk.in_(ids))
+
+
 class DomainExpressionAction(object):
     """created when the parser hits a domain_expression token.
 
@@ -429,6 +551,10 @@ class DomainExpressionAction(object):
     the value.
     """
 
+    ## compile to a UNION of id-only subselects instead of a single OR,
+    ## see compile_domain_query
+    use_union = False
+
     def __init__(self, t):
         self.domain = t[0]
         self.cond = t[1]
@@ -437,14 +563,12 @@ class DomainExpressionAction(object):
     def __repr__(self):
         return "%s %s %s" % (self.domain, self.cond, self.values)
 
-    def invoke(self, search_strategy):
-        logger.debug('DomainExpressionAction:invoke')
+    def query(self, search_strategy):
+        domain = search_strategy._shorthand.get(self.domain, self.domain)
         try:
-            if self.domain in search_strategy._shorthand:
-                self.domain = search_strategy._shorthand[self.domain]
-            cls, properties = search_strategy._domains[self.domain]
+            cls, properties = search_strategy._domains[domain]
         except KeyError:
-            raise KeyError(_('Unknown search domain: %s') % self.domain)
+            raise KeyError(_('Unknown search domain: %s') % domain)
 
         query = search_strategy._session.query(cls)
 
@@ -452,21 +576,18 @@ class DomainExpressionAction(object):
         ## domain values. each domain class should define its own 'I have
         ## accessions' filter. see issue #42
 
-        result = set()
-
         # select all objects from the domain
         if self.values == '*':
-            result.update(query.all())
-            return result
+            return query
 
         mapper = class_mapper(cls)
 
         if self.cond in ('like', 'ilike'):
             condition = lambda col: \
-                lambda val: utils.ilike(mapper.c[col], '%s' % val)
+                lambda val: textindex.ilike(mapper.c[col], '%s' % val)
         elif self.cond in ('contains', 'icontains', 'has', 'ihas'):
             condition = lambda col: \
-                lambda val: utils.ilike(mapper.c[col], '%%%s%%' % val)
+                lambda val: textindex.ilike(mapper.c[col], '%%%s%%' % val)
         elif self.cond == '=':
             condition = lambda col: \
                 lambda val: mapper.c[col] == utils.utf8(val)
@@ -474,9 +595,16 @@ class DomainExpressionAction(object):
             condition = lambda col: \
                 lambda val: mapper.c[col].op(self.cond)(val)
 
-        for col in properties:
-            ors = or_(*map(condition(col), self.values.express()))
-            result.update(query.filter(ors).all())
+        return compile_domain_query(query, mapper, properties, condition,
+                                    self.values.express(),
+                                    use_union=self.use_union)
+
+    def pairs(self, search_strategy):
+        return id_pairs(self.query(search_strategy))
+
+    def invoke(self, search_strategy):
+        logger.debug('DomainExpressionAction:invoke')
+        result = set(self.query(search_strategy).all())
 
         if None in result:
             logger.warn('removing None from result set')
@@ -494,21 +622,6 @@ class AggregatingAction(object):
     def __repr__(self):
         return "(%s %s)" % (self.function, self.identifier)
 
-    def needs_join(self, env):
-        return [self.identifier.needs_join(env)]
-
-    def evaluate(self, env):
-        """return pair (query, attribute)
-
-        let the identifier compute the query and its attribute, we do
-        not need alter anything right now since the condition on the
-        aggregated identifier is applied in the HAVING and not in the
-        WHERE.
-
-        """
-
-        return self.identifier.evaluate(env)
-
 
 class ValueListAction(object):
 
@@ -532,41 +645,35 @@ class ValueListAction(object):
         """
 
         logger.debug('ValueListAction:invoke')
-        # make searches case-insensitive, in postgres use ilike,
-        # in other use upper()
-        like = lambda table, col, val: \
-            utils.ilike(table.c[col], ('%%%s%%' % val))
+        return self._results(search_strategy, False)
+
+    def pairs(self, search_strategy):
+        """the (class, id) pairs of the results
+
+        only the objects of classes with a `replacement` are loaded.
+        """
+        return self._results(search_strategy, True)
+
+    def _results(self, search_strategy, as_pairs):
+        session = search_strategy._session
+        classes, ids = value_search_ids(
+            session, search_strategy._properties, self.express())
 
         result = set()
-        for cls, columns in search_strategy._properties.iteritems():
-            column_cross_value = [(c, v) for c in columns
-                                  for v in self.express()]
-            # as of SQLAlchemy>=0.4.2 we convert the value to a unicode
-            # object if the col is a Unicode or UnicodeText column in order
-            # to avoid the "Unicode type received non-unicode bind param"
-
-            def unicol(col, v):
-                table = class_mapper(cls)
-                if isinstance(table.c[col].type, (Unicode, UnicodeText)):
-                    return unicode(v)
-                else:
-                    return v
-
-            table = class_mapper(cls)
-            q = search_strategy._session.query(cls)  # prepares SELECT
-            q = q.filter(or_(*[like(table, c, unicol(c, v))
-                               for c, v in column_cross_value]))
-            result.update(q.all())
-
-        def replace(i):
-            try:
-                replacement = i.replacement()
-                logger.debug('replacing %s by %s in result set' %
-                             (i, replacement))
-                return replacement
-            except:
-                return i
-        result = set([replace(i) for i in result])
+        for tag, cls_ids in ids.iteritems():
+            cls = classes[tag]
+            if as_pairs and not hasattr(cls, 'replacement'):
+                result.update((cls, i) for i in cls_ids)
+                continue
+            relation = getattr(cls, 'replacement_relation', None)
+            options = relation and [joinedload(relation)] or []
+            objs = db.load_by_ids(session, cls, cls_ids, options)
+            if hasattr(cls, 'replacement'):
+                logger.debug('replacing %s objects in result set' % cls)
+                objs = [i.replacement() for i in objs]
+            if as_pairs:
+                objs = [(type(i), i.id) for i in objs if i is not None]
+            result.update(objs)
         logger.debug("result is now %s" % result)
         if None in result:
             logger.warn('removing None from result set')
@@ -574,12 +681,60 @@ class ValueListAction(object):
         return result
 
 
+def value_search_ids(session, properties, values):
+    """look for values in all registered properties, in one statement
+
+    `properties` maps classes to the list of their columns to search,
+    as in MapperSearch._properties.  the statement is a UNION ALL of
+    one `(class_tag, id)` SELECT per class, matching objects with any
+    column containing any of the values, case insensitively.
+
+    return the pair `classes, ids`, where `classes` is the list of
+    classes indexed by class_tag, and `ids` maps each class_tag to the
+    set of the matching ids.
+    """
+    from sqlalchemy import literal_column, select, union_all
+
+    def unicol(column, v):
+        # as of SQLAlchemy>=0.4.2 we convert the value to a unicode
+        # object if the col is a Unicode or UnicodeText column in order
+        # to avoid the "Unicode type received non-unicode bind param"
+        if isinstance(column.type, (Unicode, UnicodeText)):
+            return unicode(v)
+        return v
+
+    # make searches case-insensitive, in postgres use ilike,
+    # in other use upper(), or the trigram index if there is one
+    like = lambda column, val: \
+        textindex.ilike(column, ('%%%s%%' % unicol(column, val)))
+
+    classes = []
+    selects = []
+    for cls, columns in properties.iteritems():
+        mapper = class_mapper(cls)
+        clause = or_(*[like(mapper.c[c], v)
+                       for c in columns for v in values])
+        selects.append(
+            select([literal_column(str(len(classes))).label('class_tag'),
+                    mapper.primary_key[0].label('id')]).where(clause))
+        classes.append(cls)
+
+    ids = {}
+    if not selects:
+        return classes, ids
+    for tag, id in session.execute(union_all(*selects)):
+        ids.setdefault(tag, set()).add(id)
+    return classes, ids
+
+
 from pyparsing import (
     Word, alphas8bit, removeQuotes, delimitedList, Regex,
     OneOrMore, oneOf, alphas, alphanums, Group, Literal,
     CaselessLiteral, WordStart, WordEnd, srange,
     stringEnd, Keyword, quotedString,
-    infixNotation, opAssoc, Forward)
+    infixNotation, opAssoc, Forward, ParserElement)
+
+ParserElement.enablePackrat()
 
 wordStart, wordEnd = WordStart(), WordEnd()
 
@@ -672,15 +827,33 @@ class SearchParser(object):
                  | value_list('value_list')
                  ).setParseAction(StatementAction)('statement')
 
+    def __init__(self, cache_size=64):
+        self.cache = utils.Cache(cache_size)
+        self.hits = 0
+        self.misses = 0
+
     def parse_string(self, text):
         '''request pyparsing object to parse text
 
         `text` can be either a query, or a domain expression, or a list of
         values. the `self.statement` pyparsing object parses the input text
         and return a pyparsing.ParseResults object that represents the input
+
+        parsed texts are kept in a LRU cache, keyed on the stripped text,
+        `hits` and `misses` count how often the cache was useful.  the
+        returned object is shared: it must not be altered.
         '''
 
-        return self.statement.parseString(text)
+        text = text.strip()
+
+        def parse():
+            self.misses += 1
+            return self.statement.parseString(text)
+
+        def hit(value):
+            self.hits += 1
+
+        return self.cache.get(text, parse, on_hit=hit)
 
 
 class SearchStrategy(object):
@@ -700,6 +873,105 @@ class SearchStrategy(object):
         pass
 
 
+class ResultCache(object):
+    """search results, as lists of `(class, id)` pairs
+
+    entries are keyed on the query text and the database URI.  each
+    entry remembers the tables read while computing it, and is dropped
+    as soon as db.HistoryExtension notifies a change to any of them.
+    changes made by other clients of the same database are not
+    notified, so entries also expire after `max_age` seconds.
+    """
+
+    def __init__(self, size=32, max_age=300):
+        self.cache = utils.Cache(size)
+        self.max_age = max_age
+        self.keys = {}  # table name -> keys of the entries reading it
+        self.engine = None
+        self.hits = 0
+        self.misses = 0
+        db.add_change_listener(self.on_change)
+
+    def get(self, key):
+        """return the cached pairs for key, or None
+        """
+        if self.engine is not db.engine:
+            # the database was opened again, maybe at the same URI
+            self.clear()
+            self.engine = db.engine
+        entry = self.cache.storage.get(key)
+        if entry is not None and time.time() - entry[1][0] > self.max_age:
+            del self.cache.storage[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.cache.get(key, None)[1]
+
+    def put(self, key, pairs, tables):
+        """store the (class, id) pairs for key, depending on the tables
+        """
+        pairs = list(pairs)
+        self.cache.storage.pop(key, None)
+        self.cache.get(key, lambda: (time.time(), pairs))
+        for table in tables:
+            self.keys.setdefault(table, set()).add(key)
+
+    def on_change(self, table_name, operation):
+        for key in self.keys.pop(table_name, ()):
+            self.cache.storage.pop(key, None)
+
+    def clear(self):
+        self.cache.storage.clear()
+        self.keys.clear()
+
+
+class TableRecorder(object):
+    """context manager collecting the names of the tables read
+
+    all statements executed by the engine while in the context are
+    considered, not only those executed by the current thread.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.tables = set()
+
+    def record(self, conn, clauseelement, multiparams, params):
+        from sqlalchemy.sql import ClauseElement, visitors
+        if isinstance(clauseelement, ClauseElement):
+            visitors.traverse(clauseelement, {},
+                              {'table': lambda t: self.tables.add(t.name)})
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_execute', self.record)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_execute', self.record)
+
+
+def hydrate(session, pairs):
+    """return the set of objects for the (class, id) pairs
+
+    objects in the session identity map are used as they are, the
+    others are loaded with one query per class.
+    """
+    from sqlalchemy.orm.util import identity_key
+    result = set()
+    missing = {}
+    for cls, id in pairs:
+        obj = session.identity_map.get(identity_key(cls, id))
+        if obj is None:
+            missing.setdefault(cls, []).append(id)
+        else:
+            result.add(obj)
+    for cls, ids in missing.iteritems():
+        result.update(db.load_by_ids(session, cls, ids))
+    return result
+
+
 class MapperSearch(SearchStrategy):
 
     """
@@ -715,6 +987,7 @@ class MapperSearch(SearchStrategy):
     _domains = {}
     _shorthand = {}
     _properties = {}
+    result_cache = ResultCache()
 
     def __init__(self):
         super(MapperSearch, self).__init__()
@@ -772,15 +1045,49 @@ class MapperSearch(SearchStrategy):
         self._session = session
 
         self._results.clear()
+        key = text.strip(), str(db.engine.url)
+        pairs = None
+        if session is not None:
+            pairs = self.result_cache.get(key)
+        if pairs is not None:
+            logger.debug('search results for "%s" from cache' % text)
+            self._results.update(hydrate(session, pairs))
+            return self._results
         statement = self.parser.parse_string(text.decode()).statement
         logger.debug("statement : %s(%s)" % (type(statement), statement))
-        self._results.update(statement.invoke(self))
+        with TableRecorder(db.engine) as recorder:
+            self._results.update(statement.invoke(self))
+        if session is not None:
+            self.result_cache.put(
+                key, [(type(i), i.id) for i in self._results],
+                recorder.tables)
         logger.debug('search returns %s(%s)'
                      % (type(self._results), self._results))
 
         # these _results get filled in when the parse actions are called
         return self._results
 
+    def search_pairs(self, text, session=None):
+        """
+        Returns the set of the (class, id) pairs of the database hits for
+        the text search string, without loading the objects.
+        """
+        self._session = session
+        key = text.strip(), str(db.engine.url)
+        pairs = None
+        if session is not None:
+            pairs = self.result_cache.get(key)
+        if pairs is not None:
+            logger.debug('search results for "%s" from cache' % text)
+            return set(pairs)
+        statement = self.parser.parse_string(text.decode()).statement
+        logger.debug("statement : %s(%s)" % (type(statement), statement))
+        with TableRecorder(db.engine) as recorder:
+            pairs = statement.pairs(self)
+        if session is not None:
+            self.result_cache.put(key, pairs, recorder.tables)
+        return pairs
+
 
 ## list of search strategies to be tried on each search string
 _search_strategies = {'MapperSearch': MapperSearch()}
@@ -795,6 +1102,46 @@ def get_strategy(name):
     return _search_strategies.get(name, None)
 
 
+def explain(text, session=None):
+    """search for text, and return the SQL statements executed
+
+    return the list of the (statement, parameters, seconds) triples, also
+    logged.  the cached search results are dropped first, so that the
+    statements are actually executed.
+    """
+    MapperSearch.result_cache.clear()
+    with db.StatementRecorder() as recorder:
+        search(text, session)
+    statements = zip(recorder.statements, recorder.parameters,
+                     recorder.timings)
+    for statement, parameters, seconds in statements:
+        logger.info('explain: %.4fs %s %s' % (seconds, statement, parameters))
+    return statements
+
+
+class ExplainCommandHandler(pluginmgr.CommandHandler):
+
+    command = 'explain'
+
+    def __call__(self, cmd, arg):
+        session = db.Session()
+        try:
+            statements = explain(arg, session)
+        finally:
+            session.close()
+        details = '\n\n'.join('-- %.4f seconds\n%s\n%s' % (
+            seconds, statement, parameters)
+            for statement, parameters, seconds in statements)
+        utils.message_details_dialog(
+            _('%(count)d statements, %(seconds).4f seconds') % {
+                'count': len(statements),
+                'seconds': sum(i[2] for i in statements)},
+            details)
+
+
+pluginmgr.register_command(ExplainCommandHandler)
+
+
 class SchemaBrowser(gtk.VBox):
 
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+"""
+Persisted natural sort keys.
+
+:func:`bauble.db.natsort_key` computes the key of an object from its
+string, and the string of a Species or a Plant walks relations.  This
+module stores the keys of the registered classes in an indexed
+`_natsort` column of their tables, so that:
+
+* :func:`bauble.db.natsort` sorts relations in SQL, by `ORDER BY`;
+* the search view gets the keys of its results with one query.
+
+The column is optional, it is added and filled by the `sortkeys`
+command, and used only once it exists.  As long as it exists, it is
+kept up to date on each insert and update of a registered object, and
+of the objects whose string depends on it.  Rows inserted bypassing
+the ORM get their key at the next `sortkeys` command.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+#logger.setLevel(logging.DEBUG)
+
+import sqlalchemy as sa
+from sqlalchemy.orm import class_mapper, object_session, sessionmaker
+
+import bauble.db as db
+import bauble.pluginmgr as pluginmgr
+import bauble.utils as utils
+
+COLUMN = '_natsort'
+
+## registered class -> names of the relations leading to the objects
+## whose string depends on it.
+_registered = {}
+
+## names of the tables having the COLUMN, per engine; see persisted.
+_persisted = set()
+_persisted_engine = None
+
+
+def _forget(*args, **kwargs):
+    global _persisted_engine
+    _persisted_engine = None
+
+
+## tables created again have no key column
+sa.event.listen(db.metadata, 'after_create', _forget)
+
+
+def register(cls, dependents=()):
+    """have the natural sort keys of the cls objects persisted
+
+    :param dependents: the names of the relations from a cls object to
+      the objects whose string, and key, depend on it.
+    """
+    if cls in _registered:
+        return
+    _registered[cls] = tuple(dependents)
+    db.set_natsort_dependents(cls, dependents)
+    sa.event.listen(cls, 'after_insert', _after_change)
+    sa.event.listen(cls, 'after_update', _after_change)
+
+
+def persisted(engine=None):
+    """return the set of the names of the tables with persisted keys
+
+    the result is cached per engine, and refreshed by build() and drop().
+    """
+    global _persisted, _persisted_engine
+    engine = engine or db.engine
+    if engine is _persisted_engine:
+        return _persisted
+    _persisted = set()
+    _persisted_engine = engine
+    inspector = sa.inspect(engine)
+    for cls in _registered:
+        table = cls.__table__.name
+        try:
+            columns = inspector.get_columns(table)
+        except sa.exc.NoSuchTableError:
+            continue
+        if COLUMN in [c['name'] for c in columns]:
+            _persisted.add(table)
+    return _persisted
+
+
+def key_column(cls):
+    """the persisted key column of cls, to use in queries
+    """
+    return sa.literal_column('%s.%s' % (cls.__table__.name, COLUMN),
+                             sa.Unicode)
+
+
+def _table(name):
+    return sa.table(name, sa.column('id'), sa.column(COLUMN))
+
+
+def _store(connection, objects):
+    """write the keys of objects in their tables
+    """
+    rows = {}
+    for obj in objects:
+        rows.setdefault(obj.__table__.name, []).append(
+            {'_id': obj.id, '_key': db.natsort_key(obj)})
+    for name, values in rows.iteritems():
+        table = _table(name)
+        connection.execute(
+            table.update().where(table.c.id == sa.bindparam('_id')).
+            values({COLUMN: sa.bindparam('_key')}), values)
+
+
+def _after_change(mapper, connection, target):
+    if mapper.local_table.name not in persisted(connection.engine):
+        return
+    objects = [target]
+    for name in _registered.get(type(target), ()):
+        objects.extend(o for o in getattr(target, name) or []
+                       if o.__table__.name in persisted(connection.engine)
+                       and o.id is not None)
+    _store(connection, objects)
+
+
+def sorted_relation(obj, name):
+    """return the objects in the `name` relation of obj, naturally sorted
+
+    the sorting happens in SQL, and the keys read are cached on the
+    objects.  return None if the keys of the related class are not
+    persisted, or if obj has changes not yet in the database.
+    """
+    mapper = class_mapper(type(obj))
+    if name not in mapper.relationships:
+        return None
+    prop = mapper.relationships[name]
+    target = prop.mapper.class_
+    if not prop.uselist or target.__table__.name not in persisted():
+        return None
+    session = object_session(obj)
+    if session is None or obj in session.new or obj in session.dirty:
+        return None
+    key = key_column(target)
+    result = []
+    complete = True
+    for item, value in session.query(target, key).with_parent(obj, name).\
+            order_by(key, target.id):
+        if value is None:
+            complete = False
+        else:
+            db.set_natsort_key(item, value)
+        result.append(item)
+    if not complete:
+        # rows inserted without the ORM
+        result.sort(key=db.natsort_key)
+    return result
+
+
+def prime(objects):
+    """cache the persisted keys of objects, with one query per class
+    """
+    by_class = {}
+    for obj in objects:
+        if getattr(obj, '__table__', None) is not None:
+            by_class.setdefault(type(obj), {})[obj.id] = obj
+    for cls, objs in by_class.iteritems():
+        if cls.__table__.name not in persisted():
+            continue
+        table = _table(cls.__table__.name)
+        statement = sa.select([table.c.id, table.c[COLUMN]]).where(
+            db.in_ids(table.c.id, objs.keys()))
+        for id, value in db.engine.execute(statement):
+            if value is not None:
+                db.set_natsort_key(objs[id], value)
+
+
+def keys(session, cls, ids):
+    """return the dictionary of the natural sort keys of the cls objects
+
+    the persisted keys are read with one query, without loading the
+    objects.  the other objects are loaded in chunks of
+    db.IN_CHUNK_SIZE, and only their keys are kept.
+    """
+    ids = list(ids)
+    result = {}
+    if cls.__table__.name in persisted():
+        result.update(session.query(cls.id, key_column(cls)).filter(
+            db.in_ids(cls.id, ids)))
+    missing = [i for i in ids if result.get(i) is None]
+    for start in range(0, len(missing), db.IN_CHUNK_SIZE):
+        for obj in db.load_by_ids(
+                session, cls, missing[start:start + db.IN_CHUNK_SIZE]):
+            result[obj.id] = db.natsort_key(obj)
+    return result
+
+
+def natsorted(objects):
+    """return the list of objects, naturally sorted
+
+    like sorted(objects, key=db.natsort_key), using the persisted keys.
+    """
+    objects = list(objects)
+    prime(objects)
+    return sorted(objects, key=db.natsort_key)
+
+
+def _index_name(table):
+    return '%s_%s' % (COLUMN, table)
+
+
+def _drops_columns(engine):
+    """whether the database knows `ALTER TABLE ... DROP COLUMN`
+
+    SQLite does since version 3.35.
+    """
+    if engine.name != 'sqlite':
+        return True
+    return engine.dialect.dbapi.sqlite_version_info >= (3, 35)
+
+
+def _recreate_without_key(connection, cls):
+    """create the table of cls again, without the key column
+
+    the way SQLite documents for the changes ALTER TABLE can not do: a
+    copy of the table is filled and renamed, and the indexes and the
+    triggers of the table are created again.
+    """
+    table = cls.__table__
+    copy_name = '%s_%s' % (COLUMN, table.name)
+    others = [sql for (sql, ) in connection.execute(
+        "SELECT sql FROM sqlite_master WHERE tbl_name = ? "
+        "AND type IN ('index', 'trigger') AND sql IS NOT NULL "
+        "AND name != ?", (table.name, _index_name(table.name)))]
+    existing = [c['name'] for c in sa.inspect(connection).get_columns(
+        table.name)]
+    columns = ', '.join(c.name for c in table.c if c.name in existing)
+    copy = table.tometadata(table.metadata, name=copy_name)
+    try:
+        connection.execute(sa.schema.CreateTable(copy))
+    finally:
+        table.metadata.remove(copy)
+    connection.execute('INSERT INTO %s (%s) SELECT %s FROM %s'
+                       % (copy_name, columns, columns, table.name))
+    connection.execute('DROP TABLE %s' % table.name)
+    connection.execute('ALTER TABLE %s RENAME TO %s'
+                       % (copy_name, table.name))
+    for sql in others:
+        connection.execute(sql)
+
+
+def drop(engine=None):
+    """remove the persisted keys from the database
+    """
+    global _persisted_engine
+    engine = engine or db.engine
+    tables = persisted(engine)
+    classes = dict((cls.__table__.name, cls) for cls in _registered)
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        for table in sorted(tables):
+            connection.execute('DROP INDEX %s' % _index_name(table))
+            if _drops_columns(engine):
+                connection.execute('ALTER TABLE %s DROP COLUMN %s'
+                                   % (table, COLUMN))
+            else:
+                _recreate_without_key(connection, classes[table])
+    except Exception, e:
+        logger.warning('sortkey.drop(): %s' % utils.utf8(e))
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    finally:
+        connection.close()
+        _persisted_engine = None
+
+
+def build(engine=None):
+    """add the key column to the registered tables, and fill it
+
+    return the set of the names of the tables with persisted keys.
+    """
+    global _persisted_engine
+    engine = engine or db.engine
+    existing = persisted(engine)
+    column_type = 'VARCHAR'
+    if engine.name == 'postgresql':
+        # sort like python does, whatever the database locale
+        column_type = 'VARCHAR COLLATE "C"'
+    connection = engine.connect()
+    transaction = connection.begin()
+    session = sessionmaker(bind=connection, autoflush=False)()
+    try:
+        for cls in sorted(_registered, key=lambda c: c.__table__.name):
+            table = cls.__table__.name
+            if table not in existing:
+                connection.execute('ALTER TABLE %s ADD COLUMN %s %s'
+                                   % (table, COLUMN, column_type))
+                connection.execute('CREATE INDEX %s ON %s (%s)'
+                                   % (_index_name(table), table, COLUMN))
+            ids = [i for (i, ) in session.query(cls.id)]
+            for start in range(0, len(ids), 1000):
+                _store(connection, db.load_by_ids(
+                    session, cls, ids[start:start + 1000]))
+                session.expunge_all()
+    except Exception, e:
+        logger.warning('sortkey.build(): %s' % utils.utf8(e))
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    finally:
+        session.close()
+        connection.close()
+        _persisted_engine = None
+    return persisted(engine)
+
+
+class SortKeyCommandHandler(pluginmgr.CommandHandler):
+
+    command = 'sortkeys'
+
+    def __call__(self, cmd, arg):
+        if arg == 'drop':
+            drop()
+        else:
+            build()
+
+
+pluginmgr.register_command(SortKeyCommandHandler)
@@ -79,6 +79,24 @@ def check_dupids(filename):
     return list(duplicates)
 
 
+class StatementCounter(db.StatementRecorder):
+    """collect the SQL statements executed on db.engine
+
+    use it as a context manager::
+
+        with StatementCounter() as statements:
+            ...
+        self.assertEquals(len(statements), 2)
+
+    `parameters` holds the parameters of each statement, in the same
+    order, a list of them for an executemany.
+    """
+
+    def __enter__(self):
+        super(StatementCounter, self).__enter__()
+        return self.statements
+
+
 class BaubleTestCase(unittest.TestCase):
 
     def __init__(self, *args, **kwargs):
@@ -96,6 +114,19 @@ class BaubleTestCase(unittest.TestCase):
         bauble.pluginmgr.commands.clear()
         pluginmgr.plugins.clear()
 
+    def assertMaxStatements(self, maximum, function, *args, **kwargs):
+        """call function, asserting it executes at most maximum statements
+
+        return the result of the call.
+        """
+        with StatementCounter() as statements:
+            result = function(*args, **kwargs)
+        self.assertTrue(len(statements) <= maximum,
+                        '%s statements, expected at most %s:\n%s' % (
+                            len(statements), maximum,
+                            '\n'.join(statements)))
+        return result
+
     # assertIsNone is not available before 2.7
     import sys
     if sys.version_info[:2] < (2, 7):
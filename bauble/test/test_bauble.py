@@ -35,7 +35,7 @@ import unittest
 import bauble
 import bauble.db as db
 from bauble.btypes import Enum, EnumError
-from bauble.test import BaubleTestCase, check_dupids
+from bauble.test import BaubleTestCase, StatementCounter, check_dupids
 import bauble.meta as meta
 
 from bauble import prefs
@@ -291,6 +291,47 @@ class HistoryTests(BaubleTestCase):
         self.assertEquals(history.table_name, 'family')
         self.assertEquals(history.operation, 'delete')
 
+    def test_one_insert_per_flush(self):
+        from bauble.plugins.plants import Family
+        with StatementCounter() as statements:
+            self.session.add_all([Family(epithet=u'Family%s' % i)
+                                  for i in range(3)])
+            self.session.commit()
+        self.assertEquals(len([s for s in statements
+                               if s.startswith('INSERT INTO history')]), 1)
+        self.assertEquals(self.session.query(db.History).filter_by(
+            table_name=u'family').count(), 3)
+
+    def test_timestamps_not_loaded_recorded_as_none(self):
+        from bauble.plugins.plants import Family
+        family = Family(epithet=u'Family')
+        self.session.add(family)
+        with StatementCounter() as statements:
+            self.session.commit()
+        self.assertFalse([s for s in statements if s.startswith('SELECT')])
+        history = self.session.query(db.History).filter_by(
+            table_name=u'family', table_id=family.id).one()
+        self.assertTrue("'_created': u'None'" in history.values)
+        self.assertTrue("'_last_updated': u'None'" in history.values)
+
+    def test_rolled_back_with_the_session(self):
+        from bauble.plugins.plants import Family
+        base_count = self.session.query(db.History).count()
+        self.session.add(Family(epithet=u'Family'))
+        self.session.flush()
+        self.assertEquals(self.session.query(db.History).count(),
+                          base_count + 1)
+        self.session.rollback()
+        self.assertEquals(self.session.query(db.History).count(), base_count)
+
+    def test_record_history_off(self):
+        from bauble.plugins.plants import Family
+        base_count = self.session.query(db.History).count()
+        db.record_history(self.session, False)
+        self.session.add(Family(epithet=u'Family'))
+        self.session.commit()
+        self.assertEquals(self.session.query(db.History).count(), base_count)
+
 
 class MVPTests(BaubleTestCase):
 
@@ -18,7 +18,16 @@
 # You should have received a copy of the GNU General Public License
 # along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import shutil
+import tempfile
+import threading
+
+import sqlalchemy as sa
+from sqlalchemy.pool import QueuePool, SingletonThreadPool
+
 from bauble.test import BaubleTestCase
+import bauble.plugins.plants.family
 import bauble.plugins.plants.genus
 import bauble.plugins.garden.accession
 
@@ -36,3 +45,98 @@ class GlobalFunctionsTests(BaubleTestCase):
         self.assertEquals(db.class_of_object("accession_note"),
                           bauble.plugins.garden.accession.AccessionNote)
         self.assertEquals(db.class_of_object("not_existing"), None)
+
+
+class PoolTests(BaubleTestCase):
+    def test_pool_options(self):
+        self.assertEquals(db.pool_options('sqlite:///:memory:')['poolclass'],
+                          SingletonThreadPool)
+        self.assertEquals(db.pool_options('sqlite:///ghini.db')['poolclass'],
+                          SingletonThreadPool)
+        options = db.pool_options('postgresql://ghini@localhost/ghini')
+        self.assertEquals(options['poolclass'], QueuePool)
+        self.assertEquals(options['pool_size'], 5)
+
+    def test_worker_sessions_are_per_thread(self):
+        sessions = []
+
+        def work():
+            with db.worker_session() as session:
+                sessions.append(session)
+
+        for i in range(2):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        self.assertNotEquals(sessions[0], sessions[1])
+        with db.worker_session() as session:
+            self.assertTrue(session not in sessions)
+
+    def test_nested_checkout_keeps_session_work(self):
+        Family = bauble.plugins.plants.family.Family
+        self.session.add(Family(epithet=u'Nested'))
+        self.session.flush()
+        db.engine.connect().close()
+        self.session.commit()
+        self.assertEquals(self.session.query(Family).filter_by(
+            epithet=u'Nested').count(), 1)
+
+    def test_pool_metrics(self):
+        checkouts = db.pool_metrics.checkouts
+        checked_out = db.pool_metrics.checked_out
+        connection = db.engine.connect()
+        self.assertEquals(db.pool_metrics.checked_out, checked_out + 1)
+        self.assertTrue(db.pool_metrics.peak > checked_out)
+        connection.close()
+        self.assertEquals(db.pool_metrics.checkouts, checkouts + 1)
+        self.assertEquals(db.pool_metrics.checked_out, checked_out)
+
+    def test_pool_metrics_nested_connect(self):
+        checkouts = db.pool_metrics.checkouts
+        checked_out = db.pool_metrics.checked_out
+        first = db.engine.connect()
+        second = db.engine.connect()
+        self.assertEquals(db.pool_metrics.checked_out, checked_out + 1)
+        second.close()
+        first.close()
+        self.assertEquals(db.pool_metrics.checked_out, checked_out)
+        session = db.Session()
+        session.query(bauble.plugins.plants.family.Family).all()
+        connection = db.engine.connect()
+        connection.close()
+        session.close()
+        self.assertEquals(db.pool_metrics.checked_out, checked_out)
+        self.assertTrue(db.pool_metrics.checkouts > checkouts)
+
+    def test_sqlite_file_in_wal_mode(self):
+        self.assertFalse(db._use_wal(db.engine))
+        tempdir = tempfile.mkdtemp()
+        try:
+            uri = 'sqlite:///' + os.path.join(tempdir, 'wal.db')
+            engine = sa.create_engine(uri, **db.pool_options(uri))
+            self.assertTrue(db._use_wal(engine))
+            sa.event.listen(engine, 'connect', db._sqlite_wal)
+            mode = engine.execute('PRAGMA journal_mode').scalar()
+            self.assertEquals(mode, 'wal')
+            engine.dispose()
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class StatementRecorderTests(BaubleTestCase):
+    def test_statements_timed(self):
+        with db.StatementRecorder() as recorder:
+            db.engine.execute('SELECT 1')
+            self.assertRaises(sa.exc.DBAPIError,
+                              db.engine.execute, 'SELECT * FROM nowhere')
+            db.engine.execute(sa.select([sa.literal(2)]))
+        self.assertEquals(recorder.statements[:2],
+                          ['SELECT 1', 'SELECT * FROM nowhere'])
+        self.assertEquals(len(recorder.parameters), 3)
+        self.assertTrue(2 in list(recorder.parameters[2]))
+        first, failed, last = recorder.timings
+        self.assertTrue(first >= 0 and last >= 0)
+        self.assertEquals(failed, None)
+        connection = db.engine.connect()
+        self.assertFalse(recorder in connection.info)
+        connection.close()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_history.py
+#
+
+import datetime
+
+import sqlalchemy as sa
+
+import bauble.db as db
+import bauble.history as history
+from bauble.test import BaubleTestCase
+
+
+class HistoryMaintenanceTests(BaubleTestCase):
+
+    def setUp(self):
+        super(HistoryMaintenanceTests, self).setUp()
+        self.table = db.History.__table__
+        db.engine.execute(self.table.delete())
+        self.connection = db.engine.connect()
+
+    def tearDown(self):
+        self.connection.close()
+        super(HistoryMaintenanceTests, self).tearDown()
+
+    def add(self, *entries):
+        'entries are (table_id, operation, user, days ago) tuples'
+        now = datetime.datetime.today()
+        db.engine.execute(self.table.insert(), [
+            {'table_name': u'plant', 'table_id': table_id,
+             'values': u"{'id': u'%d'}" % table_id, 'operation': operation,
+             'user': user, 'timestamp': now - datetime.timedelta(days=days)}
+            for table_id, operation, user, days in entries])
+
+    def remaining(self):
+        return [tuple(row) for row in db.engine.execute(sa.select([
+            self.table.c.table_id, self.table.c.operation]).order_by(
+            self.table.c.id))]
+
+    def test_upgrade_creates_indexes(self):
+        self.assertEquals(history.upgrade(), [])
+        db.engine.execute('DROP INDEX ix_history_timestamp')
+        self.assertEquals(history.upgrade(), ['ix_history_timestamp'])
+        self.assertEquals(history.upgrade(), [])
+
+    def test_compact_keeps_last_consecutive_update(self):
+        self.add((1, u'insert', u'ann', 9), (1, u'update', u'ann', 8),
+                 (2, u'update', u'ann', 8), (1, u'update', u'ann', 7),
+                 (1, u'update', u'bob', 6), (1, u'update', u'bob', 5),
+                 (1, u'delete', u'bob', 4))
+        self.assertEquals(history.compact(self.connection), 2)
+        self.assertEquals(self.remaining(), [
+            (1, u'insert'), (2, u'update'), (1, u'update'), (1, u'update'),
+            (1, u'delete')])
+
+    def test_compact_before(self):
+        self.add((1, u'update', u'ann', 9), (1, u'update', u'ann', 8),
+                 (1, u'update', u'ann', 1), (1, u'update', u'ann', 0))
+        before = datetime.datetime.today() - datetime.timedelta(days=5)
+        self.assertEquals(history.compact(self.connection, before), 1)
+        self.assertEquals(len(self.remaining()), 3)
+
+    def test_archive(self):
+        self.add((1, u'insert', u'ann', 9), (1, u'update', u'ann', 8),
+                 (1, u'update', u'ann', 1))
+        before = datetime.datetime.today() - datetime.timedelta(days=5)
+        self.assertEquals(list(history.archived(self.connection)), [])
+        self.assertEquals(history.archive(self.connection, before), 2)
+        self.assertEquals(self.remaining(), [(1, u'update')])
+        rows = list(history.archived(self.connection))
+        self.assertEquals([(r['table_id'], r['operation'], r['user'])
+                           for r in rows],
+                          [(1, u'insert', u'ann'), (1, u'update', u'ann')])
+        self.assertEquals(list(history.archived(
+            self.connection, rows[1]['id'])), rows[1:])
+        self.assertEquals(history.archive(self.connection, before), 0)
+
+    def test_archive_dropped_with_database(self):
+        self.add((1, u'insert', u'ann', 9))
+        history.archive(self.connection, datetime.datetime.today())
+        db.metadata.drop_all(bind=db.engine)
+        db.metadata.create_all(bind=db.engine)
+        self.assertFalse(db.engine.has_table(history.archive_table.name))
+
+    def test_command_leaves_view_history(self):
+        import bauble.pluginmgr as pluginmgr
+        import bauble.view as view
+        pluginmgr.register_command(view.HistoryCommandHandler)
+        # db.open imports bauble.history after the view is loaded
+        pluginmgr.register_command(history.HistoryCommandHandler)
+        self.assertTrue(pluginmgr.commands['history']
+                        is view.HistoryCommandHandler)
+        self.assertTrue(pluginmgr.commands['history-maintenance']
+                        is history.HistoryCommandHandler)
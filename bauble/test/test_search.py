@@ -31,8 +31,9 @@ from pyparsing import ParseException
 
 import bauble.db as db
 import bauble.search as search
+import bauble.textindex as textindex
 from bauble import prefs
-from bauble.test import BaubleTestCase
+from bauble.test import BaubleTestCase, StatementCounter
 prefs.testing = True
 
 
@@ -169,21 +170,26 @@ class SearchParserTests(unittest.TestCase):
                 self.fail('ParseException not raised: "%s" - %s'
                           % (s, results))
 
-    def test_needs_join(self):
-        "check the join steps"
-
-        env = None
-        results = parser.statement.parseString("plant where accession.species."
-                                               "id=44")
-        self.assertEquals(results.statement.content.filter.needs_join(env),
-                          [['accession', 'species']])
-        results = parser.statement.parseString("plant where accession.id=44")
-        self.assertEquals(results.statement.content.filter.needs_join(env),
-                          [['accession']])
-        results = parser.statement.parseString("plant where accession.id=4 OR "
-                                               "accession.species.id=3")
-        self.assertEquals(results.statement.content.filter.needs_join(env),
-                          [['accession'], ['accession', 'species']])
+    def test_parse_string_cached(self):
+        "parsed statements are cached on the stripped text"
+
+        sp = search.SearchParser()
+        results = sp.parse_string('genus where epithet=Ficus')
+        self.assertEquals((sp.hits, sp.misses), (0, 1))
+        self.assertTrue(sp.parse_string(' genus where epithet=Ficus ')
+                        is results)
+        self.assertEquals((sp.hits, sp.misses), (1, 1))
+        sp.parse_string('genus where epithet=Morus')
+        self.assertEquals((sp.hits, sp.misses), (1, 2))
+
+    def test_parse_string_cache_size(self):
+        "least recently used statements leave the cache"
+
+        sp = search.SearchParser(cache_size=2)
+        for s in ('gen=Ficus', 'gen=Morus', 'gen=Ficus', 'gen=Ulmus',
+                  'gen=Ficus', 'gen=Morus'):
+            sp.parse_string(s)
+        self.assertEquals((sp.hits, sp.misses), (2, 4))
 
     def test_value_list_token(self):
         """value_list: should return all values
@@ -360,6 +366,136 @@ class SearchTests(BaubleTestCase):
         results = mapper_search.search('family contains FAM', self.session)
         self.assertEquals(len(results), 4)  # they case insensitively do
 
+    def test_search_by_expression_single_statement(self):
+        "domain expression on several properties is one SELECT"
+        from bauble.plugins.plants.species import Species
+        sp1 = Species(epithet=u'ficoides', genus=self.genus)
+        sp2 = Species(epithet=u'alba', infrasp1=u'ficoides',
+                      genus=self.genus)
+        sp3 = Species(epithet=u'nigra', genus=self.genus)
+        self.session.add_all([sp1, sp2, sp3])
+        self.session.commit()
+        mapper_search = search.get_strategy('MapperSearch')
+        textindex.indexed_columns()  # looked up once per engine
+        try:
+            for use_union in (False, True):
+                search.DomainExpressionAction.use_union = use_union
+                mapper_search.result_cache.clear()
+                with StatementCounter() as statements:
+                    results = mapper_search.search('sp contains fico',
+                                                   self.session)
+                self.assertEquals(sorted(i.id for i in results),
+                                  sorted([sp1.id, sp2.id]))
+                self.assertEquals(len(statements), 1)
+        finally:
+            search.DomainExpressionAction.use_union = False
+
+    def test_search_cached_statement_reinvoked(self):
+        "invoking a statement does not alter it"
+
+        mapper_search = search.get_strategy('MapperSearch')
+        for s in ('gen where epithet=genus1', 'gen=genus1', 'genus1'):
+            statement = mapper_search.parser.parse_string(s).statement
+            text = str(statement)
+            first = set(mapper_search.search(s, self.session))
+            self.assertEquals(str(statement), text)
+            self.assertEquals(set(mapper_search.search(s, self.session)),
+                              first)
+            self.assertEquals(first, set([self.genus]))
+
+    def test_search_results_cached(self):
+        "repeated search does not query the database again"
+
+        mapper_search = search.get_strategy('MapperSearch')
+        cache = mapper_search.result_cache
+        s = 'genus where family.epithet=family1'
+        self.assertEquals(mapper_search.search(s, self.session),
+                          set([self.genus]))
+        hits = cache.hits
+        results = self.assertMaxStatements(0, mapper_search.search, s,
+                                           self.session)
+        self.assertEquals(results, set([self.genus]))
+        self.assertEquals(cache.hits, hits + 1)
+
+    def test_search_results_cache_invalidated(self):
+        "changing a table read by a search invalidates its results"
+
+        mapper_search = search.get_strategy('MapperSearch')
+        s = 'genus where family.epithet=family1'
+        self.assertEquals(mapper_search.search(s, self.session),
+                          set([self.genus]))
+        genus2 = self.Genus(family=self.family, epithet=u'genus2')
+        self.session.add(genus2)
+        self.session.commit()
+        self.assertEquals(mapper_search.search(s, self.session),
+                          set([self.genus, genus2]))
+        self.family.epithet = u'family2'
+        self.session.commit()
+        self.assertEquals(mapper_search.search(s, self.session), set())
+
+    def test_search_results_cache_invalidated_by_rollback(self):
+        "results read between a flush and its rollback are dropped"
+
+        mapper_search = search.get_strategy('MapperSearch')
+        s = 'genus where family.epithet=family1'
+        self.session.delete(self.genus)
+        self.session.flush()
+        self.assertEquals(mapper_search.search(s, self.session), set())
+        self.session.rollback()
+        self.assertEquals(mapper_search.search(s, self.session),
+                          set([self.genus]))
+
+    def test_search_results_cache_invalidated_by_commit(self):
+        "results read by another session before a commit are dropped"
+
+        mapper_search = search.get_strategy('MapperSearch')
+        s = 'genus where family.epithet=family1'
+        genus2 = self.Genus(family=self.family, epithet=u'genus2')
+        self.session.add(genus2)
+        self.session.flush()
+        other = db.Session()
+        mapper_search.search(s, other)
+        hits = mapper_search.result_cache.hits
+        self.session.commit()
+        self.assertEquals(set(i.id for i in mapper_search.search(s, other)),
+                          set([self.genus.id, genus2.id]))
+        self.assertEquals(mapper_search.result_cache.hits, hits)
+        other.close()
+
+    def test_search_pairs(self):
+        "search_pairs does not load the objects"
+
+        mapper_search = search.get_strategy('MapperSearch')
+        mapper_search.result_cache.clear()
+        session = db.Session()
+        for s in ['genus1', 'genus=genus1', 'genus where epithet=genus1',
+                  'family1']:
+            expected = set((type(i), i.id)
+                           for i in mapper_search.search(s, self.session))
+            mapper_search.result_cache.clear()
+            self.assertEquals(mapper_search.search_pairs(s, session),
+                              expected)
+            self.assertEquals(len(session.identity_map), 0)
+            # and the same from the cache
+            self.assertEquals(mapper_search.search_pairs(s, session),
+                              expected)
+        session.close()
+
+    def test_search_results_cache_expires(self):
+        "cached results older than max_age are not used"
+
+        mapper_search = search.get_strategy('MapperSearch')
+        cache = mapper_search.result_cache
+        self.assertEquals(mapper_search.search('genus1', self.session),
+                          set([self.genus]))
+        misses = cache.misses
+        max_age, cache.max_age = cache.max_age, -1
+        try:
+            mapper_search.search('genus1', self.session)
+        finally:
+            cache.max_age = max_age
+        self.assertEquals(cache.misses, misses + 1)
+
     def test_search_by_query11(self):
         "query with MapperSearch, single table, single test"
 
@@ -585,6 +721,56 @@ class SearchTests(BaubleTestCase):
         resultsEmptyString = mapper_search.search(s, self.session)
         self.assertEqual(resultsNone, resultsEmptyString)
 
+    def test_search_by_query_one_select(self):
+        "query with AND, OR, NOT is one SELECT, joining each path once"
+
+        Family = self.Family
+        Genus = self.Genus
+        family2 = Family(epithet=u'family2')
+        g2 = Genus(family=family2, epithet=u'genus2')
+        g3 = Genus(family=self.family, epithet=u'genus3')
+        self.session.add_all([family2, g2, g3])
+        self.session.commit()
+
+        mapper_search = search.get_strategy('MapperSearch')
+        s = 'genus where family.epithet=family1 and not epithet=genus1 '\
+            'or family.aggregate=""'
+        with StatementCounter() as statements:
+            results = mapper_search.search(s, self.session)
+        self.assertEqual(results, set([g2, g3]))
+        self.assertEqual(len(statements), 1)
+        for operation in ('INTERSECT', 'UNION', 'EXCEPT'):
+            self.assertFalse(operation in statements[0])
+        self.assertEqual(statements[0].count('JOIN family'), 1)
+
+        s = 'family where genera.epithet=genus3 and genera.epithet=genus1'
+        with StatementCounter() as statements:
+            results = mapper_search.search(s, self.session)
+        self.assertEqual(results, set([self.family]))
+        self.assertEqual(statements[0].count('EXISTS'), 2)
+
+    def test_search_by_query_not_null(self):
+        "NOT selects the objects the negated predicate is NULL for"
+
+        g2 = self.Genus(family=self.family, epithet=u'genus2', author=None)
+        self.session.add(g2)
+        self.session.commit()
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('genus where not author=Linnaeus',
+                                       self.session)
+        self.assertTrue(g2 in results)
+
+    def test_explain(self):
+        mapper_search = search.get_strategy('MapperSearch')
+        mapper_search.search('genus where epithet=genus1', self.session)
+        statements = search.explain('genus where epithet=genus1',
+                                    self.session)
+        genus = [i for i in statements if 'FROM genus \n' in i[0]]
+        self.assertEqual(len(genus), 1)
+        statement, parameters, seconds = genus[0]
+        self.assertTrue('genus1' in parameters)
+        self.assertTrue(seconds >= 0)
+
     def test_search_by_query22id(self):
         "query with MapperSearch, joined tables, test on id of dependent table"
 
@@ -713,6 +899,8 @@ class SearchTests(BaubleTestCase):
         s = 'Schetti'
         results = mapper_search.search(s, self.session)
         self.assertEqual(results, [g3])
+        results = mapper_search.search_pairs(s, self.session)
+        self.assertEqual(results, [(Genus, g3.id)])
 
     def test_search_by_query_synonyms_disabled(self):
         """SynonymSearch strategy gives all synonyms of given taxon."""
@@ -757,6 +945,27 @@ class SearchTests(BaubleTestCase):
         results = mapper_search.search(s, self.session)
         self.assertEqual(results, set([sp]))
 
+    def test_search_by_values_statements(self):
+        """value search is one UNION ALL plus one load per class"""
+
+        from bauble.plugins.plants.species_model import Species
+        from bauble.plugins.plants.species_model import VernacularName
+        sp = Species(epithet=u"coccinea", genus=self.genus)
+        vn1 = VernacularName(name=u"coral rojo", language=u"es", species=sp)
+        vn2 = VernacularName(name=u"rojo", language=u"it", species=sp)
+        self.session.add_all([sp, vn1, vn2])
+        self.session.commit()
+        expect = [('Genus', self.genus.id), ('Species', sp.id)]
+        self.session.expunge_all()
+        mapper_search = search.get_strategy('MapperSearch')
+        textindex.indexed_columns()  # looked up once per engine
+        with StatementCounter() as statements:
+            results = mapper_search.search('rojo, genus1', self.session)
+        self.assertEqual(sorted((type(i).__name__, i.id) for i in results),
+                         expect)
+        # the UNION ALL, genera, vernacular names joined to species
+        self.assertEqual(len(statements), 3)
+
 
 class InOperatorSearch(BaubleTestCase):
     def __init__(self, *args):
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_sortkey.py
+#
+
+from nose import SkipTest
+import sqlalchemy as sa
+
+import bauble.db as db
+import bauble.sortkey as sortkey
+import bauble.utils as utils
+from bauble.test import BaubleTestCase, StatementCounter
+
+
+class SortKeyTests(BaubleTestCase):
+
+    def setUp(self):
+        super(SortKeyTests, self).setUp()
+        from bauble.plugins.plants import Family, Genus, Species
+        from bauble.plugins.garden import Accession, Location, Plant
+        self.Plant = Plant
+        family = Family(epithet=u'Moraceae')
+        genus = Genus(family=family, epithet=u'Ficus')
+        species = Species(genus=genus, epithet=u'carica')
+        self.location = Location(code=u'GH', name=u'green house')
+        self.accession = Accession(species=species, code=u'2016.0002')
+        self.plants = [Plant(accession=self.accession, code=unicode(i),
+                             quantity=1, location=self.location)
+                       for i in (10, 9, 2, 1, 11)]
+        self.session.add_all([family, genus, species, self.location,
+                              self.accession] + self.plants)
+        self.session.commit()
+
+    def tearDown(self):
+        sortkey.drop()
+        super(SortKeyTests, self).tearDown()
+
+    def stored(self, table):
+        return dict(db.engine.execute('SELECT id, %s FROM %s'
+                                      % (sortkey.COLUMN, table)).fetchall())
+
+    def test_natsort_key_cached(self):
+        plant = self.plants[0]
+        key = db.natsort_key(plant)
+        self.assertEquals(key, utils.natsort_text(plant))
+        self.assertTrue(db.natsort_key(plant) is key)
+
+    def test_natsort_key_invalidated(self):
+        plant = self.plants[0]
+        db.natsort_key(plant)
+        self.accession.code = u'2016.0003'
+        self.assertEquals(db.natsort_key(plant), utils.natsort_text(plant))
+        self.assertTrue('2016.0003' in db.natsort_key(plant))
+
+    def test_natsort_key_kept_on_other_changes(self):
+        plant = self.plants[0]
+        key = db.natsort_key(plant)
+        self.location.name = u'glass house'
+        self.plants[1].code = u'12'
+        self.assertTrue(db.natsort_key(plant) is key)
+
+    def test_natsort_key_invalidated_relation_not_loaded(self):
+        session = db.Session()
+        plant = session.query(self.Plant).get(self.plants[0].id)
+        db.natsort_key(plant)
+        accession = plant.accession
+        self.assertFalse('plants' in accession.__dict__)
+        accession.code = u'2016.0003'
+        self.assertTrue('2016.0003' in db.natsort_key(plant))
+        session.close()
+
+    def test_natsort_key_invalidated_once_per_read(self):
+        session = db.Session()
+        plant = session.query(self.Plant).get(self.plants[0].id)
+        db.natsort_key(plant)
+        accession = plant.accession
+        accession.code = u'2016.0003'
+        accession.code = u'2016.0004'
+        # the session is not scanned at each change
+        self.assertEquals(session.info[db.NATSORT_STALE],
+                          set([self.Plant]))
+        self.assertTrue('2016.0004' in db.natsort_key(plant))
+        self.assertFalse(session.info.get(db.NATSORT_STALE))
+        session.close()
+
+    def test_not_persisted_by_default(self):
+        self.assertEquals(sortkey.persisted(), set())
+        plants = db.natsort('plants', self.location)
+        self.assertEquals([p.code for p in plants],
+                          [u'1', u'2', u'9', u'10', u'11'])
+
+    def test_build(self):
+        tables = sortkey.build()
+        self.assertEquals(tables, set(['family', 'genus', 'species',
+                                       'accession', 'location', 'plant']))
+        stored = self.stored('plant')
+        for plant in self.plants:
+            self.assertEquals(stored[plant.id], utils.natsort_text(plant))
+
+    def test_keys_follow_changes(self):
+        sortkey.build()
+        plant = self.Plant(accession=self.accession, code=u'3', quantity=1,
+                           location=self.location)
+        self.session.add(plant)
+        self.session.commit()
+        self.assertEquals(self.stored('plant')[plant.id],
+                          utils.natsort_text(plant))
+        self.accession.code = u'2016.0010'
+        self.session.commit()
+        stored = self.stored('plant')
+        for plant in self.plants:
+            self.assertEquals(stored[plant.id],
+                              utils.natsort_text(u'2016.0010.%s' % plant.code))
+
+    def test_relation_sorted_in_sql(self):
+        sortkey.build()
+        from bauble.plugins.garden import Location
+        session = db.Session()
+        location = session.query(Location).get(self.location.id)
+        with StatementCounter() as statements:
+            plants = db.natsort('plants', location)
+        self.assertEquals(len(statements), 1)
+        self.assertTrue('ORDER BY plant._natsort' in statements[0])
+        self.assertEquals([p.code for p in plants],
+                          [u'1', u'2', u'9', u'10', u'11'])
+        # the keys come with the objects
+        self.assertMaxStatements(0, lambda: [db.natsort_key(p)
+                                             for p in plants])
+        session.close()
+
+    def test_prime(self):
+        sortkey.build()
+        session = db.Session()
+        plants = session.query(self.Plant).all()
+        with StatementCounter() as statements:
+            result = sortkey.natsorted(plants)
+        self.assertEquals(len(statements), 1)
+        self.assertEquals([p.code for p in result],
+                          [u'1', u'2', u'9', u'10', u'11'])
+        session.close()
+
+    def test_keys(self):
+        ids = [p.id for p in self.plants]
+        expected = dict((p.id, utils.natsort_text(p)) for p in self.plants)
+        session = db.Session()
+        self.assertEquals(sortkey.keys(session, self.Plant, ids), expected)
+        session.close()
+        sortkey.build()
+        session = db.Session()
+        with StatementCounter() as statements:
+            keys = sortkey.keys(session, self.Plant, ids)
+        self.assertEquals(len(statements), 1)
+        self.assertEquals(keys, expected)
+        self.assertEquals(len(session.identity_map), 0)
+        session.close()
+
+    def test_drop(self):
+        sortkey.build()
+        sortkey.drop()
+        self.assertEquals(sortkey.persisted(), set())
+        plants = db.natsort('plants', self.location)
+        self.assertEquals([p.code for p in plants],
+                          [u'1', u'2', u'9', u'10', u'11'])
+
+    def test_drop_recreating_tables(self):
+        # SQLite before 3.35 can not drop columns
+        if db.engine.name != 'sqlite':
+            raise SkipTest('SQLite only')
+        inspector = lambda: sa.inspect(db.engine)
+        indexes = dict((t, inspector().get_indexes(t))
+                       for t in ('plant', 'accession'))
+        triggers = lambda: db.engine.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' "
+            "AND tbl_name = 'plant'").fetchall()
+        db.engine.execute('CREATE TRIGGER plant_noop AFTER INSERT ON plant '
+                          'BEGIN SELECT 1; END')
+        before = triggers()
+        sortkey.build()
+        drops_columns = sortkey._drops_columns
+        sortkey._drops_columns = lambda engine: False
+        try:
+            sortkey.drop()
+        finally:
+            sortkey._drops_columns = drops_columns
+        self.assertEquals(sortkey.persisted(), set())
+        for table in indexes:
+            self.assertFalse(sortkey.COLUMN in [
+                c['name'] for c in inspector().get_columns(table)])
+            self.assertEquals(inspector().get_indexes(table),
+                              indexes[table])
+        self.assertEquals(triggers(), before)
+        session = db.Session()
+        location = session.merge(self.location)
+        self.assertEquals([p.code for p in db.natsort('plants', location)],
+                          [u'1', u'2', u'9', u'10', u'11'])
+        session.close()
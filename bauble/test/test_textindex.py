@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_textindex.py
+#
+
+import sqlalchemy as sa
+
+import bauble.db as db
+import bauble.search as search
+import bauble.textindex as textindex
+from bauble.test import BaubleTestCase
+
+
+class TextIndexTests(BaubleTestCase):
+
+    def setUp(self):
+        super(TextIndexTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.Family = Family
+        self.Genus = Genus
+        self.family = Family(epithet=u'Moraceae')
+        self.genus = Genus(family=self.family, epithet=u'Ficus')
+        self.session.add_all([self.family, self.genus])
+        self.session.commit()
+
+    def tearDown(self):
+        textindex.drop()
+        super(TextIndexTests, self).tearDown()
+
+    def search(self, text):
+        mapper_search = search.get_strategy('MapperSearch')
+        return set((type(i).__name__, i.id)
+                   for i in mapper_search.search(text, self.session))
+
+    def test_not_indexed_uses_utils_ilike(self):
+        self.assertEquals(textindex.indexed_columns(), {})
+        clause = textindex.ilike(self.Genus.__table__.c.epithet, '%fic%')
+        self.assertFalse('_textindex_' in str(clause))
+
+    def test_build_registered_columns(self):
+        columns = textindex.build()
+        self.assertTrue('epithet' in columns['genus'])
+        self.assertTrue('epithet' in columns['family'])
+        self.assertEquals(textindex.indexed_columns()['genus'],
+                          columns['genus'])
+        clause = textindex.ilike(self.Genus.__table__.c.epithet, '%fic%')
+        self.assertTrue('_textindex_genus' in str(clause))
+
+    def test_same_results_with_index(self):
+        expected = [self.search(s) for s in ('FIC', 'gen contains ICU',
+                                             'fam like mora%', 'zzz')]
+        textindex.build()
+        search.MapperSearch.result_cache.clear()
+        self.assertEquals([self.search(s) for s in ('FIC', 'gen contains ICU',
+                                                    'fam like mora%', 'zzz')],
+                          expected)
+        self.assertEquals(self.search('gen contains ICU'),
+                          set([('Genus', self.genus.id)]))
+
+    def test_index_follows_changes(self):
+        textindex.build()
+        genus2 = self.Genus(family=self.family, epithet=u'Morus')
+        self.session.add(genus2)
+        self.session.commit()
+        self.assertEquals(self.search('gen contains oru'),
+                          set([('Genus', genus2.id)]))
+        genus2.epithet = u'Maclura'
+        self.session.commit()
+        self.assertEquals(self.search('gen contains oru'), set())
+        self.assertEquals(self.search('gen contains clur'),
+                          set([('Genus', genus2.id)]))
+        self.session.delete(genus2)
+        self.session.commit()
+        self.assertEquals(self.search('gen contains clur'), set())
+
+    def test_recreated_table_searched(self):
+        textindex.build()
+        table = self.Genus.__table__
+        textindex.indexed_columns()
+        # like a CSV import replacing the table
+        table.drop(bind=db.engine)
+        table.create(bind=db.engine)
+        db.engine.execute(table.insert(), id=5, family_id=self.family.id,
+                          epithet=u'Maclura')
+        statement = sa.select([table.c.id]).where(
+            textindex.ilike(table.c.epithet, '%clur%'))
+        self.assertEquals(db.engine.execute(statement).fetchall(), [(5, )])
+
+    def test_drop(self):
+        textindex.build()
+        textindex.drop()
+        self.assertEquals(textindex.indexed_columns(), {})
+        self.assertFalse([i for i in db.engine.table_names()
+                          if i.startswith('_textindex_')])
@@ -125,3 +125,13 @@ class GlobalFuncs(TestCase):
 
     def test_safe_numeric_valid_not(self):
         self.assertEquals(utils.safe_numeric('123a.2'), 0)
+
+    def test_natsort_text_sorts_like_natsort_key(self):
+        items = ['2001.10', '2001.9', '2001.100', 'a10', 'a9', 'a', 'b1',
+                 '10', '9', '1.5', '1.25', 'x2y10', 'x2y9', 'x10y1']
+        self.assertEquals(sorted(items, key=utils.natsort_text),
+                          sorted(items, key=utils.natsort_key))
+
+    def test_natsort_text_pads_numbers(self):
+        self.assertEquals(utils.natsort_text('a12.3b'),
+                          u'a%s12.3b' % ('0' * (utils.NATSORT_WIDTH - 2)))
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_view.py
+#
+
+import bauble.db as db
+from bauble.test import BaubleTestCase, StatementCounter
+from bauble.view import SearchResultsModel, result_sort_key
+
+
+class SearchResultsModelTests(BaubleTestCase):
+
+    def setUp(self):
+        super(SearchResultsModelTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.Family = Family
+        self.Genus = Genus
+        self.family = Family(epithet=u'Moraceae')
+        self.genera = [Genus(family=self.family, epithet=u'Genus%d' % i)
+                       for i in range(250)]
+        self.session.add_all([self.family] + self.genera)
+        self.session.commit()
+        self.rows = [(result_sort_key(g), Genus, g.id) for g in self.genera]
+        self.ids = [g.id for g in sorted(self.genera, key=result_sort_key)]
+        self.session.expunge_all()
+
+    def model(self, **kwargs):
+        model = SearchResultsModel(db.Session(), **kwargs)
+        model.set_rows(self.rows)
+        return model
+
+    def test_rows_sorted_and_unique(self):
+        model = SearchResultsModel(db.Session())
+        model.set_rows(self.rows + self.rows[:10])
+        self.assertEquals(model.on_iter_n_children(None), 250)
+        self.assertEquals([n.id for n in model.roots], self.ids)
+        # natural sort
+        self.assertEquals(model.roots[2].key[1],
+                          u'Genus0000000000000002')
+
+    def test_nothing_loaded_before_asked(self):
+        self.assertMaxStatements(0, self.model)
+        self.assertEquals(self.model().live_objects(), [])
+
+    def test_paths(self):
+        model = self.model()
+        node = model.on_get_iter((42, ))
+        self.assertEquals(node.id, self.ids[42])
+        self.assertEquals(model.on_get_path(node), (42, ))
+        self.assertEquals(model.on_iter_next(node).id, self.ids[43])
+        self.assertEquals(model.on_iter_next(model.roots[-1]), None)
+        self.assertEquals(model.on_get_iter((250, )), None)
+        self.assertEquals(model.on_iter_nth_child(None, 7).id, self.ids[7])
+
+    def test_values_loaded_in_pages(self):
+        model = self.model()
+
+        def read_first_page():
+            for i in range(model.page_size):
+                node = model.on_get_iter((i, ))
+                self.assertEquals(model.on_get_value(node, 0).id, node.id)
+        with StatementCounter() as statements:
+            read_first_page()
+        self.assertEquals(len(statements), 1)
+        self.assertEquals(model.loads, 1)
+
+    def test_live_objects_bounded(self):
+        model = self.model()
+        model.cache_size = 150
+        for node in model.roots:
+            model.on_get_value(node, 0)
+        self.assertEquals(len(model.live_objects()), 150)
+        self.assertEquals(model.loads, 3)
+
+    def test_deleted_object_is_none(self):
+        model = self.model()
+        session = db.Session()
+        session.delete(session.query(self.Genus).get(self.ids[0]))
+        session.commit()
+        session.close()
+        self.assertEquals(model.on_get_value(model.roots[0], 0), None)
+        self.assertEquals(model.on_get_value(model.roots[1], 0).id,
+                          self.ids[1])
+
+    def test_find_and_remove(self):
+        model = self.model()
+        genus = model.session.query(self.Genus).get(self.ids[5])
+        found = model.find(genus)
+        self.assertEquals([n.id for n in found], [self.ids[5]])
+        model.remove(model.create_tree_iter(found[0]))
+        self.assertEquals(model.find(genus), [])
+        self.assertEquals(model.on_get_iter((5, )).id, self.ids[6])
+        self.assertEquals(model.on_get_path(model.roots[5]), (5, ))
+
+    def test_children(self):
+        model = self.model(has_children=lambda cls: True)
+        node = model.roots[0]
+        self.assertTrue(model.on_iter_has_child(node))
+        family = model.session.query(self.Family).one()
+        model.set_children(model.create_tree_iter(node), [family])
+        self.assertEquals(model.on_iter_n_children(node), 1)
+        child = model.on_iter_children(node)
+        self.assertEquals(model.on_get_path(child), (0, 0))
+        self.assertEquals(model.on_iter_parent(child), node)
+        self.assertEquals(model.on_get_value(child, 0), family)
+        model.set_children(model.create_tree_iter(node), [])
+        self.assertFalse(model.on_iter_has_child(node))
+
+    def test_append_object(self):
+        model = self.model()
+        family = model.session.query(self.Family).one()
+        model.append_object(family)
+        self.assertEquals(model.on_iter_n_children(None), 251)
+        self.assertEquals(model.on_get_value(model.roots[-1], 0), family)
+
+    def test_children_checked_when_asked(self):
+        asked = []
+
+        def get_children(obj):
+            asked.append(obj.id)
+            return obj.id == self.ids[1] and [obj.family] or []
+        model = self.model(has_children=lambda cls: True,
+                           get_children=get_children)
+        self.assertEquals(asked, [])
+        self.assertFalse(model.on_iter_has_child(model.roots[0]))
+        self.assertTrue(model.on_iter_has_child(model.roots[1]))
+        self.assertEquals(asked, self.ids[:2])
+        # the answer is kept for the rows without children
+        self.assertFalse(model.on_iter_has_child(model.roots[0]))
+        self.assertEquals(asked, self.ids[:2])
+        self.assertEquals(model.loads, 1)
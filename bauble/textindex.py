@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+"""
+Trigram indexes for case insensitive substring searches.
+
+A `LIKE '%x%'` test can not use a plain b-tree index, so without help
+every substring search is a full table scan.  This module builds
+trigram indexes on the columns registered with
+:meth:`bauble.search.MapperSearch.add_meta`:
+
+* on PostgreSQL, a `pg_trgm` GIN index per column. PostgreSQL uses it
+  for `ILIKE` on its own, the search clauses stay as they are.
+* on SQLite, an FTS5 table per mapped table, with the `trigram`
+  tokenizer, kept up to date by triggers.  :func:`ilike` rewrites the
+  substring tests into a lookup in the FTS5 table.
+
+The indexes are optional, they are created by the `reindex` command
+and used only once they exist.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+#logger.setLevel(logging.DEBUG)
+
+import sqlalchemy as sa
+from sqlalchemy.orm import class_mapper
+
+import bauble.db as db
+import bauble.pluginmgr as pluginmgr
+import bauble.utils as utils
+
+PREFIX = '_textindex_'
+
+## table name -> set of indexed column names, per engine; see
+## indexed_columns.
+_indexed = {}
+_indexed_engine = None
+
+
+def _forget(*args, **kwargs):
+    global _indexed_engine
+    _indexed_engine = None
+
+
+## tables created or dropped again lose their triggers, and databases
+## created again their indexes
+sa.event.listen(db.metadata, 'after_create', _forget)
+sa.event.listen(sa.Table, 'after_create', _forget)
+sa.event.listen(sa.Table, 'after_drop', _forget)
+
+
+def registered_columns():
+    """return the dictionary of the columns to index, per table name
+
+    the columns are the ones registered with MapperSearch.add_meta.
+    """
+    from bauble.search import MapperSearch
+    result = {}
+    for cls, properties in MapperSearch._properties.iteritems():
+        mapper = class_mapper(cls)
+        for prop in properties:
+            column = mapper.c[prop]
+            result.setdefault(column.table.name, set()).add(column.name)
+    return result
+
+
+def indexed_columns(engine=None):
+    """return the dictionary of the columns having a trigram index
+
+    only SQLite needs to know this, the result is cached per engine
+    and refreshed by build(), drop(), and when tables are created or
+    dropped.
+    """
+    global _indexed, _indexed_engine
+    engine = engine or db.engine
+    if engine is _indexed_engine:
+        return _indexed
+    _indexed = {}
+    _indexed_engine = engine
+    if engine.name != 'sqlite':
+        return _indexed
+    # a virtual table whose triggers are gone, like after dropping and
+    # creating its content table again, is stale.  don't use it.
+    names = [row[0] for row in engine.execute(
+        "SELECT name FROM sqlite_master WHERE type='trigger' "
+        "AND name LIKE '%s%%_ai'" % PREFIX)]
+    for name in names:
+        table = name[len(PREFIX):-len('_ai')]
+        fts = PREFIX + table
+        _indexed[table] = set(row[1] for row in engine.execute(
+            'PRAGMA table_info(%s)' % fts))
+    return _indexed
+
+
+def ilike(column, pattern):
+    """drop-in replacement for utils.ilike on indexed columns
+
+    return the clause that selects the rows where `column` matches
+    `pattern` case-insensitively.  where a trigram index exists, and
+    the database can not use it directly, the clause looks up the ids
+    in the index.
+    """
+    table = getattr(column, 'table', None)
+    if table is None or column.name not in \
+            indexed_columns().get(table.name, ()):
+        return utils.ilike(column, pattern)
+    fts = sa.table(PREFIX + table.name, sa.column('rowid'),
+                   sa.column(column.name))
+    return table.c.id.in_(
+        sa.select([fts.c.rowid]).where(fts.c[column.name].like(pattern)))
+
+
+def _sqlite_statements(table, columns):
+    fts = PREFIX + table
+    cols = ', '.join(columns)
+    new = ', '.join('new.%s' % c for c in columns)
+    old = ', '.join('old.%s' % c for c in columns)
+    insert = ('INSERT INTO %(fts)s(rowid, %(cols)s) '
+              'VALUES (new.id, %(new)s);' % locals())
+    delete = ("INSERT INTO %(fts)s(%(fts)s, rowid, %(cols)s) "
+              "VALUES ('delete', old.id, %(old)s);" % locals())
+    return [
+        "CREATE VIRTUAL TABLE %(fts)s USING fts5(%(cols)s, "
+        "content='%(table)s', content_rowid='id', tokenize='trigram')"
+        % locals(),
+        'CREATE TRIGGER %s_ai AFTER INSERT ON %s BEGIN %s END'
+        % (fts, table, insert),
+        'CREATE TRIGGER %s_ad AFTER DELETE ON %s BEGIN %s END'
+        % (fts, table, delete),
+        'CREATE TRIGGER %s_au AFTER UPDATE ON %s BEGIN %s %s END'
+        % (fts, table, delete, insert),
+        "INSERT INTO %(fts)s(%(fts)s) VALUES('rebuild')" % locals(),
+        ]
+
+
+def _postgresql_statements(table, columns):
+    result = []
+    for column in columns:
+        name = '%s%s_%s' % (PREFIX, table, column)
+        result.append('CREATE INDEX %s ON %s USING gin (%s gin_trgm_ops)'
+                      % (name, table, column))
+    return result
+
+
+def drop(engine=None):
+    """remove all trigram indexes from the database
+    """
+    global _indexed_engine
+    engine = engine or db.engine
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        if engine.name == 'sqlite':
+            names = [row[0] for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' "
+                "AND sql LIKE 'CREATE VIRTUAL TABLE %s%%'" % PREFIX)]
+            for name in names:
+                # triggers on the content table go with it
+                for suffix in ('_ai', '_ad', '_au'):
+                    connection.execute('DROP TRIGGER IF EXISTS %s%s'
+                                       % (name, suffix))
+                connection.execute('DROP TABLE %s' % name)
+        elif engine.name == 'postgresql':
+            names = [row[0] for row in connection.execute(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE indexname LIKE '%s%%'" % PREFIX.replace('_', r'\_'))]
+            for name in names:
+                connection.execute('DROP INDEX %s' % name)
+    except Exception, e:
+        logger.warning('textindex.drop(): %s' % utils.utf8(e))
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    finally:
+        connection.close()
+        _indexed_engine = None
+
+
+def build(engine=None):
+    """(re)build the trigram indexes for all registered columns
+
+    return the dictionary of the indexed columns per table, empty if
+    the database does not support trigram indexes.
+    """
+    global _indexed_engine
+    engine = engine or db.engine
+    if engine.name == 'sqlite':
+        statements = _sqlite_statements
+    elif engine.name == 'postgresql':
+        statements = _postgresql_statements
+    else:
+        logger.info('no trigram index support for %s' % engine.name)
+        return {}
+    drop(engine)
+    columns = registered_columns()
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        if engine.name == 'postgresql':
+            connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table in sorted(columns):
+            for statement in statements(table, sorted(columns[table])):
+                connection.execute(statement)
+    except Exception, e:
+        logger.warning('textindex.build(): %s' % utils.utf8(e))
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    finally:
+        connection.close()
+        _indexed_engine = None
+    return columns
+
+
+class TextIndexCommandHandler(pluginmgr.CommandHandler):
+
+    command = 'reindex'
+
+    def __call__(self, cmd, arg):
+        if arg == 'drop':
+            drop()
+        else:
+            build()
+
+
+pluginmgr.register_command(TextIndexCommandHandler)
@@ -920,6 +920,26 @@ def natsort_key(obj):
     return (chunks, item)
 
 
+NATSORT_WIDTH = 16
+
+
+def natsort_text(obj):
+    """
+    a string that sorts like natsort_key(obj), by plain comparison
+
+    numbers in obj.__str__() are left padded with zeros to
+    NATSORT_WIDTH digits, so that also a database `ORDER BY` on the
+    result gives the natural order.
+    """
+
+    def pad(match):
+        whole, dot, fraction = match.group(1).partition('.')
+        return whole.rjust(NATSORT_WIDTH, '0') + dot + fraction
+    if not isinstance(obj, basestring):
+        obj = unicode(obj)
+    return __natsort_rx.sub(pad, to_unicode(obj))
+
+
 def delete_or_expunge(obj):
     """
     If the object is in object_session(obj).new then expunge it from the
@@ -20,11 +20,11 @@
 #
 # Description: the default view
 #
-import itertools
 import os
 import sys
 import traceback
 import cgi
+from collections import OrderedDict
 
 import logging
 logger = logging.getLogger(__name__)
@@ -37,6 +37,7 @@ import threading
 
 from bauble.i18n import _
 from pyparsing import ParseException
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import object_session
 import sqlalchemy.exc as saexc
 
@@ -47,6 +48,7 @@ from bauble import paths
 from bauble import pluginmgr
 from bauble import prefs
 from bauble import search
+from bauble import sortkey
 from bauble import utils
 from bauble import editor
 from bauble import pictures_view
@@ -397,6 +399,28 @@ class AddOneDot(threading.Thread):
             gobject.idle_add(self.callback, self.dotno)
 
 
+def top_level_count(session, klass, ids):
+    """return the top level count of the klass objects with the given ids
+
+    classes defining top_level_count_query get their figures from the
+    database in one query; for the other classes, the objects are
+    loaded and their top_level_count values merged.  the result maps
+    the top_level_count keys to integers.
+    """
+    ids = set(ids)
+    if hasattr(klass, 'top_level_count_query'):
+        return klass.top_level_count_query(session, ids)
+    d = {}
+    for item in db.load_by_ids(session, klass, ids):
+        for k, v in item.top_level_count().items():
+            if isinstance(v, set):
+                d[k] = v.union(d.get(k, set()))
+            else:
+                d[k] = v + d.get(k, 0)
+    return dict((k, len(v) if isinstance(v, set) else v)
+                for k, v in d.items())
+
+
 class CountResultsTask(threading.Thread):
     def __init__(self, klass, ids, dots_thread,
                  group=None, verbose=None, **kwargs):
@@ -411,24 +435,12 @@ class CountResultsTask(threading.Thread):
         self.__cancel = True
 
     def run(self):
-        session = db.Session()
-        klass = self.klass
-        d = {}
-        for ndx in self.ids:
-            item = session.query(klass).filter(klass.id == ndx).one()
-            if self.__cancel:  # check whether caller asks to cancel
-                break
-            for k, v in item.top_level_count().items():
-                if isinstance(v, set):
-                    d[k] = v.union(d.get(k, set()))
-                else:
-                    d[k] = v + d.get(k, 0)
+        with db.worker_session() as session:
+            d = top_level_count(session, self.klass, self.ids)
         result = []
         for k, v in sorted(d.items()):
             if isinstance(k, tuple):
                 k = k[1]
-            if isinstance(v, set):
-                v = len(v)
             result.append("%s: %d" % (k, v))
             if self.__cancel:  # check whether caller asks to cancel
                 break
@@ -444,8 +456,246 @@ class CountResultsTask(threading.Thread):
                 gobject.idle_add(callback, value)
         else:
             logger.debug("showing text %s", value)
-        ## we should not leave the session around
-        session.close()
+
+
+class ResultNode(object):
+    """a row of the SearchResultsModel
+
+    a node only knows the class and id of the object it shows, its sort
+    key, and its position in the tree.  `children` is None until the
+    row is expanded.
+    """
+    __slots__ = ('cls', 'id', 'key', 'parent', 'index', 'children')
+
+    def __init__(self, cls, id, key=None, parent=None, index=0):
+        self.cls = cls
+        self.id = id
+        self.key = key
+        self.parent = parent
+        self.index = index
+        self.children = None
+
+
+def result_sort_key(obj):
+    """the sort key of obj in the search results
+
+    results are grouped by type, and naturally sorted within each group.
+    """
+    return (type(obj).__name__, db.natsort_key(obj))
+
+
+class SearchResultsModel(gtk.GenericTreeModel):
+    """a lazy tree model for the search results
+
+    the model holds `(class, id)` pairs and sort keys, not the objects.
+    the objects are loaded in pages of `page_size` rows, when the view
+    asks for a value, and at most `cache_size` of them are kept alive.
+    """
+
+    page_size = 100
+    cache_size = 1000
+
+    def __init__(self, session, has_children=lambda cls: False,
+                 get_children=None):
+        """
+        :param session: the session the objects are loaded in
+        :param has_children: a callable telling whether objects of a
+          class can have children, before the row is expanded
+        :param get_children: if given, a callable returning the children
+          of an object, used to tell whether a row the view asks about
+          actually has children
+        """
+        super(SearchResultsModel, self).__init__()
+        self.props.leak_references = False
+        self.session = session
+        self.has_children = has_children
+        self.get_children = get_children
+        self.roots = []
+        self.live = OrderedDict()  # (class, id) -> object, in LRU order
+        self.loads = 0
+
+    def set_rows(self, rows):
+        """replace the top level rows
+
+        :param rows: a list of (sort key, class, id) triples
+        """
+        self.roots = self._make_nodes(sorted(rows), None)
+
+    def _make_nodes(self, rows, parent):
+        nodes = []
+        seen = set()
+        for key, cls, id in rows:
+            if (cls, id) in seen:
+                continue
+            seen.add((cls, id))
+            nodes.append(ResultNode(cls, id, key, parent, len(nodes)))
+        return nodes
+
+    def siblings(self, node):
+        if node.parent is None:
+            return self.roots
+        return node.parent.children
+
+    def get_object(self, node):
+        """return the object shown by node, loading its page if needed
+
+        None if the object does not exist any more.
+        """
+        pair = (node.cls, node.id)
+        obj = self.live.pop(pair, None)
+        if obj is None:
+            siblings = self.siblings(node)
+            start = node.index - node.index % self.page_size
+            page = [(n.cls, n.id)
+                    for n in siblings[start:start + self.page_size]
+                    if (n.cls, n.id) not in self.live]
+            self.loads += 1
+            for loaded in search.hydrate(self.session, page):
+                self._keep((type(loaded), loaded.id), loaded)
+            obj = self.live.pop(pair, None)
+        if obj is not None:
+            self._keep(pair, obj)
+        return obj
+
+    def _keep(self, pair, obj):
+        self.live[pair] = obj
+        # a page must fit, or it would push itself out
+        while len(self.live) > max(self.cache_size, self.page_size):
+            self.live.popitem(last=False)
+
+    def live_objects(self):
+        """the objects currently loaded
+        """
+        return self.live.values()
+
+    def find(self, obj):
+        """return the nodes showing obj, at any level of the tree
+        """
+        pair = (type(obj), obj.id)
+        result = []
+        stack = list(self.roots)
+        while stack:
+            node = stack.pop()
+            if (node.cls, node.id) == pair:
+                result.append(node)
+            if node.children:
+                stack.extend(node.children)
+        return result
+
+    def append_object(self, obj):
+        """add a top level row for obj, return its tree iter
+        """
+        node = ResultNode(type(obj), obj.id, result_sort_key(obj), None,
+                          len(self.roots))
+        self.roots.append(node)
+        self._keep((node.cls, node.id), obj)
+        path = self.on_get_path(node)
+        treeiter = self.get_iter(path)
+        self.row_inserted(path, treeiter)
+        self.row_has_child_toggled(path, treeiter)
+        return treeiter
+
+    def set_children(self, treeiter, kids):
+        """replace the children of the row at treeiter with kids
+        """
+        node = self.get_user_data(treeiter)
+        self.remove_children(treeiter)
+        rows = sorted((result_sort_key(k), type(k), k.id) for k in kids)
+        node.children = self._make_nodes(rows, node)
+        for kid in kids:
+            self._keep((type(kid), kid.id), kid)
+        for child in node.children:
+            path = self.on_get_path(child)
+            self.row_inserted(path, self.get_iter(path))
+        path = self.on_get_path(node)
+        self.row_has_child_toggled(path, treeiter)
+
+    def remove_children(self, treeiter):
+        node = self.get_user_data(treeiter)
+        if not node.children:
+            return
+        path = self.on_get_path(node)
+        while node.children:
+            child = node.children.pop()
+            self.row_deleted(path + (child.index, ))
+        node.children = None
+
+    def remove(self, treeiter):
+        """remove the row at treeiter, and its children
+        """
+        node = self.get_user_data(treeiter)
+        path = self.on_get_path(node)
+        siblings = self.siblings(node)
+        del siblings[node.index]
+        for i in range(node.index, len(siblings)):
+            siblings[i].index = i
+        self.live.pop((node.cls, node.id), None)
+        self.row_deleted(path)
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_ITERS_PERSIST
+
+    def on_get_n_columns(self):
+        return 1
+
+    def on_get_column_type(self, index):
+        return object
+
+    def on_get_iter(self, path):
+        node = None
+        nodes = self.roots
+        for i in path:
+            if nodes is None or i >= len(nodes):
+                return None
+            node = nodes[i]
+            nodes = node.children
+        return node
+
+    def on_get_path(self, node):
+        path = []
+        while node is not None:
+            path.insert(0, node.index)
+            node = node.parent
+        return tuple(path)
+
+    def on_get_value(self, node, column):
+        return self.get_object(node)
+
+    def on_iter_next(self, node):
+        siblings = self.siblings(node)
+        if node.index + 1 < len(siblings):
+            return siblings[node.index + 1]
+        return None
+
+    def on_iter_children(self, node):
+        nodes = self.roots if node is None else node.children
+        return nodes and nodes[0] or None
+
+    def on_iter_has_child(self, node):
+        if node.children is None:
+            if not self.has_children(node.cls):
+                return False
+            if self.get_children is None:
+                return True
+            obj = self.get_object(node)
+            if obj is None or not self.get_children(obj):
+                node.children = []
+            else:
+                return True
+        return len(node.children) > 0
+
+    def on_iter_n_children(self, node):
+        nodes = self.roots if node is None else node.children
+        return len(nodes or [])
+
+    def on_iter_nth_child(self, node, n):
+        nodes = self.roots if node is None else node.children
+        if nodes and n < len(nodes):
+            return nodes[n]
+        return None
+
+    def on_iter_parent(self, node):
+        return node.parent
 
 
 class SearchView(pluginmgr.View):
@@ -788,7 +1038,7 @@ class SearchView(pluginmgr.View):
         bold = '<b>%s</b>'
         results = []
         try:
-            results = search.search(text, self.session)
+            results = search.search_pairs(text, self.session)
         except ParseException, err:
             error_msg = _('Error in search string at column %s') % err.column
         except (BaubleError, AttributeError, Exception, SyntaxError), e:
@@ -801,7 +1051,7 @@ class SearchView(pluginmgr.View):
             return
 
         # not error
-        utils.clear_model(self.results_view)
+        self.clear_results()
         self.update_infobox()
         statusbar = bauble.gui.widgets.statusbar
         sbcontext_id = statusbar.get_context_id('searchview.nresults')
@@ -813,12 +1063,6 @@ class SearchView(pluginmgr.View):
             model.append([msg])
             self.results_view.set_model(model)
         else:
-            if len(results) > 5000:
-                msg = _('This query returned %s results.  It may take a '
-                        'long time to get all the data. Are you sure you '
-                        'want to continue?') % len(results)
-                if not utils.yes_no_dialog(msg):
-                    return
             statusbar.push(sbcontext_id, _("Retrieving %s search "
                                            "results...") % len(results))
             try:
@@ -842,10 +1086,10 @@ class SearchView(pluginmgr.View):
             else:
                 statusbar.pop(sbcontext_id)
                 statusbar.push(sbcontext_id, _('counting results'))
-                if len(set(item.__class__ for item in results)) == 1:
+                if len(set(cls for cls, id in results)) == 1:
                     dots_thread = self.start_thread(AddOneDot())
                     self.start_thread(CountResultsTask(
-                        results[0].__class__, [i.id for i in results],
+                        results[0][0], [id for cls, id in results],
                         dots_thread))
                 else:
                     statusbar.push(sbcontext_id,
@@ -856,15 +1100,16 @@ class SearchView(pluginmgr.View):
 
         self.update_bottom_notebook()
 
-    def remove_children(self, model, parent):
+    def clear_results(self):
         """
-        Remove all children of some parent in the model, reverse
-        iterate through them so you don't invalidate the iter
+        Remove the results model from the view.
         """
-        while model.iter_has_child(parent):
-            nkids = model.iter_n_children(parent)
-            child = model.iter_nth_child(parent, nkids-1)
-            model.remove(child)
+        model = self.results_view.get_model()
+        if isinstance(model, SearchResultsModel):
+            # clear_model would load every row just to forget it
+            self.results_view.set_model(None)
+        else:
+            utils.clear_model(self.results_view)
 
     def on_test_expand_row(self, view, treeiter, path, data=None):
         '''
@@ -874,25 +1119,23 @@ class SearchView(pluginmgr.View):
         model = view.get_model()
         row = model.get_value(treeiter, 0)
         view.collapse_row(path)
-        self.remove_children(model, treeiter)
+        if row is None:
+            # the object is gone
+            model.remove(treeiter)
+            return True
         try:
             kids = self.row_meta[type(row)].get_children(row)
-            if len(kids) == 0:
-                return True
         except saexc.InvalidRequestError, e:
             logger.debug(utils.utf8(e))
-            model = self.results_view.get_model()
-            for found in utils.search_tree_model(model, row):
-                model.remove(found)
+            for found in model.find(row):
+                model.remove(model.create_tree_iter(found))
             return True
         except Exception, e:
             logger.debug(utils.utf8(e))
             logger.debug(traceback.format_exc())
             return True
-        else:
-            self.append_children(
-                model, treeiter, sorted(kids, key=utils.natsort_key))
-            return False
+        model.set_children(treeiter, kids)
+        return len(kids) == 0
 
     def populate_results(self, results, check_for_kids=False):
         """
@@ -907,76 +1150,41 @@ class SearchView(pluginmgr.View):
         """
         Generator function for adding the search results to the
         model. This method is usually called by self.populate_results()
-        """
-        nresults = len(results)
-        model = gtk.TreeStore(object)
-        model.set_default_sort_func(lambda *args: -1)
-        model.set_sort_column_id(-1, gtk.SORT_ASCENDING)
-        utils.clear_model(self.results_view)
-
-        groups = []
-
-        # sort by type so that groupby works properly
-        results = sorted(results, key=lambda x: type(x))
-
-        for key, group in itertools.groupby(results, key=lambda x: type(x)):
-            # return groups by type and natural sort each of the
-            # groups by their strings
-            groups.append(sorted(group, key=utils.natsort_key, reverse=True))
 
-        # sort the groups by type so we more or less always get the
-        # results by type in the same order
-        groups = sorted(groups, key=lambda x: type(x[0]), reverse=True)
+        :param results: a list of (class, id) pairs, or of objects
 
-        update_every = 200
-        steps_so_far = 0
-
-        # iterate over slice of size "steps", yield after adding each
-        # slice to the model
-        #for obj in itertools.islice(itertools.chain(*groups), 0,None, steps):
-        #for obj in itertools.islice(itertools.chain(results), 0,None, steps):
-
-        added = set()
-        for obj in itertools.chain(*groups):
-            if obj in added:  # only add unique object
-                continue
-            else:
-                added.add(obj)
-            parent = model.prepend(None, [obj])
-            obj_type = type(obj)
-            if check_for_kids:
-                kids = self.row_meta[obj_type].get_children(obj)
-                if len(kids) > 0:
-                    model.prepend(parent, ['-'])
-            elif self.row_meta[obj_type].children is not None:
-                model.prepend(parent, ['-'])
-            #steps_so_far += chunk_size
-            steps_so_far += 1
-            if steps_so_far % update_every == 0:
-                percent = float(steps_so_far)/float(nresults)
-                if 0 < percent < 1.0:
-                    bauble.gui.progressbar.set_fraction(percent)
-                yield
+        the model keeps the class, id and sort key of each result, the
+        objects are loaded when their rows become visible.
+        """
+        nresults = len(results)
+        get_children = None
+        if check_for_kids:
+            get_children = lambda obj: \
+                self.row_meta[type(obj)].get_children(obj)
+        model = SearchResultsModel(
+            self.session, lambda cls: self.row_meta[cls].children is not None,
+            get_children)
+        self.clear_results()
+
+        ids = {}
+        for item in results:
+            if not isinstance(item, tuple):
+                item = (type(item), item.id)
+            ids.setdefault(item[0], []).append(item[1])
+        rows = []
+        for cls, cls_ids in ids.iteritems():
+            keys = sortkey.keys(self.session, cls, cls_ids)
+            rows.extend(((cls.__name__, keys[i]), cls, i)
+                        for i in cls_ids if i in keys)
+            percent = float(len(rows))/float(nresults)
+            if 0 < percent < 1.0:
+                bauble.gui.progressbar.set_fraction(percent)
+            yield
+        model.set_rows(rows)
         self.results_view.freeze_child_notify()
         self.results_view.set_model(model)
         self.results_view.thaw_child_notify()
 
-    def append_children(self, model, parent, kids):
-        """
-        append object to a parent iter in the model
-
-        :param model: the model the append to
-        :param parent:  the parent gtk.TreeIter
-        :param kids: a list of kids to append
-        @return: the model with the kids appended
-        """
-        check(parent is not None, "append_children(): need a parent")
-        for k in kids:
-            i = model.append(parent, [k])
-            if self.row_meta[type(k)].children is not None:
-                model.append(i, ["_dummy"])
-        return model
-
     def cell_data_func(self, col, cell, model, treeiter):
         # start with a (redundant) check, whether the cell is visible.
         path = model.get_path(treeiter)
@@ -988,7 +1196,11 @@ class SearchView(pluginmgr.View):
         value = model[treeiter][0]
         #logger.debug('TBR: far too detailed, please do not keep us here')
         #logger.debug('TBR: %s' % value)
-        if isinstance(value, basestring):
+        if value is None:
+            # deleted since the search, the row goes
+            cell.set_property('markup', '')
+            gobject.idle_add(self.remove_row, model.get_user_data(treeiter))
+        elif isinstance(value, basestring):
             cell.set_property('markup', value)
         else:
             # if the value isn't part of a session then add it to the
@@ -1021,13 +1233,8 @@ class SearchView(pluginmgr.View):
                     'bauble.view.SearchView.cell_data_func(): \n(%s)%s' %
                     (type(e), e))
 
-                def remove():
-                    model = self.results_view.get_model()
-                    self.results_view.set_model(None)  # detach model
-                    for found in utils.search_tree_model(model, value):
-                        model.remove(found)
-                    self.results_view.set_model(model)
-                gobject.idle_add(remove)
+                for found in model.find(value):
+                    gobject.idle_add(self.remove_row, found)
 
             except Exception, e:
                 logger.error(
@@ -1035,6 +1242,17 @@ class SearchView(pluginmgr.View):
                     (type(e), e))
                 raise
 
+    def remove_row(self, node):
+        """
+        Remove the row of a ResultNode from the results, if still there.
+        """
+        model = self.results_view.get_model()
+        if not isinstance(model, SearchResultsModel):
+            return
+        siblings = model.siblings(node) or []
+        if node.index < len(siblings) and siblings[node.index] is node:
+            model.remove(model.create_tree_iter(node))
+
     def get_expanded_rows(self):
         '''
         return all the rows in the model that are expanded
@@ -1150,11 +1368,11 @@ class SearchView(pluginmgr.View):
         # and Accession right now....it's a bit of a hack since there's
         # no real interface that the method complies to...but it does
         # fix our string caching issues
-        def invalidate_cache(model, path, treeiter, data=None):
-            obj = model[path][0]
-            if hasattr(obj, 'invalidate_str_cache'):
-                obj.invalidate_str_cache()
-        model.foreach(invalidate_cache)
+        # only the loaded objects have a cache to invalidate
+        if isinstance(model, SearchResultsModel):
+            for obj in model.live_objects():
+                if hasattr(obj, 'invalidate_str_cache'):
+                    obj.invalidate_str_cache()
         expanded_rows = self.get_expanded_rows()
         self.results_view.collapse_all()
         # expand_to_all_refs will invalidate the ref so get the path first
@@ -1294,18 +1512,22 @@ class AppendThousandRows(threading.Thread):
         self.__stopped.set()
 
     def run(self):
-        session = db.Session()
-        q = session.query(db.History).order_by(db.History.timestamp.desc())
-        # add rows in small batches
-        offset = 0
-        step = 200
-        count = q.count()
-        while offset < count and not self.__stopped.isSet():
-            rows = q.offset(offset).limit(step).all()
-            gobject.idle_add(self.callback, rows)
-            offset += step
-        session.close()
-        if offset < count:
+        History = db.History
+        with db.worker_session() as session:
+            q = session.query(History).order_by(
+                History.timestamp.desc(), History.id.desc())
+            # add rows in small batches, each one starting where the
+            # previous one ended, along the timestamp index
+            step = 200
+            rows = q.limit(step).all()
+            while rows and not self.__stopped.isSet():
+                gobject.idle_add(self.callback, rows)
+                last = rows[-1]
+                rows = q.filter(and_(
+                    History.timestamp <= last.timestamp,
+                    or_(History.timestamp < last.timestamp,
+                        History.id < last.id))).limit(step).all()
+        if rows:
             gobject.idle_add(self.cancel_callback)
 
 
@@ -1439,13 +1661,19 @@ def select_in_search_results(obj):
     logger.debug("select_in_search_results %s is in session %s" %
                  (obj, obj in view.session))
     model = view.results_view.get_model()
-    found = utils.search_tree_model(model, obj)
+    if not isinstance(model, SearchResultsModel):
+        # there were no results
+        model = SearchResultsModel(
+            view.session,
+            lambda cls: view.row_meta[cls].children is not None)
+        view.clear_results()
+        view.results_view.set_model(model)
+    found = model.find(obj)
     row_iter = None
     if len(found) > 0:
-        row_iter = found[0]
+        row_iter = model.create_tree_iter(found[0])
     else:
-        row_iter = model.append(None, [obj])
-        model.append(row_iter, ['-'])
+        row_iter = model.append_object(obj)
     view.results_view.set_cursor(model.get_path(row_iter))
     return row_iter
 
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# benchmark_csvexport.py
+#
+# time the csv export of a generated history table, and compare the
+# peak memory of the streaming export with the one of reading the whole
+# table at once, as the exporter used to do.
+#
+# usage: benchmark_csvexport.py [-c URI] [-n ROWS] [-z]
+#
+# the database at URI is created from scratch, do not point this script
+# to a database holding data you care about.
+#
+
+import os
+import resource
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option('-c', '--conn', dest='uri', default='sqlite:///:memory:',
+                  help='the db connection uri', metavar='URI')
+parser.add_option('-n', '--rows', dest='rows', type='int', default=1000000,
+                  help='number of history rows to generate')
+parser.add_option('-z', '--gzip', dest='compress', action='store_true',
+                  default=False, help='write gzipped files')
+(options, args) = parser.parse_args()
+
+import datetime
+import bauble.db as db
+from bauble.plugins.imex.csv_ import CSVExporter
+from bauble.test import init_bauble
+
+init_bauble(options.uri)
+table = db.History.__table__
+now = datetime.datetime.now()
+for start in range(0, options.rows, 10000):
+    db.engine.execute(table.insert(), [
+        {'table_name': u'plant', 'table_id': i, 'operation': u'update',
+         'values': u"{'code': u'%d', 'quantity': %d}" % (i, i % 7),
+         'user': u'bench', 'timestamp': now}
+        for i in range(start, min(start + 10000, options.rows))])
+
+
+def peak_memory():
+    'the peak resident memory of this process, in MB'
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+tempdir = tempfile.mkdtemp()
+filename = os.path.join(tempdir, 'history.txt')
+if options.compress:
+    filename += '.gz'
+
+before = peak_memory()
+start = time.time()
+for step in CSVExporter().export_table(table, filename):
+    pass
+elapsed = time.time() - start
+print 'streaming export: %d rows in %.2fs, %d rows/s, %d bytes' % (
+    options.rows, elapsed, options.rows / elapsed, os.path.getsize(filename))
+print '  peak memory grew by %.1f MB' % (peak_memory() - before)
+
+before = peak_memory()
+rows = table.select().execute().fetchall()
+print 'reading the whole table: peak memory grew by %.1f MB' % (
+    peak_memory() - before)
+shutil.rmtree(tempdir)
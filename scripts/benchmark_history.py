@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# benchmark_history.py
+#
+# time opening the history view on a generated history table, with and
+# without its indexes: the first page of rows, and a page deep in the
+# table, read by OFFSET as the view used to do, and from the previous
+# page.  then time compacting and archiving the table.
+#
+# usage: benchmark_history.py [-c URI] [-n ROWS] [-p PAGE]
+#
+# the database at URI is created from scratch, do not point this script
+# to a database holding data you care about.
+#
+
+import datetime
+import time
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option('-c', '--conn', dest='uri', default='sqlite:///:memory:',
+                  help='the db connection uri', metavar='URI')
+parser.add_option('-n', '--rows', dest='rows', type='int', default=5000000,
+                  help='number of history rows to generate')
+parser.add_option('-p', '--page', dest='page', type='int', default=1000,
+                  help='the deep page to read')
+(options, args) = parser.parse_args()
+
+import sqlalchemy as sa
+import bauble.db as db
+import bauble.history as history
+from bauble.test import init_bauble
+
+STEP = 200  # rows per page, as in the history view
+
+init_bauble(options.uri)
+table = db.History.__table__
+start = time.time()
+first = datetime.datetime.now() - datetime.timedelta(
+    seconds=options.rows * 10)
+for offset in range(0, options.rows, 10000):
+    db.engine.execute(table.insert(), [
+        {'table_name': u'plant', 'table_id': i % 50000, 'operation':
+         i < 50000 and u'insert' or u'update',
+         'values': u"{'code': u'%d', 'quantity': %d}" % (i, i % 7),
+         'user': u'bench%d' % (i // 250000 % 3),
+         'timestamp': first + datetime.timedelta(seconds=i * 10)}
+        for i in range(offset, min(offset + 10000, options.rows))])
+print '%d rows generated in %.1fs' % (options.rows, time.time() - start)
+
+History = db.History
+session = db.Session()
+q = session.query(History).order_by(History.timestamp.desc(),
+                                    History.id.desc())
+
+
+def step(name, function):
+    start = time.time()
+    result = function()
+    print '  %-32s %8.3fs' % (name, time.time() - start)
+    return result
+
+
+def open_by_offset():
+    'what the view did: count the rows, then read the first page'
+    q.count()
+    return q.offset(0).limit(STEP).all()
+
+
+def deep_page_by_offset():
+    return q.offset(options.page * STEP).limit(STEP).all()
+
+
+def next_page(last):
+    return q.filter(sa.and_(
+        History.timestamp <= last.timestamp,
+        sa.or_(History.timestamp < last.timestamp,
+               History.id < last.id))).limit(STEP).all()
+
+
+def run():
+    step('open, count and offset', open_by_offset)
+    step('open, first page', lambda: q.limit(STEP).all())
+    last = step('page %d by offset' % options.page, deep_page_by_offset)[0]
+    session.expunge_all()
+    step('page %d from the previous' % options.page,
+         lambda: next_page(last))
+    session.expunge_all()
+
+print 'without indexes'
+for index in table.indexes:
+    index.drop(bind=db.engine)
+run()
+print 'with indexes'
+step('create indexes', history.upgrade)
+run()
+session.close()
+
+connection = db.engine.connect()
+step('compact', lambda: history.compact(connection))
+step('archive a year', lambda: history.archive(
+    connection, datetime.datetime.now() - datetime.timedelta(days=365)))
+print '%d rows left' % db.engine.execute(
+    sa.select([sa.func.count()]).select_from(table)).scalar()
+connection.close()
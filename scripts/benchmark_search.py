@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# benchmark_search.py
+#
+# compare the number of database round trips and the time spent by
+# domain expression searches, in the per-property form used up to now
+# and in the single statement compiled by search.compile_domain_query.
+#
+# usage: benchmark_search.py [-c URI] [-n SPECIES] [-r REPEAT]
+#
+# the database at URI is created from scratch, do not point this script
+# to a database holding data you care about.
+#
+
+import time
+from optparse import OptionParser
+
+from sqlalchemy import or_
+from sqlalchemy.orm import class_mapper
+
+parser = OptionParser()
+parser.add_option('-c', '--conn', dest='uri', default='sqlite:///:memory:',
+                  help='the db connection uri', metavar='URI')
+parser.add_option('-n', '--species', dest='species', type='int',
+                  default=40000, help='number of species to generate')
+parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5,
+                  help='how many times to run each search')
+(options, args) = parser.parse_args()
+
+import bauble.db as db
+import bauble.search as search
+import bauble.utils as utils
+from bauble.test import init_bauble, StatementCounter
+
+init_bauble(options.uri)
+from bauble.plugins.plants import Family, Genus, Species
+
+families = [{'id': i, 'epithet': u'Familyaceae%d' % i}
+            for i in range(1, 51)]
+genera = [{'id': i, 'epithet': u'Genus%d' % i, 'family_id': i % 50 + 1}
+          for i in range(1, 1001)]
+species = [{'id': i, 'epithet': u'epithet%d' % i, 'genus_id': i % 1000 + 1,
+            'infrasp1': (i % 7 == 0) and u'sub%d' % i or None}
+           for i in range(1, options.species + 1)]
+db.engine.execute(Family.__table__.insert(), families)
+db.engine.execute(Genus.__table__.insert(), genera)
+db.engine.execute(Species.__table__.insert(), species)
+
+def per_property(session, text):
+    """the domain expression search as it was, one query per property
+    """
+    domain, values = text.split(' contains ')
+    cls, properties = search.MapperSearch._domains[domain]
+    mapper = class_mapper(cls)
+    query = session.query(cls)
+    result = set()
+    for col in properties:
+        ors = or_(*[utils.ilike(mapper.c[col], '%%%s%%' % v)
+                    for v in values.split()])
+        result.update(query.filter(ors).all())
+    return result
+
+
+def compiled(use_union):
+    def run(session, text):
+        search.DomainExpressionAction.use_union = use_union
+        search.MapperSearch.result_cache.clear()
+        return search.get_strategy('MapperSearch').search(text, session)
+    return run
+
+queries = ['species contains 12', 'species contains sub7 epithet99']
+runners = [('per property', per_property),
+           ('single OR', compiled(False)),
+           ('UNION of ids', compiled(True))]
+
+for text in queries:
+    print text
+    for name, runner in runners:
+        elapsed = []
+        for i in range(options.repeat):
+            session = db.Session()
+            start = time.time()
+            with StatementCounter() as statements:
+                found = len(runner(session, text))
+            elapsed.append(time.time() - start)
+            session.close()
+        print '  %-14s %6d objects %3d statements %8.4fs (best of %d)' % (
+            name, found, len(statements), min(elapsed), options.repeat)
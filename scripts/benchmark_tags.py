@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# benchmark_tags.py
+#
+# time tagging, expanding, counting and untagging a selection of
+# generated locations, and count the statements each step executes.
+#
+# usage: benchmark_tags.py [-c URI] [-n OBJECTS]
+#
+# the database at URI is created from scratch, do not point this script
+# to a database holding data you care about.
+#
+
+import time
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option('-c', '--conn', dest='uri', default='sqlite:///:memory:',
+                  help='the db connection uri', metavar='URI')
+parser.add_option('-n', '--objects', dest='objects', type='int',
+                  default=10000, help='number of objects to tag')
+(options, args) = parser.parse_args()
+
+import bauble.db as db
+from bauble.plugins.garden import Location
+from bauble.plugins.tag import Tag, tag_objects, untag_objects, get_tag_ids
+from bauble.test import init_bauble, StatementCounter
+
+init_bauble(options.uri)
+db.engine.execute(Location.__table__.insert(), [
+    {'code': u'L%d' % i, 'name': u'location %d' % i}
+    for i in range(options.objects)])
+
+session = db.Session()
+selection = session.query(Location).all()
+
+
+def step(name, function, *args):
+    start = time.time()
+    with StatementCounter() as statements:
+        result = function(*args)
+    print '%-24s %8.2fs %6d statements' % (
+        name, time.time() - start, len(statements))
+    return result
+
+print '%d objects' % len(selection)
+step('tag half', tag_objects, u'bench', selection[::2])
+step('tag all', tag_objects, u'bench', selection)
+step('common tags', get_tag_ids, selection)
+tag = session.query(Tag).filter_by(tag=u'bench').one()
+step('count tagged', tag.get_tagged_counts)
+step('expand tag', tag.get_tagged_objects)
+step('untag all', untag_objects, u'bench', selection)
+session.close()
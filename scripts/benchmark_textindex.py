@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# benchmark_textindex.py
+#
+# time substring searches on a generated garden of 100k plants, first
+# without and then with the trigram indexes built by bauble.textindex.
+#
+# usage: benchmark_textindex.py [-c URI] [-n PLANTS] [-r REPEAT]
+#
+# the database at URI is created from scratch, do not point this script
+# to a database holding data you care about.
+#
+
+import time
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option('-c', '--conn', dest='uri', default='sqlite:///:memory:',
+                  help='the db connection uri', metavar='URI')
+parser.add_option('-n', '--plants', dest='plants', type='int',
+                  default=100000, help='number of plants to generate')
+parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5,
+                  help='how many times to run each search')
+(options, args) = parser.parse_args()
+
+import bauble.db as db
+import bauble.search as search
+import bauble.textindex as textindex
+from bauble.test import init_bauble
+
+init_bauble(options.uri)
+from bauble.plugins.plants import Family, Genus, Species
+from bauble.plugins.garden import Accession, Location, Plant
+
+n_accessions = options.plants / 4
+db.engine.execute(Family.__table__.insert(),
+                  [{'id': i, 'epithet': u'Familyaceae%d' % i}
+                   for i in range(1, 51)])
+db.engine.execute(Genus.__table__.insert(),
+                  [{'id': i, 'epithet': u'Genus%d' % i,
+                    'family_id': i % 50 + 1}
+                   for i in range(1, 1001)])
+db.engine.execute(Species.__table__.insert(),
+                  [{'id': i, 'epithet': u'epithet%d' % i,
+                    'genus_id': i % 1000 + 1}
+                   for i in range(1, 10001)])
+db.engine.execute(Location.__table__.insert(),
+                  [{'id': i, 'code': u'LOC%d' % i, 'name': u'bed %d' % i}
+                   for i in range(1, 201)])
+db.engine.execute(Accession.__table__.insert(),
+                  [{'id': i, 'code': u'%04d.%05d' % (1990 + i % 25, i),
+                    'species_id': i % 10000 + 1}
+                   for i in range(1, n_accessions + 1)])
+db.engine.execute(Plant.__table__.insert(),
+                  [{'id': i, 'code': u'%d' % (i / n_accessions + 1),
+                    'quantity': 1, 'accession_id': i % n_accessions + 1,
+                    'location_id': i % 200 + 1}
+                   for i in range(1, options.plants + 1)])
+
+queries = ['plant contains 3', 'acc contains 00042', 'loc contains bed',
+           'sp contains ithet99', 'ithet123, 2004.0']
+
+
+def run_all(title):
+    print title
+    for text in queries:
+        elapsed = []
+        for i in range(options.repeat):
+            session = db.Session()
+            start = time.time()
+            found = len(search.get_strategy('MapperSearch').search(
+                text, session))
+            elapsed.append(time.time() - start)
+            session.close()
+        print '  %-22s %7d objects %8.4fs (best of %d)' % (
+            text, found, min(elapsed), options.repeat)
+
+run_all('without trigram index')
+start = time.time()
+textindex.build()
+print 'building the index: %.2fs' % (time.time() - start)
+run_all('with trigram index')
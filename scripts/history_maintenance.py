@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Mario Frasca <mario@anche.no>.
+#
+# This file is part of ghini.desktop.
+#
+# ghini.desktop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ghini.desktop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ghini.desktop. If not, see <http://www.gnu.org/licenses/>.
+#
+# history_maintenance.py
+#
+# compact the history table of a ghini database, collapsing the
+# consecutive updates of each object by the same user, and archive the
+# rows older than a number of days.  meant to be run periodically, for
+# example by cron.
+#
+# usage: history_maintenance.py -c URI [-k DAYS] [-a DAYS]
+#
+
+import datetime
+import sys
+import time
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option('-c', '--conn', dest='uri',
+                  help='the db connection uri', metavar='URI')
+parser.add_option('-k', '--compact-days', dest='compact_days', type='int',
+                  default=0, help='compact the rows older than DAYS days',
+                  metavar='DAYS')
+parser.add_option('-a', '--archive-days', dest='archive_days', type='int',
+                  help='archive the rows older than DAYS days',
+                  metavar='DAYS')
+(options, args) = parser.parse_args()
+if not options.uri:
+    parser.error('a database connection uri is required')
+
+import bauble.db as db
+import bauble.history as history
+
+
+def days_ago(days):
+    return datetime.datetime.today() - datetime.timedelta(days=days)
+
+db.open(options.uri)
+connection = db.engine.connect()
+try:
+    start = time.time()
+    collapsed = history.compact(connection, days_ago(options.compact_days))
+    print 'collapsed %d updates in %.1fs' % (collapsed, time.time() - start)
+    if options.archive_days is not None:
+        start = time.time()
+        archived = history.archive(connection, days_ago(options.archive_days))
+        print 'archived %d rows in %.1fs' % (archived, time.time() - start)
+except Exception, e:
+    print >>sys.stderr, e
+    sys.exit(1)
+finally:
+    connection.close()